@@ -0,0 +1,586 @@
+"""Асинхронный путь для аналитики только на чтение: баланс, потребность, рекомендации, отчёты.
+
+Отдельное ASGI-приложение на asyncpg со своим пулом соединений на шард. Пока PostgreSQL
+считает v_capacity_balance, запрос не держит поток воркера: один процесс ждёт сотни
+запросов в событийном цикле. Независимые запросы одного ответа (строки и итоги,
+запросы к разным шардам) идут параллельно; если клиент закрыл соединение, запрос
+в БД отменяется.
+
+Ответы — JSON, адреса — /api/analytics/… (прокси направляет их на этот сервер).
+Аналитика читается с реплики шарда, если её отставание не больше DB_REPLICA_MAX_LAG;
+read-your-writes здесь нет — сессии пользователя у этого сервера нет.
+Одновременных ответов в процессе не больше ANALYTICS_CONCURRENCY (остальные ждут
+до ANALYTICS_QUEUE_TIMEOUT сек. и получают 503), запросы к БД ограничены
+statement_timeout тяжёлых маршрутов (DB_STATEMENT_TIMEOUT_HEAVY).
+
+Здесь же поток изменений баланса /api/analytics/events/capacity (SSE, как /events/capacity
+в app.py): открытая вкладка — это задача в событийном цикле, а не поток воркера gunicorn.
+Страница баланса подключается сюда, если в окружении веб-приложения задан
+CAPACITY_EVENTS_URL=/api/analytics/events/capacity.
+
+Запуск:
+    uvicorn analytics_async:app --workers 4 --port 5002
+"""
+import asyncio
+import collections
+import heapq
+import json
+import logging
+import operator
+import os
+import time
+from datetime import date, datetime
+from urllib.parse import parse_qs
+
+import asyncpg
+
+from app import (
+    CAPACITY_EVENTS_AFTER_SQL, CAPACITY_EVENTS_CHANNEL, CAPACITY_EVENTS_POSITION_SQL, DB_REPLICA_CHECK_SECONDS,
+    DB_REPLICA_MAX_LAG, DB_REPLICAS, REPORT_EXPORT_COLUMNS, REPORT_EXPORT_QUERIES, REPORT_MERGE_KEYS,
+    SSE_BATCH_SIZE, SSE_HEARTBEAT_SECONDS, SSE_HISTORY_SIZE, SSE_POLL_SECONDS, SSE_QUEUE_SIZE,
+    SSE_RECONNECT_SECONDS, STATEMENT_TIMEOUTS, BalanceColumns, _capacity_event_json, _db_settings,
+    format_event_position, generate_recommendations_from_balance, metrics, parse_event_position,
+    shard_for, shard_names, subtype_catalog,
+)
+
+logger = logging.getLogger(__name__)
+
+# Пул asyncpg на шард (и на его реплику) в каждом процессе
+ANALYTICS_POOL_MIN = int(os.getenv('ANALYTICS_POOL_MIN', 1))
+ANALYTICS_POOL_MAX = int(os.getenv('ANALYTICS_POOL_MAX', 20))
+
+# Одновременных ответов в процессе и сколько ждать места, сек.: сверх лимита — 503
+ANALYTICS_CONCURRENCY = int(os.getenv('ANALYTICS_CONCURRENCY', 16))
+ANALYTICS_QUEUE_TIMEOUT = float(os.getenv('ANALYTICS_QUEUE_TIMEOUT', 20))
+
+# Отчёты, которые отдаёт асинхронный путь (план смен строится в памяти — только синхронно)
+ANALYTICS_REPORTS = ('balance', 'load', 'requirement', 'capacity')
+
+metrics.describe('analytics_async_requests_total', 'counter', 'Асинхронные запросы аналитики: endpoint, status')
+metrics.describe('analytics_async_seconds_total', 'counter', 'Суммарное время ответов асинхронной аналитики')
+metrics.describe('analytics_async_cancelled_total', 'counter', 'Запросы, отменённые из-за обрыва соединения клиентом')
+metrics.describe('analytics_async_rejected_total', 'counter', 'Запросы, не дождавшиеся места: endpoint')
+
+
+class BadRequest(Exception):
+    """Ошибка параметров запроса — ответ 400"""
+
+
+# === Пулы и маршрутизация чтений ===
+_pools = {}
+_pool_lock = asyncio.Lock()
+# Последняя проверка реплик: шард -> (когда, отставание)
+_replica_lag = {}
+
+
+def _connect_settings(shard, replica):
+    """Параметры _db_settings в именах asyncpg"""
+    settings = dict(_db_settings(shard, replica))
+    settings['timeout'] = settings.pop('connect_timeout')
+    if 'dbname' in settings:
+        settings['database'] = settings.pop('dbname')
+    if 'sslmode' in settings:
+        settings['ssl'] = settings.pop('sslmode')
+    return settings
+
+
+async def get_pool(shard, replica=False):
+    key = (shard, replica)
+    pool = _pools.get(key)
+    if pool is None:
+        async with _pool_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = await asyncpg.create_pool(
+                    min_size=ANALYTICS_POOL_MIN, max_size=ANALYTICS_POOL_MAX,
+                    server_settings={'statement_timeout': str(int(STATEMENT_TIMEOUTS['heavy'] * 1000))},
+                    **_connect_settings(shard, replica)
+                )
+    return pool
+
+
+async def close_pools():
+    pools = list(_pools.values())
+    _pools.clear()
+    await asyncio.gather(*(pool.close() for pool in pools))
+
+
+async def _read_pool(shard):
+    """Пул для чтения: реплика шарда, если она есть и не отстаёт, иначе основная база"""
+    if shard not in DB_REPLICAS:
+        return await get_pool(shard)
+    reason = 'replica'
+    try:
+        checked = _replica_lag.get(shard)
+        if checked is None or time.monotonic() - checked[0] >= DB_REPLICA_CHECK_SECONDS:
+            pool = await get_pool(shard, replica=True)
+            lag = await pool.fetchval('''
+                SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                       END::float8;
+            ''')
+            checked = _replica_lag[shard] = (time.monotonic(), lag)
+            metrics.set('db_replica_lag_seconds', lag, shard=shard)
+        if checked[1] > DB_REPLICA_MAX_LAG:
+            reason = 'lag'
+    except (OSError, asyncpg.PostgresError) as e:
+        logger.warning('Реплика шарда %s недоступна: %s', shard, e)
+        reason = 'replica_error'
+    metrics.inc('db_read_route_total', target='replica' if reason == 'replica' else 'primary',
+                reason=reason, shard=shard)
+    return await get_pool(shard, replica=reason == 'replica')
+
+
+def _numbered(sql):
+    """Параметры %s (как в psycopg2) -> $1, $2, … (asyncpg)"""
+    parts = sql.split('%s')
+    return parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+
+
+async def fetch_shard(shard, sql, params):
+    pool = await _read_pool(shard)
+    return await pool.fetch(_numbered(sql), *params)
+
+
+async def fetch_sharded(sql, params, key, warehouse_id=None):
+    """Строки запроса со всех шардов (с warehouse_id — с шарда склада), слитые в порядке key.
+
+    Шарды опрашиваются одновременно; отмена ответа отменяет запросы на всех шардах."""
+    shards = [shard_for(warehouse_id)] if warehouse_id else shard_names()
+    results = await asyncio.gather(*(fetch_shard(shard, sql, params) for shard in shards))
+    if len(results) == 1:
+        return results[0]
+    return list(heapq.merge(*results, key=key))
+
+
+async def fetch_totals(sql, params, warehouse_id=None):
+    """Однострочный итог запроса, сложенный по шардам"""
+    shards = [shard_for(warehouse_id)] if warehouse_id else shard_names()
+    rows = await asyncio.gather(*(fetch_shard(shard, sql, params) for shard in shards))
+    return [sum(values) for values in zip(*(shard_rows[0] for shard_rows in rows))]
+
+
+# === Параметры запроса ===
+def _date_arg(args, name, required=False):
+    value = args.get(name)
+    if not value:
+        if required:
+            raise BadRequest(f'Укажите {name}')
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f'{name}: ожидается дата ГГГГ-ММ-ДД')
+
+
+def _int_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(f'{name}: ожидается число')
+
+
+def _period_conditions(args, column):
+    conditions, params = [], []
+    start_date = _date_arg(args, 'start_date')
+    end_date = _date_arg(args, 'end_date')
+    if start_date:
+        conditions.append(f'{column} >= %s')
+        params.append(start_date)
+    if end_date:
+        conditions.append(f'{column} <= %s')
+        params.append(end_date)
+    return conditions, params
+
+
+def _where(conditions):
+    return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+
+# === Маршруты ===
+async def balance(args):
+    """Баланс мощностей (как /balance) и итоги периода — два запроса параллельно"""
+    warehouse_id = _int_arg(args, 'warehouse_id')
+    as_of = args.get('as_of')
+    if as_of:
+        # Неверный момент иначе отклонил бы PostgreSQL — и ответ был бы 500
+        try:
+            datetime.fromisoformat(as_of)
+        except ValueError:
+            raise BadRequest('as_of: ожидается дата и время ГГГГ-ММ-ДДTЧЧ:ММ')
+    conditions, params = _period_conditions(args, 'date')
+    if warehouse_id:
+        conditions.append('warehouse_id = %s')
+        params.append(warehouse_id)
+    if as_of:
+        # Срез по истории (sql/011_history.sql); момент разбирает PostgreSQL, как и на странице
+        source = 'capacity_balance_as_of(%s::text::timestamptz)'
+        params.insert(0, as_of)
+    else:
+        source = 'v_capacity_balance'
+    where = _where(conditions)
+    rows, totals = await asyncio.gather(
+        fetch_sharded(f'''
+            SELECT date, zone_name, resource_subtype,
+                   ROUND(required_hours, 2)::float8, ROUND(available_hours, 2)::float8, ROUND(balance, 2)::float8
+            FROM {source}{where}
+            ORDER BY date, zone_name, resource_subtype;
+        ''', params, REPORT_MERGE_KEYS['balance'], warehouse_id),
+        fetch_totals(f'''
+            SELECT COALESCE(SUM(required_hours), 0)::float8, COALESCE(SUM(available_hours), 0)::float8,
+                   COALESCE(SUM(balance) FILTER (WHERE balance < 0), 0)::float8,
+                   COUNT(*) FILTER (WHERE balance < 0)
+            FROM {source}{where};
+        ''', params, warehouse_id),
+    )
+    required, available, deficit, deficit_cells = totals
+    return {
+        'columns': ['date', 'zone', 'resource_subtype', 'required_hours', 'available_hours', 'balance'],
+        'rows': [list(row) for row in rows],
+        'totals': {
+            'required_hours': round(required, 2),
+            'available_hours': round(available, 2),
+            'balance': round(available - required, 2),
+            'deficit_hours': round(-deficit, 2),
+            'deficit_cells': deficit_cells,
+        },
+    }
+
+
+async def requirements(args):
+    """Потребность в ресурсах (как /requirements) и итоги по типам ресурсов"""
+    warehouse_id = _int_arg(args, 'warehouse_id')
+    conditions, params = _period_conditions(args, 'r.date')
+    if warehouse_id:
+        conditions.append('z.warehouse_id = %s')
+        params.append(warehouse_id)
+    source = 'v_resource_requirements r JOIN zones z ON r.zone_id = z.zone_id' + _where(conditions)
+    rows, by_type = await asyncio.gather(
+        fetch_sharded(f'''
+            SELECT r.date, r.doc_number, z.name, r.resource_type, ROUND(r.required_units, 2)::float8
+            FROM {source}
+            ORDER BY r.date, r.doc_number, z.name;
+        ''', params, operator.itemgetter(0, 1, 2), warehouse_id),
+        fetch_sharded(f'''
+            SELECT r.resource_type, SUM(r.required_units)::float8
+            FROM {source}
+            GROUP BY r.resource_type ORDER BY r.resource_type;
+        ''', params, operator.itemgetter(0), warehouse_id),
+    )
+    totals = {}
+    for resource_type, units in by_type:
+        totals[resource_type] = round(totals.get(resource_type, 0) + units, 2)
+    return {
+        'columns': ['date', 'doc_number', 'zone', 'resource_type', 'required_units'],
+        'rows': [list(row) for row in rows],
+        'totals': totals,
+    }
+
+
+async def recommendations(args):
+    """Рекомендации по ненулевому балансу (как /recommendations)"""
+    conditions, params = _period_conditions(args, 'date')
+    # Справочник подтипов обычно уже в памяти; если нет, читается в потоке, не останавливая цикл
+    rows, subtypes = await asyncio.gather(fetch_sharded(f'''
+        SELECT date - DATE '1970-01-01', zone_name, resource_subtype,
+               required_hours::float8, available_hours::float8, balance::float8
+        FROM v_capacity_balance{_where(['balance != 0'] + conditions)}
+        ORDER BY date, zone_name, resource_subtype;
+    ''', params, REPORT_MERGE_KEYS['balance']), asyncio.to_thread(subtype_catalog.get))
+    columns = BalanceColumns()
+    columns.extend(rows)
+    return {'recommendations': generate_recommendations_from_balance(columns, subtypes)}
+
+
+async def report(args, report_type):
+    """Строки отчёта за период — те же запросы, что у колоночной выгрузки"""
+    if report_type not in ANALYTICS_REPORTS:
+        raise BadRequest(f'Неизвестный отчёт: {report_type}')
+    params = (_date_arg(args, 'start_date', required=True), _date_arg(args, 'end_date', required=True))
+    if report_type == 'balance':
+        sql = '''
+            SELECT date, zone_name, resource_subtype,
+                   ROUND(required_hours, 2)::float8, ROUND(available_hours, 2)::float8, ROUND(balance, 2)::float8
+            FROM v_capacity_balance
+            WHERE date BETWEEN %s AND %s
+            ORDER BY date, zone_name, resource_subtype;
+        '''
+    else:
+        sql = REPORT_EXPORT_QUERIES[report_type]
+    rows = await fetch_sharded(sql, params, REPORT_MERGE_KEYS[report_type])
+    return {
+        'columns': [name for name, _ in REPORT_EXPORT_COLUMNS[report_type]],
+        'rows': [list(row) for row in rows],
+    }
+
+
+ROUTES = {
+    '/api/analytics/balance': balance,
+    '/api/analytics/requirements': requirements,
+    '/api/analytics/recommendations': recommendations,
+}
+
+REPORT_PREFIX = '/api/analytics/reports/'
+
+EVENTS_PATH = '/api/analytics/events/capacity'
+
+
+# === Поток изменений баланса (SSE) ===
+async def _fetch_events(conn, after, limit=SSE_BATCH_SIZE):
+    """События журнала после after: [((tx_id, event_id), JSON-строка)], как _fetch_capacity_events"""
+    rows = await conn.fetch(_numbered(CAPACITY_EVENTS_AFTER_SQL), *after, limit)
+    events = []
+    for row in rows:
+        row = list(row)
+        # jsonb asyncpg отдаёт строкой
+        if row[-1] is not None:
+            row[-1] = json.loads(row[-1])
+        events.append(((row[0], row[1]), json.dumps(_capacity_event_json(row[1:]), ensure_ascii=False)))
+    return events
+
+
+class CapacityEvents:
+    """Раздатчик событий журнала шарда всем SSE-клиентам процесса (как CapacityEventBroadcaster
+    в app.py): одно LISTEN-соединение asyncpg, очереди клиентов в памяти, кольцевой буфер
+    недавних событий для переподключений по Last-Event-ID."""
+
+    def __init__(self, shard):
+        self.shard = shard
+        self._subscribers = set()
+        self._history = collections.deque(maxlen=SSE_HISTORY_SIZE)
+        self._position = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def subscribe(self, position=None):
+        """Очередь клиента и пропущенные после position события"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        subscription = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self._subscribers.add(subscription)
+        if position is None:
+            return subscription, []
+        backlog = [event for event in self._history if event[0] > position]
+        if ((self._history and self._history[0][0] <= position)
+                or (self._position is not None and position >= self._position)):
+            return subscription, backlog
+        # Клиент отстал сильнее буфера — дочитываем журнал из основной базы один раз
+        try:
+            pool = await get_pool(self.shard)
+            async with pool.acquire() as conn:
+                return subscription, await _fetch_events(conn, position, SSE_HISTORY_SIZE)
+        except BaseException:
+            self._subscribers.discard(subscription)
+            raise
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    async def _publish_new(self, conn):
+        while True:
+            events = await _fetch_events(conn, self._position)
+            for event in events:
+                self._history.append(event)
+                for subscription in list(self._subscribers):
+                    try:
+                        subscription.put_nowait(event)
+                    except asyncio.QueueFull:
+                        # Медленный клиент отключается (None вместо очереди) и догонит по Last-Event-ID
+                        self._subscribers.discard(subscription)
+                        while not subscription.empty():
+                            subscription.get_nowait()
+                        subscription.put_nowait(None)
+            if events:
+                self._position = events[-1][0]
+            if len(events) < SSE_BATCH_SIZE:
+                return
+
+    async def _run(self):
+        while self._subscribers:
+            conn = None
+            try:
+                conn = await asyncpg.connect(**_connect_settings(self.shard, False))
+                await conn.add_listener(CAPACITY_EVENTS_CHANNEL, lambda *args: self._wake.set())
+                if self._position is None:
+                    row = await conn.fetchrow(CAPACITY_EVENTS_POSITION_SQL)
+                    self._position = (row[0], row[1]) if row else (0, 0)
+                while self._subscribers:
+                    self._wake.clear()
+                    # После переподключения дочитываем пропущенное; по таймауту — события,
+                    # ждавшие завершения более старых транзакций
+                    await self._publish_new(conn)
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), SSE_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning('Слушатель событий баланса (шард %s): %s; переподключение', self.shard, e)
+                await asyncio.sleep(SSE_RECONNECT_SECONDS)
+            except Exception:
+                logger.exception('Слушатель событий баланса (шард %s) упал; перезапуск', self.shard)
+                await asyncio.sleep(SSE_RECONNECT_SECONDS)
+            finally:
+                if conn is not None:
+                    await conn.close()
+
+
+_capacity_events = {}
+
+
+async def _stream_events(scope, receive, send, args):
+    """Поток SSE: новые события шарда склада (?warehouse_id=), пропущенные — по Last-Event-ID"""
+    headers = dict(scope.get('headers') or [])
+    position = parse_event_position(headers.get(b'last-event-id', b'').decode() or args.get('after'))
+    try:
+        shard = shard_for(_int_arg(args, 'warehouse_id'))
+    except BadRequest as e:
+        return await _respond(send, 400, {'error': str(e)})
+    events = _capacity_events.get(shard)
+    if events is None:
+        events = _capacity_events[shard] = CapacityEvents(shard)
+    try:
+        subscription, backlog = await events.subscribe(position)
+    except (OSError, asyncpg.PostgresError) as e:
+        logger.warning('Журнал событий шарда %s недоступен: %s', shard, e)
+        return await _respond(send, 503, {'error': 'Журнал событий недоступен'})
+    disconnect = asyncio.ensure_future(_disconnected(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        last_sent = position or (0, 0)
+        while not disconnect.done():
+            if backlog:
+                event = backlog.pop(0)
+            else:
+                getter = asyncio.ensure_future(subscription.get())
+                await asyncio.wait((getter, disconnect), timeout=SSE_HEARTBEAT_SECONDS,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    if not disconnect.done():
+                        # Пульс, чтобы прокси не рвали простаивающее соединение
+                        await send({'type': 'http.response.body', 'body': b': heartbeat\n\n', 'more_body': True})
+                    continue
+                event = getter.result()
+                if event is None:
+                    # Очередь переполнилась — клиент переподключится и догонит по Last-Event-ID
+                    break
+            event_position, data = event
+            # Догрузка из БД и очередь могут пересекаться
+            if event_position <= last_sent:
+                continue
+            last_sent = event_position
+            message = f'id: {format_event_position(event_position)}\nevent: capacity\ndata: {data}\n\n'
+            await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+        if not disconnect.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.cancel()
+        events.unsubscribe(subscription)
+
+
+# === ASGI ===
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} не сериализуется в JSON')
+
+
+async def _respond(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False, default=_json_default).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json; charset=utf-8'),
+                    (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _disconnected(receive):
+    """Завершается, когда клиент закрыл соединение"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+_slots = None
+
+
+async def _call(handler, args):
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(ANALYTICS_CONCURRENCY)
+    try:
+        await asyncio.wait_for(_slots.acquire(), ANALYTICS_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return 503, {'error': 'Сервер занят аналитикой — повторите запрос через минуту'}
+    try:
+        return 200, await handler(args)
+    except BadRequest as e:
+        return 400, {'error': str(e)}
+    except Exception as e:
+        # Любая ошибка — ответ 500: иначе задача падает, а клиент остаётся без ответа
+        logger.exception('Ошибка аналитики')
+        return 500, {'error': f'Ошибка при загрузке аналитики: {e}'}
+    finally:
+        _slots.release()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_pools()
+            metrics.flush(force=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    path = scope['path']
+    if path == EVENTS_PATH:
+        args = {name: values[-1] for name, values in parse_qs(scope['query_string'].decode()).items()}
+        return await _stream_events(scope, receive, send, args)
+    if path.startswith(REPORT_PREFIX):
+        endpoint = 'reports'
+        handler = lambda args: report(args, path[len(REPORT_PREFIX):])  # noqa: E731
+    else:
+        endpoint = path.rsplit('/', 1)[-1]
+        handler = ROUTES.get(path)
+    if handler is None:
+        return await _respond(send, 404, {'error': f'Нет такого адреса: {path}'})
+    if scope['method'] != 'GET':
+        return await _respond(send, 405, {'error': 'Только GET'})
+    args = {name: values[-1] for name, values in parse_qs(scope['query_string'].decode()).items()}
+
+    started = time.perf_counter()
+    work = asyncio.ensure_future(_call(handler, args))
+    disconnect = asyncio.ensure_future(_disconnected(receive))
+    await asyncio.wait((work, disconnect), return_when=asyncio.FIRST_COMPLETED)
+    if not work.done():
+        # Клиент ушёл: отмена задачи отменяет и выполняющиеся запросы asyncpg на сервере БД
+        work.cancel()
+        await asyncio.gather(work, return_exceptions=True)
+        metrics.inc('analytics_async_cancelled_total', endpoint=endpoint)
+        metrics.flush()
+        return
+    disconnect.cancel()
+    status, payload = work.result()
+    if status == 503:
+        metrics.inc('analytics_async_rejected_total', endpoint=endpoint)
+    await _respond(send, status, payload)
+    metrics.inc('analytics_async_requests_total', endpoint=endpoint, status=status)
+    metrics.inc('analytics_async_seconds_total', time.perf_counter() - started, endpoint=endpoint)
+    metrics.flush()
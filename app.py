@@ -1,147 +1,1321 @@
 # app.py
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, make_response
+from flask import (Flask, render_template, request, redirect, url_for, flash, make_response, send_file, jsonify,
+                   Response, stream_with_context, g, has_app_context, has_request_context, session, current_app,
+                   before_render_template, template_rendered, copy_current_request_context)
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values, Json
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+from array import array
+import collections
 import csv
-from io import StringIO
+import functools
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import logging
+import operator
+import queue
+import select
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zipfile
+import click
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import StringIO, TextIOWrapper
+from urllib.parse import urlencode
 
 # Загружаем переменные окружения из .env
 load_dotenv()
 
-# Создаём Flask-приложение
-app = Flask(__name__)
-app.secret_key = 'warehouse_capacity_secret_key_2025'  # Обязателен для flash-сообщений
-
-# Функция подключения к БД
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv('DB_HOST', 'localhost'),
-        database=os.getenv('DB_NAME', 'warehouse_capacity'),
-        user=os.getenv('DB_USER', 'postgres'),
-        password=os.getenv('DB_PASSWORD')
-    )
+logger = logging.getLogger(__name__)
+
+# Маршруты и команды копятся здесь и подключаются к приложению в create_app()
+_routes = []
+_cli_commands = []
+
+
+def route(rule, **options):
+    """Аналог @app.route для фабрики приложений: имя endpoint — имя функции"""
+    def decorator(view_func):
+        _routes.append((rule, view_func, options))
+        return view_func
+    return decorator
+
+
+def cli_command(command):
+    _cli_commands.append(command)
+    return command
+
+
+# === Метрики (текстовый формат Prometheus, /metrics) ===
+# Каталог, через который воркеры gunicorn складывают метрики в общий /metrics
+METRICS_DIR = os.getenv('METRICS_DIR')
+
+# Не чаще, чем раз в столько секунд, процесс сбрасывает свои метрики в METRICS_DIR
+METRICS_FLUSH_SECONDS = 1.0
+
+
+class Metrics:
+    """Счётчики и измерители процесса.
+
+    Метрика описывается один раз (describe), значения хранятся по наборам меток.
+    С METRICS_DIR каждый процесс пишет свой снимок в файл, а /metrics суммирует
+    счётчики и берёт максимум измерителей по всем процессам."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds = {}
+        self._help = {}
+        self._values = {}
+        self._flushed_at = 0.0
+
+    def describe(self, name, kind, help_text):
+        self._kinds[name] = kind
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def _snapshot(self):
+        with self._lock:
+            return [[name, dict(labels), value] for (name, labels), value in self._values.items()]
+
+    def flush(self, force=False):
+        if not METRICS_DIR:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < METRICS_FLUSH_SECONDS:
+            return
+        self._flushed_at = now
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._snapshot(), f)
+        os.replace(tmp_path, os.path.join(METRICS_DIR, f'{os.getpid()}.json'))
+
+    def _collect(self):
+        if not METRICS_DIR:
+            return self._snapshot()
+        self.flush(force=True)
+        samples = []
+        for file_name in os.listdir(METRICS_DIR):
+            if file_name.endswith('.json'):
+                try:
+                    with open(os.path.join(METRICS_DIR, file_name)) as f:
+                        samples.extend(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return samples
+
+    def render(self):
+        totals = {}
+        for name, labels, value in self._collect():
+            key = (name, tuple(sorted(labels.items())))
+            if self._kinds.get(name) == 'gauge':
+                totals[key] = max(totals.get(key, value), value)
+            else:
+                totals[key] = totals.get(key, 0) + value
+        lines = []
+        for name in sorted({name for name, _ in totals}):
+            lines.append(f'# HELP {name} {self._help.get(name, name)}')
+            lines.append(f'# TYPE {name} {self._kinds.get(name, "untyped")}')
+            for (metric, labels), value in sorted(totals.items()):
+                if metric != name:
+                    continue
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def flush_metrics(response):
+    metrics.flush()
+    return response
+
+
+# === Подключение к БД ===
+# Пул соединений процесса: размер и ожидание свободного соединения (сек.)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+
+# Шард по умолчанию — база из DB_HOST/DB_NAME: справочники и склады без своего шарда
+DEFAULT_SHARD = 'default'
+
+# Строк за один FETCH при чтении со всех шардов
+SHARD_FETCH_SIZE = 10000
+
+# Реплики для аналитики: при отставании больше DB_REPLICA_MAX_LAG сек. читаем с основной базы;
+# позицию реплики проверяем не чаще, чем раз в DB_REPLICA_CHECK_SECONDS
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_CHECK_SECONDS = float(os.getenv('DB_REPLICA_CHECK_SECONDS', 1))
+
+# statement_timeout соединения по классу маршрута, сек. (0 — без ограничения):
+# быстрые страницы и формы, тяжёлые отчёты на странице, выгрузки файлом.
+# Выгрузка тоже держит поток воркера, поэтому и у неё предел конечный
+STATEMENT_TIMEOUTS = {
+    'interactive': float(os.getenv('DB_STATEMENT_TIMEOUT_INTERACTIVE', 30)),
+    'heavy': float(os.getenv('DB_STATEMENT_TIMEOUT_HEAVY', 120)),
+    'export': float(os.getenv('DB_STATEMENT_TIMEOUT_EXPORT', 600)),
+}
+
+metrics.describe('db_read_route_total', 'counter', 'Выбор базы для аналитических чтений: target, reason, shard')
+metrics.describe('db_replica_lag_seconds', 'gauge', 'Отставание реплики по последней проверке')
+
+
+def _load_shards():
+    """Карта шардов из DB_SHARDS — JSON-строка или путь к JSON-файлу:
+    {"north": {"database": "wh_north", "warehouses": [1, 2], "replica": {"host": "…"}}, …}.
+    Параметры шарда дополняют DB_*, параметры реплики — параметры шарда.
+    Реплика шарда по умолчанию задаётся и через DB_REPLICA_HOST.
+    Возвращает (шард -> параметры, шард -> параметры реплики, склад -> шард)."""
+    shards, replicas, warehouse_shards = {}, {}, {}
+    if os.getenv('DB_REPLICA_HOST'):
+        replicas[DEFAULT_SHARD] = {'host': os.getenv('DB_REPLICA_HOST')}
+    raw = os.getenv('DB_SHARDS')
+    if not raw:
+        return shards, replicas, warehouse_shards
+    if os.path.isfile(raw):
+        with open(raw, encoding='utf-8') as f:
+            raw = f.read()
+    for name, settings in json.loads(raw).items():
+        settings = dict(settings)
+        for warehouse_id in settings.pop('warehouses', []):
+            warehouse_shards[int(warehouse_id)] = name
+        if 'replica' in settings:
+            replicas[name] = settings.pop('replica')
+        shards[name] = settings
+    return shards, replicas, warehouse_shards
+
+
+DB_SHARDS, DB_REPLICAS, WAREHOUSE_SHARDS = _load_shards()
+
+
+def shard_names():
+    return [DEFAULT_SHARD] + [name for name in DB_SHARDS if name != DEFAULT_SHARD]
+
+
+def shard_for(warehouse_id):
+    """Шард, где лежат зоны, ресурсы и документы склада"""
+    if not warehouse_id:
+        return DEFAULT_SHARD
+    return WAREHOUSE_SHARDS.get(int(warehouse_id), DEFAULT_SHARD)
+
+
+def _db_settings(shard=DEFAULT_SHARD, replica=False):
+    settings = {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'database': os.getenv('DB_NAME', 'warehouse_capacity'),
+        'user': os.getenv('DB_USER', 'postgres'),
+        'password': os.getenv('DB_PASSWORD'),
+        'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 10)),
+    }
+    settings.update(DB_SHARDS.get(shard, {}))
+    if replica:
+        settings.update(DB_REPLICAS[shard])
+    return settings
+
+
+def connect_db(shard=DEFAULT_SHARD):
+    """Отдельное соединение вне пула — для долгоживущих слушателей LISTEN"""
+    return psycopg2.connect(**_db_settings(shard))
+
+
+class PooledConnection:
+    """Соединение из пула: close() возвращает его в пул, остальное — как у psycopg2.
+
+    commit() запоминает в g шарды, где транзакция действительно что-то записала:
+    по ним remember_write_position берёт позицию WAL для read-your-writes."""
+    __slots__ = ('_conn', '_pool')
+
+    def __init__(self, conn, pool):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_pool', pool)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def commit(self):
+        pool = self._pool
+        wrote = False
+        if not pool.replica and pool.shard in DB_REPLICAS and has_app_context():
+            # Номер транзакции выдаётся только при первой записи — чтение его не получает
+            cur = self._conn.cursor()
+            cur.execute('SELECT pg_current_xact_id_if_assigned() IS NOT NULL;')
+            wrote = cur.fetchone()[0]
+            cur.close()
+        self._conn.commit()
+        if wrote:
+            g.setdefault('written_shards', set()).add(pool.shard)
+
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, '_conn', None)
+        self._pool.release(conn)
+
+
+class ConnectionPool:
+    """Потокобезопасный пул: при исчерпании ждёт свободное соединение до timeout"""
+
+    def __init__(self, minconn, maxconn, timeout, shard=DEFAULT_SHARD, replica=False):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **_db_settings(shard, replica))
+        self.shard = shard
+        self.replica = replica
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+        # statement_timeout, выставленный в сессии соединения (мс); нет записи — значение сервера
+        self._statement_timeouts = weakref.WeakKeyDictionary()
+
+    def acquire(self, statement_timeout=None):
+        """Соединение с заданным statement_timeout (мс, None — значение сервера)"""
+        if not self._slots.acquire(timeout=self._timeout):
+            raise psycopg2.pool.PoolError('нет свободных соединений с БД')
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            self._set_statement_timeout(conn, statement_timeout)
+        except psycopg2.Error:
+            self._pool.putconn(conn, close=True)
+            self._slots.release()
+            raise
+        return PooledConnection(conn, self)
+
+    def _set_statement_timeout(self, conn, statement_timeout):
+        # SET уровня сессии переживает возврат в пул: повторно выставляем, только если класс сменился
+        if self._statement_timeouts.get(conn) == statement_timeout:
+            return
+        cur = conn.cursor()
+        if statement_timeout is None:
+            cur.execute('RESET statement_timeout;')
+        else:
+            cur.execute('SET statement_timeout = %s;', (statement_timeout,))
+        cur.close()
+        conn.commit()
+        if statement_timeout is None:
+            self._statement_timeouts.pop(conn, None)
+        else:
+            self._statement_timeouts[conn] = statement_timeout
+
+    def release(self, conn):
+        try:
+            broken = bool(conn.closed)
+            if not broken:
+                try:
+                    # Незавершённая транзакция не должна достаться следующему запросу
+                    conn.rollback()
+                    conn.autocommit = False
+                except psycopg2.Error:
+                    broken = True
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+
+# Пулы текущего процесса: (шард, реплика?) -> пул
+_pools = {}
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Пулы, унаследованные от родителя при fork. Ссылки держим, чтобы сборщик мусора
+# не закрыл их соединения: закрытие из дочернего процесса оборвало бы сессии родителя
+_inherited_pools = []
+
+
+def get_pool(shard=DEFAULT_SHARD, replica=False):
+    """Пул шарда (или его реплики) в текущем процессе; после fork воркер создаёт свои"""
+    global _pools, _pool_pid
+    pid = os.getpid()
+    key = (shard, replica)
+    pool = _pools.get(key) if _pool_pid == pid else None
+    if pool is None:
+        with _pool_lock:
+            if _pool_pid != pid:
+                if _pools:
+                    _inherited_pools.append(_pools)
+                _pools = {}
+                _pool_pid = pid
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, shard, replica)
+    return pool
+
+
+def reset_pool():
+    """Забывает пулы процесса (хук post_fork сервера): следующий запрос создаст новые"""
+    global _pools, _pool_pid
+    with _pool_lock:
+        if _pools and _pool_pid != os.getpid():
+            _inherited_pools.append(_pools)
+        _pools = {}
+        _pool_pid = None
+
+
+def _lsn(text):
+    """Позиция WAL 'X/Y' как число для сравнения"""
+    high, _, low = text.partition('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+# Последняя проверка реплик процесса: шард -> (когда, воспроизведённая позиция WAL, отставание)
+_replica_state = {}
+
+
+def _replica_position(shard, force=False):
+    state = _replica_state.get(shard)
+    if state is None or force or time.monotonic() - state[0] >= DB_REPLICA_CHECK_SECONDS:
+        conn = get_pool(shard, replica=True).acquire()
+        try:
+            cur = conn.cursor()
+            # Если всё полученное уже воспроизведено, реплика не отстаёт, даже когда основная простаивает
+            cur.execute('''
+                SELECT pg_last_wal_replay_lsn()::text,
+                       CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                       END::float8;
+            ''')
+            replay_lsn, lag = cur.fetchone()
+            cur.close()
+        finally:
+            conn.close()
+        state = _replica_state[shard] = (time.monotonic(), _lsn(replay_lsn) if replay_lsn else 0, lag)
+        metrics.set('db_replica_lag_seconds', lag, shard=shard)
+    return state
+
+
+def _read_route(shard):
+    """Можно ли читать с реплики шарда: (да/нет, причина)"""
+    if shard not in DB_REPLICAS:
+        return False, 'no_replica'
+    try:
+        _, replay_lsn, lag = _replica_position(shard)
+        if lag > DB_REPLICA_MAX_LAG:
+            return False, 'lag'
+        # Read-your-writes: пользователь должен увидеть то, что только что сохранил
+        write_lsn = session.get('write_lsns', {}).get(shard) if has_request_context() else None
+        if write_lsn and _lsn(write_lsn) > replay_lsn:
+            if _lsn(write_lsn) > _replica_position(shard, force=True)[1]:
+                return False, 'read_your_writes'
+    except psycopg2.Error as e:
+        logger.warning('Реплика шарда %s недоступна: %s', shard, e)
+        return False, 'replica_error'
+    return True, 'replica'
+
+
+def _statement_timeout():
+    """statement_timeout (мс) для класса текущего маршрута; вне запроса — значение сервера"""
+    if not has_request_context():
+        return None
+    # Класс хранится в environ запроса: его видят и потоки с копией контекста (пакет отчётов)
+    return int(STATEMENT_TIMEOUTS[request.environ.get(ROUTE_CLASS_ENVIRON, 'interactive')] * 1000)
+
+
+# Функция подключения к БД: warehouse_id выбирает шард склада,
+# readonly=True — аналитическое чтение, которое может уйти на реплику
+def get_db_connection(warehouse_id=None, shard=None, readonly=False):
+    shard = shard or shard_for(warehouse_id)
+    statement_timeout = _statement_timeout()
+    conn = None
+    if readonly:
+        use_replica, reason = _read_route(shard)
+        if use_replica:
+            try:
+                conn = get_pool(shard, replica=True).acquire(statement_timeout)
+                # Страница с данными реплики не кешируется под версиями основной (cached_page)
+                if has_app_context():
+                    g.replica_read = True
+            except psycopg2.Error as e:
+                logger.warning('Реплика шарда %s недоступна: %s', shard, e)
+                reason = 'replica_error'
+        metrics.inc('db_read_route_total', target='replica' if conn else 'primary', reason=reason, shard=shard)
+    if conn is None:
+        conn = get_pool(shard).acquire(statement_timeout)
+    # Соединения, не закрытые маршрутом (ранний redirect), вернёт teardown
+    if has_app_context():
+        g.setdefault('db_connections', []).append(conn)
     return conn
 
-# === Главная страница ===
-@app.route('/')
-def index():
+
+def release_db_connections(exc=None):
+    for conn in g.pop('db_connections', []):
+        conn.close()
+
+
+def remember_write_position(response):
+    """После записи запоминает позиции WAL изменённых шардов в сессии пользователя:
+    пока реплика шарда её не воспроизведёт, его аналитика по шарду читается с основной.
+
+    Шарды с записью отмечает PooledConnection.commit — запросы без записи сессию не трогают."""
+    written = g.pop('written_shards', None)
+    if not written:
+        return response
+    write_lsns = dict(session.get('write_lsns', {}))
+    for shard in sorted(written):
+        try:
+            conn = get_db_connection(shard=shard)
+            cur = conn.cursor()
+            cur.execute('SELECT pg_current_wal_lsn()::text;')
+            write_lsns[shard] = cur.fetchone()[0]
+            cur.close()
+            conn.close()
+        except psycopg2.Error as e:
+            logger.warning('Позиция WAL шарда %s не получена: %s', shard, e)
+    session['write_lsns'] = write_lsns
+    return response
+
+
+def iter_shards(sql, params, key, warehouse_id=None, readonly=True):
+    """Строки запроса со всех шардов (с warehouse_id — с шарда склада), слитые в порядке key.
+
+    sql должен быть упорядочен по тем же колонкам, что сравнивает key. Запрос
+    выполняется на шардах (их репликах, если можно и readonly) параллельно, дальше строки
+    читаются серверными курсорами пачками и сливаются без сортировки всего результата в памяти."""
+    shards = [shard_for(warehouse_id)] if warehouse_id else shard_names()
+    conns = [get_db_connection(shard=shard, readonly=readonly) for shard in shards]
     try:
-        conn = get_db_connection()
+        cursors = []
+        for conn in conns:
+            cur = conn.cursor(name='shard_rows')
+            cur.itersize = SHARD_FETCH_SIZE
+            cursors.append(cur)
+
+        def first_batch(cur):
+            cur.execute(sql, params)
+            return cur.fetchmany(SHARD_FETCH_SIZE)
+
+        if len(cursors) == 1:
+            first_batches = [first_batch(cursors[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(cursors)) as executor:
+                first_batches = list(executor.map(first_batch, cursors))
+
+        def rows(cur, batch):
+            while batch:
+                yield from batch
+                batch = cur.fetchmany(SHARD_FETCH_SIZE)
+
+        yield from heapq.merge(*(rows(cur, batch) for cur, batch in zip(cursors, first_batches)), key=key)
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def fetch_sharded(sql, params, key, warehouse_id=None, readonly=True):
+    """Все строки запроса: с warehouse_id — только с шарда склада, иначе со всех шардов"""
+    return list(iter_shards(sql, params, key, warehouse_id, readonly))
+
+
+def locate_shards(table, key, row_ids):
+    """Шарды строк table по ключам: {ключ: шард}; строк, которых нет ни на одном шарде, в ответе нет.
+
+    Зоны, ресурсы, мощности и документы пишутся на шард своего склада, а ключи
+    новых строк на шардах не пересекаются (flask shards keys) — строку ищем по всем шардам."""
+    row_ids = list(row_ids)
+    shards = shard_names()
+    if len(shards) == 1:
+        return dict.fromkeys(row_ids, DEFAULT_SHARD)
+    found = {}
+    for shard in shards:
+        conn = get_db_connection(shard=shard)
         cur = conn.cursor()
-        cur.execute('SELECT name FROM clients LIMIT 5;')
-        clients = cur.fetchall()
+        cur.execute(f'SELECT {key} FROM {table} WHERE {key} = ANY(%s);', (row_ids,))
+        for (row_id,) in cur.fetchall():
+            found.setdefault(row_id, shard)
         cur.close()
         conn.close()
-        return render_template('index.html', clients=clients)
-    except Exception as e:
-        return f"<h1>❌ Ошибка подключения</h1><p>{str(e)}</p>"
+    return found
 
-# === CRUD: Справочник клиентов ===
-@app.route('/clients')
-def client_list():
-    """Просмотр списка клиентов"""
+
+def locate_shard(table, key, row_id):
+    """Шард строки table с ключом row_id; нет такой строки — шард по умолчанию
+    (там маршрут её и не найдёт)"""
+    try:
+        row_id = int(row_id)
+    except (TypeError, ValueError):
+        return DEFAULT_SHARD
+    return locate_shards(table, key, [row_id]).get(row_id, DEFAULT_SHARD)
+
+
+# Справочники одинаковы на всех шардах: пишутся на основной и тем же запросом копируются
+# на остальные (replicate_reference), целиком — flask shards sync-reference.
+# Таблица -> (ключ, [(родительская таблица, колонка-ссылка)]); порядок — по внешним ключам.
+# Строки родителей копируются вместе со строкой: подтип норматива заводится триггером sql/013
+REFERENCE_TABLES = {
+    'warehouses': ('warehouse_id', []),
+    'clients': ('client_id', []),
+    'products': ('sku_id', [('clients', 'client_id')]),
+    'resource_subtypes': ('subtype_id', []),
+    'norms': ('norm_id', [('resource_subtypes', 'subtype_id')]),
+}
+
+
+def _copy_reference(cur, targets, table, ids=None, upsert=True, delete=True):
+    """Переносит строки справочника из транзакции основного шарда (cur) на targets.
+
+    С ids — только эти строки, без ids — весь справочник. Строки, которых на основном
+    шарде нет, на targets удаляются."""
+    key, parents = REFERENCE_TABLES[table]
+    if ids is None:
+        cur.execute(f'SELECT * FROM {table};')
+    else:
+        ids = list(ids)
+        cur.execute(f'SELECT * FROM {table} WHERE {key} = ANY(%s);', (ids,))
+    columns = [column.name for column in cur.description]
+    rows = cur.fetchall()
+    present = [row[columns.index(key)] for row in rows]
+    if upsert and ids is not None:
+        for parent, column in parents:
+            parent_ids = {row[columns.index(column)] for row in rows} - {None}
+            if parent_ids:
+                _copy_reference(cur, targets, parent, parent_ids, delete=False)
+    sql = f'''
+        INSERT INTO {table} ({', '.join(columns)}) VALUES %s
+        ON CONFLICT ({key}) DO UPDATE SET {', '.join(f'{c} = EXCLUDED.{c}' for c in columns if c != key)};
+    '''
+    for target in targets:
+        target_cur = target.cursor()
+        if delete and ids is None:
+            target_cur.execute(f'DELETE FROM {table} WHERE {key} <> ALL(%s);', (present,))
+        elif delete:
+            target_cur.execute(f'DELETE FROM {table} WHERE {key} = ANY(%s) AND {key} <> ALL(%s);', (ids, present))
+        if upsert and rows:
+            execute_values(target_cur, sql, rows, page_size=BULK_PAGE_SIZE)
+        target_cur.close()
+
+
+def replicate_reference(cur, table, ids):
+    """Копирует изменённые строки справочника с основного шарда на остальные.
+
+    Вызывается курсором транзакции основного шарда перед её commit: строки читаются
+    вместе с правкой, удалённые на основном удаляются и на остальных. Шарды коммитятся
+    раньше основного, поэтому ошибка на любом из них (например, на удаляемый склад
+    ссылаются его зоны) отменяет всю правку. Расхождение после сбоя между commit
+    выравнивает flask shards sync-reference."""
+    shards = [shard for shard in shard_names() if shard != DEFAULT_SHARD]
+    if not shards:
+        return
+    targets = [get_db_connection(shard=shard) for shard in shards]
+    try:
+        _copy_reference(cur, targets, table, ids)
+        for target in targets:
+            target.commit()
+    finally:
+        for target in targets:
+            target.close()
+
+
+def warehouse_choices():
+    """Склады для фильтров страниц: (warehouse_id, name) из шарда по умолчанию"""
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT client_id, name, contact_person FROM clients ORDER BY name;')
-    clients = cur.fetchall()
+    cur.execute('SELECT warehouse_id, name FROM warehouses ORDER BY name;')
+    warehouses = cur.fetchall()
     cur.close()
     conn.close()
-    return render_template('clients/list.html', clients=clients)
+    return warehouses
 
-@app.route('/clients/create', methods=('GET', 'POST'))
-def client_create():
-    """Добавление нового клиента"""
-    if request.method == 'POST':
-        name = request.form.get('name', '').strip()
-        contact = request.form.get('contact_person', '').strip()
-        if not name:
-            flash('Название клиента обязательно для заполнения!', 'error')
-        else:
+
+def zone_choices():
+    """Зоны всех шардов для выпадающих списков: (zone_id, name)"""
+    return fetch_sharded(
+        'SELECT zone_id, name FROM zones ORDER BY name;', (), operator.itemgetter(1), readonly=False
+    )
+
+
+def resource_choices():
+    """Ресурсы всех шардов для выпадающих списков: (resource_id, name, subtype)"""
+    return fetch_sharded(
+        'SELECT resource_id, name, subtype FROM resources ORDER BY name;', (), operator.itemgetter(1),
+        readonly=False
+    )
+
+
+# === Помесячные секции таблиц с датой (sql/005_month_partitions.sql) ===
+# Таблица -> колонка даты, по которой она секционирована
+PARTITIONED_TABLES = {
+    'inbound_documents': 'doc_date',
+    'available_capacities': 'date',
+    'outbound_plan': 'date',
+}
+
+
+def require_partition(cur, table, date):
+    """Проверяет перед вставкой, что секция месяца под дату есть.
+
+    Веб-запросы секций не создают (DDL блокирует родительскую таблицу) — их заранее
+    создаёт `flask partitions create` по расписанию. Проверка идёт в БД каждый раз:
+    секцию мог унести в архив `flask partitions archive` из другого процесса."""
+    month = datetime.strptime(str(date), '%Y-%m-%d').strftime('%Y%m')
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL;', (f'{table}_p{month}',))
+    if not cur.fetchone()[0]:
+        raise ValueError(
+            f'нет секции {table} за {month[:4]}-{month[4:]}: месяц в архиве или ещё не создан '
+            f'(flask partitions create --months-ahead N)'
+        )
+
+
+# === Ключи идемпотентности (sql/010_idempotency_locks.sql) ===
+def new_idempotency_key():
+    """Ключ для скрытого поля формы создания: повторная отправка формы не создаст дубль"""
+    return uuid.uuid4().hex
+
+
+def claim_idempotency_key(cur, key, endpoint):
+    """Занимает ключ в текущей транзакции.
+
+    None — ключ новый, запрос выполняется. Иначе — кортеж (endpoint, result_id,
+    status, response) первого запроса. Дубль, пришедший, пока первый запрос ещё
+    не завершён, ждёт на блокировке первичного ключа; если первый откатился —
+    ключ достаётся дублю."""
+    cur.execute('''
+        INSERT INTO idempotency_keys (key, endpoint) VALUES (%s, %s)
+        ON CONFLICT (key) DO NOTHING RETURNING key;
+    ''', (key, endpoint))
+    if cur.fetchone():
+        return None
+    cur.execute(
+        'SELECT endpoint, result_id, status, response FROM idempotency_keys WHERE key = %s;',
+        (key,)
+    )
+    return cur.fetchone()
+
+
+def store_idempotent_result(cur, key, result_id=None, status=None, response=None):
+    """Сохраняет результат запроса под ключом (в той же транзакции, что и запись)"""
+    cur.execute('''
+        UPDATE idempotency_keys SET result_id = %s, status = %s, response = %s
+        WHERE key = %s;
+    ''', (result_id, status, Json(response) if response is not None else None, key))
+
+
+# === HTTP-кэширование страниц (sql/008_table_versions.sql) ===
+TABLE_VERSIONS_CHANNEL = 'table_versions'
+
+# Необязательный общий для воркеров кеш готовых страниц (каталог на диске)
+PAGE_CACHE_DIR = os.getenv('PAGE_CACHE_DIR')
+
+
+class TableVersions:
+    """Версии таблиц шарда в памяти процесса.
+
+    Фоновый поток слушает NOTIFY table_versions и обновляет версии, поэтому
+    проверка ETag не обращается к БД. Пока слушатель не подключён, а также
+    после записи в этом процессе версии перечитываются одним запросом."""
+
+    def __init__(self, shard=DEFAULT_SHARD):
+        self.shard = shard
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._listening = False
+        self._stale = True
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._listening = False
+            self._stale = True
+            self._thread = threading.Thread(target=self._run, name=f'table-versions-{self.shard}', daemon=True)
+            self._thread.start()
+
+    def get(self, tables):
+        """Кортеж версий таблиц или None, если версии недоступны"""
+        self._ensure_started()
+        with self._lock:
+            if self._listening and not self._stale:
+                return tuple(self._versions.get(table, 0) for table in tables)
+        try:
+            conn = get_db_connection(shard=self.shard)
             try:
-                conn = get_db_connection()
                 cur = conn.cursor()
-                cur.execute(
-                    'INSERT INTO clients (name, contact_person) VALUES (%s, %s);',
-                    (name, contact)
-                )
-                conn.commit()
+                self._load(cur)
                 cur.close()
+            finally:
                 conn.close()
-                flash('Клиент успешно добавлен!', 'success')
-                return redirect(url_for('client_list'))
-            except Exception as e:
-                flash(f'Ошибка при добавлении клиента: {e}', 'error')
-    return render_template('clients/create.html')
+        except psycopg2.Error as e:
+            logger.warning('Версии таблиц шарда %s недоступны: %s', self.shard, e)
+            return None
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in tables)
 
-@app.route('/clients/edit/<int:id>', methods=('GET', 'POST'))
-def client_edit(id):
-    """Редактирование клиента"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT client_id, name, contact_person FROM clients WHERE client_id = %s;', (id,))
-    client = cur.fetchone()
-    if not client:
-        flash('Клиент не найден.', 'error')
-        return redirect(url_for('client_list'))
-    if request.method == 'POST':
-        name = request.form.get('name', '').strip()
-        contact = request.form.get('contact_person', '').strip()
-        if not name:
-            flash('Название клиента обязательно!', 'error')
-        else:
+    def mark_stale(self):
+        """Запись в этом процессе: следующая проверка перечитает версии, не дожидаясь NOTIFY"""
+        with self._lock:
+            self._stale = True
+
+    def _load(self, cur):
+        cur.execute('SELECT table_name, version FROM table_versions;')
+        rows = cur.fetchall()
+        with self._lock:
+            for table, version in rows:
+                self._versions[table] = max(version, self._versions.get(table, 0))
+            self._stale = False
+
+    def _apply(self, payload):
+        table, _, version = payload.rpartition(':')
+        with self._lock:
+            self._versions[table] = max(int(version), self._versions.get(table, 0))
+
+    def _run(self):
+        while True:
+            conn = None
             try:
-                cur.execute(
-                    'UPDATE clients SET name = %s, contact_person = %s WHERE client_id = %s;',
-                    (name, contact, id)
-                )
-                conn.commit()
-                flash('Данные клиента обновлены!', 'success')
-                return redirect(url_for('client_list'))
-            except Exception as e:
-                flash(f'Ошибка при обновлении: {e}', 'error')
-    cur.close()
-    conn.close()
-    return render_template('clients/edit.html', client=client)
+                conn = connect_db(self.shard)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN {TABLE_VERSIONS_CHANNEL};')
+                # Изменения, пришедшие до LISTEN, подхватываем полной загрузкой
+                self._load(cur)
+                with self._lock:
+                    self._listening = True
+                while True:
+                    if select.select([conn], [], [], SSE_HEARTBEAT_SECONDS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._apply(conn.notifies.pop(0).payload)
+            except psycopg2.Error as e:
+                logger.warning('Слушатель версий таблиц шарда %s: %s; переподключение', self.shard, e)
+                with self._lock:
+                    self._listening = False
+                time.sleep(SSE_RECONNECT_SECONDS)
+            finally:
+                if conn is not None:
+                    conn.close()
 
-@app.route('/clients/delete/<int:id>', methods=('GET', 'POST'))
-def client_delete(id):
-    """Удаление клиента"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT name FROM clients WHERE client_id = %s;', (id,))
-    client = cur.fetchone()
-    if not client:
-        flash('Клиент не найден.', 'error')
-        return redirect(url_for('client_list'))
-    if request.method == 'POST':
-        try:
-            cur.execute('DELETE FROM clients WHERE client_id = %s;', (id,))
-            conn.commit()
-            flash(f'Клиент "{client[0]}" удалён.', 'success')
-            return redirect(url_for('client_list'))
-        except Exception as e:
-            flash(f'Ошибка при удалении: {e}', 'error')
-    cur.close()
-    conn.close()
-    return render_template('clients/delete.html', client_name=client[0])
 
-# === CRUD: Справочник складов ===
-@app.route('/warehouses')
-def warehouse_list():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT warehouse_id, name, address, capacity_m3 FROM warehouses ORDER BY name;')
-    warehouses = cur.fetchall()
-    cur.close()
-    conn.close()
-    return render_template('warehouses/list.html', warehouses=warehouses)
+# Страница может читать любой шард, поэтому ETag учитывает версии всех
+table_versions = {shard: TableVersions(shard) for shard in shard_names()}
 
-@app.route('/warehouses/create', methods=('GET', 'POST'))
-def warehouse_create():
-    if request.method == 'POST':
-        name = request.form['name'].strip()
+
+class PageCache:
+    """Готовые страницы в каталоге, общем для воркеров: файл на адрес, первая строка — ETag"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.html')
+
+    def get(self, key, etag):
+        try:
+            with open(self._path(key), 'rb') as f:
+                if f.readline().rstrip(b'\n') != etag.encode():
+                    return None
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, etag, body):
+        # Запись через временный файл: читатели видят либо старую, либо новую страницу
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(etag.encode() + b'\n' + body)
+        os.replace(tmp_path, self._path(key))
+
+
+page_cache = PageCache(PAGE_CACHE_DIR) if PAGE_CACHE_DIR else None
+
+
+def cached_page(*tables):
+    """Условный GET для страницы, зависящей только от таблиц tables и адреса запроса.
+
+    ETag строится из версий таблиц; совпавший If-None-Match получает 304,
+    а при включённом PAGE_CACHE_DIR страница отдаётся из общего кеша — в обоих
+    случаях без запросов к БД. Страницы с flash-сообщениями не кешируются,
+    но их фрагменты {% cache %} берутся из кеша фрагментов по версии данных.
+    Страница, прочитанная с реплики, может отставать от версий основной базы:
+    её не кешируем и ETag ей не выдаём."""
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view_func(*args, **kwargs)
+            versions = [versions.get(tables) for versions in table_versions.values()]
+            if None in versions:
+                return view_func(*args, **kwargs)
+            # По той же версии шаблон кеширует фрагменты — и на страницах с flash
+            g.data_version = hashlib.sha1(str(versions).encode()).hexdigest()
+            if session.get('_flashes'):
+                return view_func(*args, **kwargs)
+            key = request.full_path
+            etag = hashlib.sha1(f'{key}|{versions}'.encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                body = page_cache.get(key, etag) if page_cache else None
+                if body is not None:
+                    response = Response(body, mimetype='text/html')
+                else:
+                    response = make_response(view_func(*args, **kwargs))
+                    # Ошибки, редиректы с flash и данные реплики не кешируем
+                    if response.status_code != 200 or session.get('_flashes') or g.get('replica_read'):
+                        return response
+                    if page_cache:
+                        page_cache.put(key, etag, response.get_data())
+            response.set_etag(etag, weak=True)
+            # Браузер хранит страницу, но каждый раз сверяет ETag
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate_table_versions(response):
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        for versions in table_versions.values():
+            versions.mark_stale()
+    return response
+
+# === Шаблоны: кеш фрагментов и время рендера ===
+# Предел памяти кеша фрагментов в каждом процессе
+TEMPLATE_FRAGMENT_CACHE_MB = float(os.getenv('TEMPLATE_FRAGMENT_CACHE_MB', '64'))
+
+metrics.describe('template_render_seconds_total', 'counter', 'Суммарное время рендера по шаблонам')
+metrics.describe('template_renders_total', 'counter', 'Число рендеров по шаблонам')
+metrics.describe('template_fragment_cache_total', 'counter', 'Обращения к кешу фрагментов: fragment, result')
+
+
+class FragmentCache:
+    """Готовые фрагменты шаблонов в памяти процесса: LRU с пределом по размеру.
+
+    Ключ содержит версию данных, поэтому устаревшие фрагменты не читаются,
+    а просто вытесняются новыми."""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_chars:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_chars:
+                _, old = self._items.popitem(last=False)
+                self._size -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+fragment_cache = FragmentCache(int(TEMPLATE_FRAGMENT_CACHE_MB * 1024 * 1024))
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache 'имя', ключ… %}…{% endcache %} — фрагмент, кешируемый по версии данных страницы.
+
+    Версию ставит cached_page (g.data_version); без неё фрагмент рендерится как обычно.
+    Версия — версия основной базы, поэтому фрагмент, при рендере которого запрос ушёл
+    на реплику, в кеш не кладётся: реплика могла ещё не дойти до этой версии."""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        version = g.get('data_version') if has_app_context() else None
+        if version is None:
+            return caller()
+        cache_key = (version, repr(key))
+        fragment = fragment_cache.get(cache_key)
+        metrics.inc('template_fragment_cache_total', fragment=key[0], result='miss' if fragment is None else 'hit')
+        if fragment is None:
+            fragment = caller()
+            if not g.get('replica_read'):
+                fragment_cache.put(cache_key, fragment)
+        return fragment
+
+
+class LazyRows:
+    """Строки, которые запрашиваются при первом обращении шаблона.
+
+    Если фрагмент с таблицей взят из кеша, запроса к БД нет совсем"""
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._rows = None
+
+    def _load(self):
+        if self._rows is None:
+            self._rows = self._fetch()
+        return self._rows
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __bool__(self):
+        return bool(self._load())
+
+
+def html_cells(values):
+    """Фильтр cells: ячейки <td> строки таблицы одной разметкой.
+
+    Экранирует значения сам и создаёт один Markup на строку, а не на ячейку —
+    на больших таблицах это основная часть времени рендера"""
+    return Markup('<td>' + '</td><td>'.join([html.escape(str(value)) for value in values]) + '</td>')
+
+
+def _template_render_started(sender, template, context, **extra):
+    g.setdefault('template_render_started', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    started = g.template_render_started.pop()
+    metrics.inc('template_render_seconds_total', time.perf_counter() - started, template=template.name)
+    metrics.inc('template_renders_total', template=template.name)
+
+# === Допуск тяжёлых запросов: лимиты, очередь, классы маршрутов ===
+# Класс маршрута в environ запроса: от него зависят statement_timeout и допуск
+ROUTE_CLASS_ENVIRON = 'warehouse.route_class'
+
+# Одновременных тяжёлых запросов (отчёты и рекомендации на странице) в процессе и у одного пользователя
+ADMISSION_CONCURRENCY = int(os.getenv('ADMISSION_CONCURRENCY', 2))
+ADMISSION_USER_CONCURRENCY = int(os.getenv('ADMISSION_USER_CONCURRENCY', 1))
+# Выгрузки файлом и длинные периоды — свой лимит и своя очередь (по умолчанию без
+# очереди: занято — отказ), чтобы многоминутная выгрузка не занимала место отчётов
+ADMISSION_EXPORT_CONCURRENCY = int(os.getenv('ADMISSION_EXPORT_CONCURRENCY', 1))
+ADMISSION_EXPORT_QUEUE_SIZE = int(os.getenv('ADMISSION_EXPORT_QUEUE_SIZE', 0))
+# Ожидающих в очереди: всего и от одного пользователя; сколько ждать, сек.
+# Ожидающий запрос держит поток сервера — очередь меньше числа потоков воркера
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 2))
+ADMISSION_USER_QUEUE_SIZE = int(os.getenv('ADMISSION_USER_QUEUE_SIZE', 1))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 20))
+
+# Период длиннее стольких дней не строится в памяти для страницы: уходит в выгрузку файлом
+ADMISSION_INLINE_MAX_DAYS = int(os.getenv('ADMISSION_INLINE_MAX_DAYS', 92))
+
+metrics.describe('admission_admitted_total', 'counter', 'Допущенные тяжёлые запросы: route_class, queued')
+metrics.describe('admission_rejected_total', 'counter', 'Отклонённые тяжёлые запросы: route_class, reason')
+metrics.describe('admission_wait_seconds_total', 'counter', 'Суммарное ожидание в очереди: route_class')
+metrics.describe('admission_running', 'gauge', 'Выполняющиеся тяжёлые запросы процесса: route_class')
+metrics.describe('admission_queued', 'gauge', 'Тяжёлые запросы в очереди процесса: route_class')
+metrics.describe('admission_routed_total', 'counter', 'Длинные периоды, отправленные в выгрузку: endpoint')
+
+
+class AdmissionRejected(Exception):
+    """Тяжёлый запрос не допущен: reason — queue_full, user_queue_full или timeout"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Лимиты одновременных тяжёлых запросов процесса: всего и на пользователя.
+
+    Сверх лимита запрос ждёт в очереди. Очереди у каждого пользователя свои,
+    освободившееся место получает следующий по кругу пользователь, которому
+    позволяет его собственный лимит: десяток отчётов одного не задерживает
+    единственный отчёт другого."""
+
+    def __init__(self, route_class, concurrency, user_concurrency, queue_size, user_queue_size, timeout):
+        self.route_class = route_class
+        self.concurrency = concurrency
+        self.user_concurrency = user_concurrency
+        self.queue_size = queue_size
+        self.user_queue_size = user_queue_size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._running = collections.Counter()
+        # Пользователь -> его ожидающие запросы; порядок ключей — очередь обхода по кругу
+        self._waiting = collections.OrderedDict()
+        self._queued = 0
+
+    def _publish(self):
+        metrics.set('admission_running', sum(self._running.values()), route_class=self.route_class)
+        metrics.set('admission_queued', self._queued, route_class=self.route_class)
+
+    def _dispatch(self):
+        """Раздаёт свободные места ожидающим по кругу пользователей"""
+        while self._waiting and sum(self._running.values()) < self.concurrency:
+            user = next((user for user in self._waiting if self._running[user] < self.user_concurrency), None)
+            if user is None:
+                return
+            ticket = self._waiting[user].popleft()
+            if self._waiting[user]:
+                self._waiting.move_to_end(user)
+            else:
+                del self._waiting[user]
+            self._queued -= 1
+            self._running[user] += 1
+            ticket['admitted'] = True
+        self._cond.notify_all()
+
+    def acquire(self, user):
+        """Ждёт места; возвращает время ожидания, сек., или бросает AdmissionRejected"""
+        with self._cond:
+            if (not self._waiting and sum(self._running.values()) < self.concurrency
+                    and self._running[user] < self.user_concurrency):
+                self._running[user] += 1
+                self._publish()
+                return 0.0
+            if self._queued >= self.queue_size:
+                raise AdmissionRejected('queue_full')
+            if len(self._waiting.get(user, ())) >= self.user_queue_size:
+                raise AdmissionRejected('user_queue_full')
+            ticket = {'admitted': False}
+            self._waiting.setdefault(user, collections.deque()).append(ticket)
+            self._queued += 1
+            self._dispatch()
+            self._publish()
+            started = time.monotonic()
+            deadline = started + self.timeout
+            while not ticket['admitted']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting[user].remove(ticket)
+                    if not self._waiting[user]:
+                        del self._waiting[user]
+                    self._queued -= 1
+                    self._publish()
+                    raise AdmissionRejected('timeout')
+                self._cond.wait(remaining)
+            self._publish()
+            return time.monotonic() - started
+
+    def release(self, user):
+        with self._cond:
+            self._running[user] -= 1
+            if not self._running[user]:
+                del self._running[user]
+            self._dispatch()
+            self._publish()
+
+
+# Класс маршрута -> его лимиты
+admission_controls = {
+    'heavy': AdmissionController(
+        'heavy', ADMISSION_CONCURRENCY, ADMISSION_USER_CONCURRENCY,
+        ADMISSION_QUEUE_SIZE, ADMISSION_USER_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+    ),
+    'export': AdmissionController(
+        'export', ADMISSION_EXPORT_CONCURRENCY, ADMISSION_USER_CONCURRENCY,
+        ADMISSION_EXPORT_QUEUE_SIZE, min(ADMISSION_USER_QUEUE_SIZE, ADMISSION_EXPORT_QUEUE_SIZE),
+        ADMISSION_QUEUE_TIMEOUT
+    ),
+}
+
+
+def long_period(start_date, end_date):
+    """Период длиннее ADMISSION_INLINE_MAX_DAYS. Без одной из границ период открыт
+    (до конца истории) — тоже длинный; с ошибкой в дате — нет, её отклонит маршрут"""
+    if not (start_date and end_date):
+        return True
+    try:
+        span = datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return False
+    return span.days + 1 > ADMISSION_INLINE_MAX_DAYS
+
+
+def admission(route_class, fallback='index'):
+    """Тяжёлый маршрут: допуск через лимиты класса (admission_controls) и statement_timeout класса.
+
+    route_class — 'heavy', 'export' или функция, выбирающая класс по запросу.
+    Не допущенный запрос получает flash и redirect на fallback."""
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapper(*args, **kwargs):
+            name = route_class() if callable(route_class) else route_class
+            request.environ[ROUTE_CLASS_ENVIRON] = name
+            # Пользователь — по сессии: за одним прокси у всех один адрес
+            user = session.setdefault('admission_id', uuid.uuid4().hex)
+            control = admission_controls[name]
+            try:
+                waited = control.acquire(user)
+            except AdmissionRejected as e:
+                metrics.inc('admission_rejected_total', route_class=name, reason=e.reason)
+                flash('Сервер занят тяжёлыми отчётами — повторите запрос через минуту.', 'error')
+                return redirect(url_for(fallback))
+            metrics.inc('admission_admitted_total', route_class=name, queued=str(waited > 0).lower())
+            metrics.inc('admission_wait_seconds_total', waited, route_class=name)
+            try:
+                return view_func(*args, **kwargs)
+            finally:
+                control.release(user)
+        return wrapper
+    return decorator
+
+
+# === Главная страница ===
+@route('/')
+def index():
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute('SELECT name FROM clients LIMIT 5;')
+        clients = cur.fetchall()
+        cur.close()
+        conn.close()
+        return render_template('index.html', clients=clients)
+    except Exception as e:
+        return f"<h1>❌ Ошибка подключения</h1><p>{str(e)}</p>"
+
+# === CRUD: Справочник клиентов ===
+@route('/clients')
+def client_list():
+    """Просмотр списка клиентов"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT client_id, name, contact_person FROM clients ORDER BY name;')
+    clients = cur.fetchall()
+    cur.close()
+    conn.close()
+    return render_template('clients/list.html', clients=clients)
+
+@route('/clients/create', methods=('GET', 'POST'))
+def client_create():
+    """Добавление нового клиента"""
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        contact = request.form.get('contact_person', '').strip()
+        if not name:
+            flash('Название клиента обязательно для заполнения!', 'error')
+        else:
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute(
+                    'INSERT INTO clients (name, contact_person) VALUES (%s, %s) RETURNING client_id;',
+                    (name, contact)
+                )
+                replicate_reference(cur, 'clients', [cur.fetchone()[0]])
+                conn.commit()
+                cur.close()
+                conn.close()
+                flash('Клиент успешно добавлен!', 'success')
+                return redirect(url_for('client_list'))
+            except Exception as e:
+                flash(f'Ошибка при добавлении клиента: {e}', 'error')
+    return render_template('clients/create.html')
+
+@route('/clients/edit/<int:id>', methods=('GET', 'POST'))
+def client_edit(id):
+    """Редактирование клиента"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT client_id, name, contact_person FROM clients WHERE client_id = %s;', (id,))
+    client = cur.fetchone()
+    if not client:
+        flash('Клиент не найден.', 'error')
+        return redirect(url_for('client_list'))
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        contact = request.form.get('contact_person', '').strip()
+        if not name:
+            flash('Название клиента обязательно!', 'error')
+        else:
+            try:
+                cur.execute(
+                    'UPDATE clients SET name = %s, contact_person = %s WHERE client_id = %s;',
+                    (name, contact, id)
+                )
+                replicate_reference(cur, 'clients', [id])
+                conn.commit()
+                flash('Данные клиента обновлены!', 'success')
+                return redirect(url_for('client_list'))
+            except Exception as e:
+                conn.rollback()
+                flash(f'Ошибка при обновлении: {e}', 'error')
+    cur.close()
+    conn.close()
+    return render_template('clients/edit.html', client=client)
+
+@route('/clients/delete/<int:id>', methods=('GET', 'POST'))
+def client_delete(id):
+    """Удаление клиента"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT name FROM clients WHERE client_id = %s;', (id,))
+    client = cur.fetchone()
+    if not client:
+        flash('Клиент не найден.', 'error')
+        return redirect(url_for('client_list'))
+    if request.method == 'POST':
+        try:
+            cur.execute('DELETE FROM clients WHERE client_id = %s;', (id,))
+            replicate_reference(cur, 'clients', [id])
+            conn.commit()
+            flash(f'Клиент "{client[0]}" удалён.', 'success')
+            return redirect(url_for('client_list'))
+        except Exception as e:
+            conn.rollback()
+            flash(f'Ошибка при удалении: {e}', 'error')
+    cur.close()
+    conn.close()
+    return render_template('clients/delete.html', client_name=client[0])
+
+# === CRUD: Справочник складов ===
+@route('/warehouses')
+@cached_page('warehouses')
+def warehouse_list():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT warehouse_id, name, address, capacity_m3 FROM warehouses ORDER BY name;')
+    warehouses = cur.fetchall()
+    cur.close()
+    conn.close()
+    return render_template('warehouses/list.html', warehouses=warehouses)
+
+@route('/warehouses/create', methods=('GET', 'POST'))
+def warehouse_create():
+    if request.method == 'POST':
+        name = request.form['name'].strip()
         address = request.form.get('address', '').strip()
         capacity = request.form.get('capacity_m3')
         if not name:
@@ -151,9 +1325,10 @@ def warehouse_create():
                 conn = get_db_connection()
                 cur = conn.cursor()
                 cur.execute(
-                    'INSERT INTO warehouses (name, address, capacity_m3) VALUES (%s, %s, %s);',
+                    'INSERT INTO warehouses (name, address, capacity_m3) VALUES (%s, %s, %s) RETURNING warehouse_id;',
                     (name, address, capacity or None)
                 )
+                replicate_reference(cur, 'warehouses', [cur.fetchone()[0]])
                 conn.commit()
                 flash('Склад добавлен!', 'success')
                 return redirect(url_for('warehouse_list'))
@@ -161,7 +1336,7 @@ def warehouse_create():
                 flash(f'Ошибка: {e}', 'error')
     return render_template('warehouses/create.html')
 
-@app.route('/warehouses/edit/<int:id>', methods=('GET', 'POST'))
+@route('/warehouses/edit/<int:id>', methods=('GET', 'POST'))
 def warehouse_edit(id):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -177,18 +1352,23 @@ def warehouse_edit(id):
         if not name:
             flash('Название обязательно!', 'error')
         else:
-            cur.execute(
-                'UPDATE warehouses SET name = %s, address = %s, capacity_m3 = %s WHERE warehouse_id = %s;',
-                (name, address, capacity or None, id)
-            )
-            conn.commit()
-            flash('Склад обновлён!', 'success')
-            return redirect(url_for('warehouse_list'))
+            try:
+                cur.execute(
+                    'UPDATE warehouses SET name = %s, address = %s, capacity_m3 = %s WHERE warehouse_id = %s;',
+                    (name, address, capacity or None, id)
+                )
+                replicate_reference(cur, 'warehouses', [id])
+                conn.commit()
+                flash('Склад обновлён!', 'success')
+                return redirect(url_for('warehouse_list'))
+            except Exception as e:
+                conn.rollback()
+                flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
     return render_template('warehouses/edit.html', warehouse=wh)
 
-@app.route('/warehouses/delete/<int:id>', methods=('GET', 'POST'))
+@route('/warehouses/delete/<int:id>', methods=('GET', 'POST'))
 def warehouse_delete(id):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -198,33 +1378,37 @@ def warehouse_delete(id):
         flash('Склад не найден.', 'error')
         return redirect(url_for('warehouse_list'))
     if request.method == 'POST':
-        cur.execute('DELETE FROM warehouses WHERE warehouse_id = %s;', (id,))
-        conn.commit()
-        flash(f'Склад "{wh[0]}" удалён.', 'success')
-        return redirect(url_for('warehouse_list'))
+        try:
+            cur.execute('DELETE FROM warehouses WHERE warehouse_id = %s;', (id,))
+            # Зоны склада лежат на его шарде: там их внешний ключ и не даст удалить склад
+            replicate_reference(cur, 'warehouses', [id])
+            conn.commit()
+            flash(f'Склад "{wh[0]}" удалён.', 'success')
+            return redirect(url_for('warehouse_list'))
+        except Exception as e:
+            conn.rollback()
+            flash(f'Ошибка при удалении: {e}', 'error')
     cur.close()
     conn.close()
     return render_template('warehouses/delete.html', name=wh[0])
 
 # === CRUD: Справочник зон ===
-@app.route('/zones')
+@route('/zones')
+@cached_page('zones', 'warehouses')
 def zone_list():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
+    # Зоны лежат на шардах своих складов
+    zones = fetch_sharded('''
         SELECT z.zone_id, z.name, z.type, w.name AS warehouse
         FROM zones z
         JOIN warehouses w ON z.warehouse_id = w.warehouse_id
         ORDER BY w.name, z.name;
-    ''')
-    zones = cur.fetchall()
-    cur.close()
-    conn.close()
+    ''', (), operator.itemgetter(3, 1), readonly=False)
     return render_template('zones/list.html', zones=zones)
 
-@app.route('/zones/create', methods=('GET', 'POST'))
+@route('/zones/create', methods=('GET', 'POST'))
 def zone_create():
-    conn = get_db_connection()
+    # Зона пишется на шард своего склада; справочник складов одинаков на всех шардах
+    conn = get_db_connection(warehouse_id=request.form.get('warehouse_id'))
     cur = conn.cursor()
     cur.execute('SELECT warehouse_id, name FROM warehouses ORDER BY name;')
     warehouses = cur.fetchall()
@@ -250,9 +1434,10 @@ def zone_create():
     conn.close()
     return render_template('zones/create.html', warehouses=warehouses)
 
-@app.route('/zones/edit/<int:id>', methods=('GET', 'POST'))
+@route('/zones/edit/<int:id>', methods=('GET', 'POST'))
 def zone_edit(id):
-    conn = get_db_connection()
+    shard = locate_shard('zones', 'zone_id', id)
+    conn = get_db_connection(shard=shard)
     cur = conn.cursor()
     cur.execute('SELECT warehouse_id, name, type, max_capacity FROM zones WHERE zone_id = %s;', (id,))
     zone = cur.fetchone()
@@ -268,6 +1453,8 @@ def zone_edit(id):
         max_cap = request.form.get('max_capacity')
         if not (name and wh_id and zone_type):
             flash('Все поля обязательны!', 'error')
+        elif shard_for(wh_id) != shard:
+            flash('Склад лежит на другом шарде: перенести туда зону нельзя, создайте её на новом складе.', 'error')
         else:
             cur.execute(
                 'UPDATE zones SET warehouse_id = %s, name = %s, type = %s, max_capacity = %s WHERE zone_id = %s;',
@@ -280,9 +1467,9 @@ def zone_edit(id):
     conn.close()
     return render_template('zones/edit.html', zone=zone, warehouses=warehouses)
 
-@app.route('/zones/delete/<int:id>', methods=('GET', 'POST'))
+@route('/zones/delete/<int:id>', methods=('GET', 'POST'))
 def zone_delete(id):
-    conn = get_db_connection()
+    conn = get_db_connection(shard=locate_shard('zones', 'zone_id', id))
     cur = conn.cursor()
     cur.execute('SELECT name FROM zones WHERE zone_id = %s;', (id,))
     zone = cur.fetchone()
@@ -299,7 +1486,7 @@ def zone_delete(id):
     return render_template('zones/delete.html', name=zone[0])
 
 # === CRUD: Справочник товаров ===
-@app.route('/products')
+@route('/products')
 def product_list():
     conn = get_db_connection()
     cur = conn.cursor()
@@ -317,7 +1504,7 @@ def product_list():
     conn.close()
     return render_template('products/list.html', products=products)
 
-@app.route('/products/create', methods=('GET', 'POST'))
+@route('/products/create', methods=('GET', 'POST'))
 def product_create():
     conn = get_db_connection()
     cur = conn.cursor()
@@ -335,18 +1522,20 @@ def product_create():
             try:
                 cur.execute('''
                     INSERT INTO products (client_id, name, weight_per_unit, units_per_box, units_per_pallet)
-                    VALUES (%s, %s, %s, %s, %s);
+                    VALUES (%s, %s, %s, %s, %s) RETURNING sku_id;
                 ''', (client_id, name, weight, box, pallet))
+                replicate_reference(cur, 'products', [cur.fetchone()[0]])
                 conn.commit()
                 flash('Товар добавлен!', 'success')
                 return redirect(url_for('product_list'))
             except Exception as e:
+                conn.rollback()
                 flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
     return render_template('products/create.html', clients=clients)
 
-@app.route('/products/edit/<int:id>', methods=('GET', 'POST'))
+@route('/products/edit/<int:id>', methods=('GET', 'POST'))
 def product_edit(id):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -376,16 +1565,18 @@ def product_edit(id):
                         units_per_box = %s, units_per_pallet = %s
                     WHERE sku_id = %s;
                 ''', (client_id, name, weight, box, pallet, id))
+                replicate_reference(cur, 'products', [id])
                 conn.commit()
                 flash('Товар обновлён!', 'success')
                 return redirect(url_for('product_list'))
             except Exception as e:
+                conn.rollback()
                 flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
     return render_template('products/edit.html', product=product, clients=clients)
 
-@app.route('/products/delete/<int:id>', methods=('GET', 'POST'))
+@route('/products/delete/<int:id>', methods=('GET', 'POST'))
 def product_delete(id):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -395,40 +1586,219 @@ def product_delete(id):
         flash('Товар не найден.', 'error')
         return redirect(url_for('product_list'))
     if request.method == 'POST':
-        cur.execute('DELETE FROM products WHERE sku_id = %s;', (id,))
-        conn.commit()
-        flash(f'Товар "{prod[0]}" удалён.', 'success')
-        return redirect(url_for('product_list'))
+        try:
+            cur.execute('DELETE FROM products WHERE sku_id = %s;', (id,))
+            replicate_reference(cur, 'products', [id])
+            conn.commit()
+            flash(f'Товар "{prod[0]}" удалён.', 'success')
+            return redirect(url_for('product_list'))
+        except Exception as e:
+            conn.rollback()
+            flash(f'Ошибка при удалении: {e}', 'error')
     cur.close()
     conn.close()
     return render_template('products/delete.html', name=prod[0])
 
-# === CRUD: Справочник ресурсов ===
-@app.route('/resources')
-def resource_list():
+# === Справочник подтипов ресурсов (sql/013_resource_subtypes.sql) ===
+RESOURCE_CATEGORIES = {'staff': 'Персонал', 'equipment': 'Техника'}
+
+# Колонки подтипа в порядке запроса справочника
+RESOURCE_SUBTYPE_FIELDS = (
+    'subtype_id', 'name', 'category', 'cost_per_hour', 'overtime_cost_per_hour',
+    'rental_cost_per_hour', 'rental_lead_days',
+)
+
+
+# Сколько секунд держать справочник подтипов, пока версии таблиц недоступны
+SUBTYPE_CATALOG_TTL = float(os.getenv('SUBTYPE_CATALOG_TTL', 5))
+
+
+class SubtypeCatalog:
+    """Справочник подтипов в памяти процесса: {название: подтип}.
+
+    Подтипы заводятся только на шарде по умолчанию (ensure_subtypes) и копируются
+    на остальные с теми же id, поэтому справочник читается одним запросом с шарда
+    по умолчанию, когда меняется версия таблицы resource_subtypes; пока версия
+    недоступна — не чаще, чем раз в SUBTYPE_CATALOG_TTL сек."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._loaded_at = None
+        self._subtypes = {}
+
+    def get(self):
+        version = table_versions[DEFAULT_SHARD].get(('resource_subtypes',))
+        with self._lock:
+            if self._loaded_at is not None:
+                if version is None:
+                    if time.monotonic() - self._loaded_at < SUBTYPE_CATALOG_TTL:
+                        return self._subtypes
+                elif version == self._version:
+                    return self._subtypes
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(f"SELECT {', '.join(RESOURCE_SUBTYPE_FIELDS)} FROM resource_subtypes ORDER BY category, name;")
+        subtypes = {}
+        for row in cur.fetchall():
+            subtype = dict(zip(RESOURCE_SUBTYPE_FIELDS, row))
+            for field in ('cost_per_hour', 'overtime_cost_per_hour', 'rental_cost_per_hour'):
+                if subtype[field] is not None:
+                    subtype[field] = float(subtype[field])
+            subtypes[subtype['name']] = subtype
+        cur.close()
+        conn.close()
+        with self._lock:
+            self._subtypes, self._version, self._loaded_at = subtypes, version, time.monotonic()
+        return subtypes
+
+    def by_category(self):
+        """Названия подтипов по категориям — для выпадающих списков форм; без категории — под ключом ''"""
+        groups = {category: [] for category in RESOURCE_CATEGORIES}
+        for name, subtype in self.get().items():
+            groups.setdefault(subtype['category'] or '', []).append(name)
+        return groups
+
+
+subtype_catalog = SubtypeCatalog()
+
+
+def ensure_subtypes(subtypes):
+    """Заводит неизвестные подтипы на шарде по умолчанию и копирует их на остальные.
+
+    subtypes — {название: категория или None}; пустая категория известного подтипа
+    дописывается. Триггеры ресурсов и нормативов (sql/013) только находят подтип по
+    названию, поэтому вызывается до записи строки — на любом шарде."""
+    known = subtype_catalog.get()
+    missing = {}
+    for name, category in subtypes.items():
+        category = category if category in RESOURCE_CATEGORIES else None
+        if name not in known or (category and not known[name]['category']):
+            missing[name] = category
+    if not missing:
+        return
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('''
-        SELECT
-            r.resource_id,
-            r.name,
-            CASE
-                WHEN r.type = 'staff' THEN 'Персонал'
-                WHEN r.type = 'equipment' THEN 'Техника'
-                ELSE r.type
-            END AS type_ru,
-            r.subtype,
-            z.name AS zone
-        FROM resources r
-        LEFT JOIN zones z ON r.zone_id = z.zone_id
-        ORDER BY r.type, r.subtype, r.name;
-    ''')
-    resources = cur.fetchall()
-    cur.close()
-    conn.close()
-    return render_template('resources/list.html', resources=resources)
+    try:
+        ids = [row[0] for row in execute_values(cur, '''
+            INSERT INTO resource_subtypes (name, category) VALUES %s
+            ON CONFLICT (name) DO UPDATE SET category = COALESCE(resource_subtypes.category, EXCLUDED.category)
+            RETURNING subtype_id;
+        ''', sorted(missing.items()), fetch=True)]
+        replicate_reference(cur, 'resource_subtypes', ids)
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
 
-@app.route('/resources/create', methods=('GET', 'POST'))
+
+@route('/resource-subtypes')
+def resource_subtype_list():
+    return render_template(
+        'resource_subtypes/list.html', subtypes=subtype_catalog.get().values(), categories=RESOURCE_CATEGORIES
+    )
+
+
+def _subtype_form(name=None):
+    """Поля подтипа из формы (при правке название прежнее): (значения, ошибка)"""
+    values = {
+        'name': name or request.form.get('name', '').strip(),
+        'category': request.form.get('category') or None,
+    }
+    if not values['name']:
+        return values, 'Название подтипа обязательно!'
+    if values['category'] not in (None, *RESOURCE_CATEGORIES):
+        return values, 'Неизвестная категория.'
+    try:
+        for field in ('cost_per_hour', 'overtime_cost_per_hour', 'rental_cost_per_hour'):
+            value = request.form.get(field, '').strip().replace(',', '.')
+            values[field] = float(value) if value else None
+        values['rental_lead_days'] = int(request.form.get('rental_lead_days') or 0)
+    except ValueError:
+        return values, 'Стоимость и срок должны быть числами.'
+    return values, None
+
+
+@route('/resource-subtypes/create', methods=('GET', 'POST'))
+def resource_subtype_create():
+    if request.method == 'POST':
+        values, error = _subtype_form()
+        if error:
+            flash(error, 'error')
+        else:
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                fields = RESOURCE_SUBTYPE_FIELDS[1:]
+                cur.execute(f'''
+                    INSERT INTO resource_subtypes ({', '.join(fields)})
+                    VALUES ({', '.join(['%s'] * len(fields))}) RETURNING subtype_id;
+                ''', [values[field] for field in fields])
+                replicate_reference(cur, 'resource_subtypes', [cur.fetchone()[0]])
+                conn.commit()
+                flash('Подтип добавлен!', 'success')
+                return redirect(url_for('resource_subtype_list'))
+            except psycopg2.errors.UniqueViolation:
+                flash('Подтип с таким названием уже есть.', 'error')
+            except Exception as e:
+                flash(f'Ошибка: {e}', 'error')
+    return render_template('resource_subtypes/create.html', categories=RESOURCE_CATEGORIES)
+
+
+@route('/resource-subtypes/edit/<int:id>', methods=('GET', 'POST'))
+def resource_subtype_edit(id):
+    """Категория, стоимость часа и срок аренды; название — ключ, по которому подтип
+    указан в ресурсах и нормативах, поэтому здесь не меняется"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"SELECT {', '.join(RESOURCE_SUBTYPE_FIELDS)} FROM resource_subtypes WHERE subtype_id = %s;", (id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    if not row:
+        flash('Подтип не найден.', 'error')
+        return redirect(url_for('resource_subtype_list'))
+    subtype = dict(zip(RESOURCE_SUBTYPE_FIELDS, row))
+    if request.method == 'POST':
+        values, error = _subtype_form(subtype['name'])
+        if error:
+            flash(error, 'error')
+        else:
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                fields = RESOURCE_SUBTYPE_FIELDS[2:]
+                cur.execute(f'''
+                    UPDATE resource_subtypes SET {', '.join(f'{field} = %s' for field in fields)}
+                    WHERE subtype_id = %s;
+                ''', [values[field] for field in fields] + [id])
+                replicate_reference(cur, 'resource_subtypes', [id])
+                conn.commit()
+                flash('Подтип обновлён!', 'success')
+                return redirect(url_for('resource_subtype_list'))
+            except Exception as e:
+                flash(f'Ошибка: {e}', 'error')
+    return render_template('resource_subtypes/edit.html', subtype=subtype, categories=RESOURCE_CATEGORIES)
+
+
+# === CRUD: Справочник ресурсов ===
+@route('/resources')
+def resource_list():
+    resources = fetch_sharded('''
+        SELECT
+            r.resource_id,
+            r.name,
+            COALESCE(st.category, r.type) AS category,
+            st.name AS subtype,
+            z.name AS zone
+        FROM resources r
+        JOIN resource_subtypes st ON st.subtype_id = r.subtype_id
+        LEFT JOIN zones z ON r.zone_id = z.zone_id
+        ORDER BY category, st.name, r.name;
+    ''', (), operator.itemgetter(2, 3, 1), readonly=False)
+    return render_template('resources/list.html', resources=resources, categories=RESOURCE_CATEGORIES)
+
+@route('/resources/create', methods=('GET', 'POST'))
 def resource_create():
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
@@ -439,39 +1809,36 @@ def resource_create():
             flash('Все поля обязательны!', 'error')
         else:
             try:
-                conn = get_db_connection()
+                ensure_subtypes({subtype: r_type})
+                # Ресурс лежит на шарде своей зоны; без зоны — на шарде по умолчанию
+                conn = get_db_connection(shard=locate_shard('zones', 'zone_id', zone_id))
                 cur = conn.cursor()
                 cur.execute('''
                     INSERT INTO resources (type, subtype, name, zone_id)
-                    VALUES (%s, %s, %s, %s);
+                    VALUES (%s, %s, %s, %s) RETURNING resource_id;
                 ''', (r_type, subtype, name, zone_id))
+                record_capacity_event(cur, 'resource', 'create', cur.fetchone()[0])
                 conn.commit()
                 flash('Ресурс добавлен!', 'success')
                 return redirect(url_for('resource_list'))
             except Exception as e:
                 flash(f'Ошибка: {e}', 'error')
     # Загружаем зоны для выпадающего списка
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT zone_id, name FROM zones ORDER BY name;')
-    zones = cur.fetchall()
-    cur.close()
-    conn.close()
-    return render_template('resources/create.html', zones=zones)
+    return render_template('resources/create.html', zones=zone_choices(), subtypes=subtype_catalog.by_category())
 
-@app.route('/resources/edit/<int:id>', methods=('GET', 'POST'))
+@route('/resources/edit/<int:id>', methods=('GET', 'POST'))
 def resource_edit(id):
-    conn = get_db_connection()
+    shard = locate_shard('resources', 'resource_id', id)
+    conn = get_db_connection(shard=shard)
     cur = conn.cursor()
     cur.execute('SELECT resource_id, type, subtype, name, zone_id FROM resources WHERE resource_id = %s;', (id,))
     res = cur.fetchone()
     if not res:
         flash('Ресурс не найден.', 'error')
         return redirect(url_for('resource_list'))
-    cur.execute('SELECT zone_id, name FROM zones ORDER BY name;')
-    zones = cur.fetchall()
     cur.close()
     conn.close()
+    zones = zone_choices()
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
         r_type = request.form.get('type')
@@ -479,25 +1846,32 @@ def resource_edit(id):
         zone_id = request.form.get('zone_id') or None
         if not (name and r_type and subtype):
             flash('Все поля обязательны!', 'error')
+        elif zone_id and locate_shard('zones', 'zone_id', zone_id) != shard:
+            flash('Зона лежит на шарде другого склада: перенести туда ресурс нельзя.', 'error')
         else:
             try:
-                conn = get_db_connection()
+                ensure_subtypes({subtype: r_type})
+                conn = get_db_connection(shard=shard)
                 cur = conn.cursor()
+                before = _capacity_contribution(cur, 'resource_id', id)
                 cur.execute('''
                     UPDATE resources
                     SET type = %s, subtype = %s, name = %s, zone_id = %s
                     WHERE resource_id = %s;
                 ''', (r_type, subtype, name, zone_id, id))
+                record_capacity_event(
+                    cur, 'resource', 'edit', id, before, _capacity_contribution(cur, 'resource_id', id)
+                )
                 conn.commit()
                 flash('Ресурс обновлён!', 'success')
                 return redirect(url_for('resource_list'))
             except Exception as e:
                 flash(f'Ошибка: {e}', 'error')
-    return render_template('resources/edit.html', resource=res, zones=zones)
+    return render_template('resources/edit.html', resource=res, zones=zones, subtypes=subtype_catalog.by_category())
 
-@app.route('/resources/delete/<int:id>', methods=('GET', 'POST'))
+@route('/resources/delete/<int:id>', methods=('GET', 'POST'))
 def resource_delete(id):
-    conn = get_db_connection()
+    conn = get_db_connection(shard=locate_shard('resources', 'resource_id', id))
     cur = conn.cursor()
     cur.execute('SELECT name FROM resources WHERE resource_id = %s;', (id,))
     res = cur.fetchone()
@@ -505,7 +1879,9 @@ def resource_delete(id):
         flash('Ресурс не найден.', 'error')
         return redirect(url_for('resource_list'))
     if request.method == 'POST':
+        before = _capacity_contribution(cur, 'resource_id', id)
         cur.execute('DELETE FROM resources WHERE resource_id = %s;', (id,))
+        record_capacity_event(cur, 'resource', 'delete', id, before)
         conn.commit()
         flash(f'Ресурс "{res[0]}" удалён.', 'success')
         return redirect(url_for('resource_list'))
@@ -514,35 +1890,35 @@ def resource_delete(id):
     return render_template('resources/delete.html', name=res[0])
 
 # === Планы поступления ===
-@app.route('/inbound')
+@route('/inbound')
 def inbound_list():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT d.doc_id, c.name AS client, d.doc_number, d.doc_date, d.validated
+    # Документы лежат на шардах своих складов; слияние — по убыванию даты и номера
+    docs = fetch_sharded('''
+        SELECT d.doc_id, c.name AS client, d.doc_number, d.doc_date, d.validated, w.name AS warehouse
         FROM inbound_documents d
         JOIN clients c ON d.client_id = c.client_id
+        LEFT JOIN warehouses w ON d.warehouse_id = w.warehouse_id
         ORDER BY d.doc_date DESC, d.doc_id DESC;
-    ''')
-    docs = cur.fetchall()
-    cur.close()
-    conn.close()
+    ''', (), lambda row: (-row[3].toordinal(), -row[0]), readonly=False)
     return render_template('inbound/list.html', docs=docs)
 
-@app.route('/inbound/create', methods=('GET', 'POST'))
+@route('/inbound/create', methods=('GET', 'POST'))
 def inbound_create():
-    conn = get_db_connection()
+    # Документ пишется на шард своего склада
+    conn = get_db_connection(warehouse_id=request.form.get('warehouse_id'))
     cur = conn.cursor()
     cur.execute('SELECT client_id, name FROM clients ORDER BY name;')
     clients = cur.fetchall()
     if request.method == 'POST':
         client_id = request.form.get('client_id')
+        warehouse_id = request.form.get('warehouse_id')
         doc_number = request.form.get('doc_number', '').strip()
         doc_date = request.form.get('doc_date')
         skus = request.form.getlist('sku_id')
         qtys = request.form.getlist('qty')
         units = request.form.getlist('unit_type')
-        if not (client_id and doc_number and doc_date):
+        idempotency_key = request.form.get('idempotency_key')
+        if not (client_id and warehouse_id and doc_number and doc_date):
             flash('Заполните реквизиты документа!', 'error')
         else:
             valid_positions = 0
@@ -562,11 +1938,19 @@ def inbound_create():
                 flash('Добавьте хотя бы одну позицию с количеством > 0!', 'error')
             else:
                 try:
+                    if idempotency_key and claim_idempotency_key(cur, idempotency_key, 'inbound_create'):
+                        # Повторная отправка той же формы: документ уже создан первым запросом
+                        conn.rollback()
+                        flash('Поступление уже добавлено.', 'success')
+                        return redirect(url_for('inbound_list'))
+                    require_partition(cur, 'inbound_documents', doc_date)
                     cur.execute('''
-                        INSERT INTO inbound_documents (client_id, doc_number, doc_date)
-                        VALUES (%s, %s, %s) RETURNING doc_id;
-                    ''', (client_id, doc_number, doc_date))
+                        INSERT INTO inbound_documents (client_id, warehouse_id, doc_number, doc_date)
+                        VALUES (%s, %s, %s, %s) RETURNING doc_id;
+                    ''', (client_id, warehouse_id, doc_number, doc_date))
                     doc_id = cur.fetchone()[0]
+                    if idempotency_key:
+                        store_idempotent_result(cur, idempotency_key, result_id=doc_id)
                     for i in range(len(skus)):
                         sku_id = skus[i]
                         qty_str = qtys[i] if i < len(qtys) else ''
@@ -582,6 +1966,10 @@ def inbound_create():
                                 ''', (doc_id, sku_id, qty_val, unit))
                         except ValueError:
                             continue
+                    # Новый документ ещё не валидирован и в баланс не входит
+                    record_capacity_event(
+                        cur, 'inbound', 'create', doc_id, payload={'doc_date': doc_date}
+                    )
                     conn.commit()
                     flash('Поступление добавлено!', 'success')
                     return redirect(url_for('inbound_list'))
@@ -595,17 +1983,27 @@ def inbound_create():
         products = cur.fetchall()
     cur.close()
     conn.close()
-    return render_template('inbound/create.html', clients=clients, products=products)
+    return render_template(
+        'inbound/create.html', clients=clients, products=products, warehouses=warehouse_choices(),
+        idempotency_key=request.form.get('idempotency_key') or new_idempotency_key()
+    )
 
-@app.route('/inbound/edit/<int:doc_id>', methods=('GET', 'POST'))
+@route('/inbound/edit/<int:doc_id>', methods=('GET', 'POST'))
 def inbound_edit(doc_id):
-    conn = get_db_connection()
+    shard = locate_shard('inbound_documents', 'doc_id', doc_id)
+    conn = get_db_connection(shard=shard)
     cur = conn.cursor()
-    cur.execute('SELECT doc_id, client_id, doc_number, doc_date FROM inbound_documents WHERE doc_id = %s;', (doc_id,))
+    cur.execute('''
+        SELECT doc_id, client_id, doc_number, doc_date, validated, row_version, warehouse_id
+        FROM inbound_documents WHERE doc_id = %s;
+    ''', (doc_id,))
     doc = cur.fetchone()
     if not doc:
         flash('Документ не найден.', 'error')
         return redirect(url_for('inbound_list'))
+    if doc[4]:
+        flash('Подтверждённое поступление нельзя изменить.', 'error')
+        return redirect(url_for('inbound_list'))
     cur.execute('SELECT client_id, name FROM clients ORDER BY name;')
     clients = cur.fetchall()
     cur.execute('SELECT sku_id, name FROM products WHERE client_id = %s ORDER BY name;', (doc[1],))
@@ -614,22 +2012,42 @@ def inbound_edit(doc_id):
     items = cur.fetchall()
     if request.method == 'POST':
         client_id = request.form.get('client_id')
+        warehouse_id = request.form.get('warehouse_id')
         doc_number = request.form.get('doc_number', '').strip()
         doc_date = request.form.get('doc_date')
         skus = request.form.getlist('sku_id')
         qtys = request.form.getlist('qty')
         units = request.form.getlist('unit_type')
-        if not (client_id and doc_number and doc_date):
+        if not (client_id and warehouse_id and doc_number and doc_date):
             flash('Заполните реквизиты документа!', 'error')
+        elif shard_for(warehouse_id) != shard:
+            flash('Склад лежит на другом шарде: перенести туда документ нельзя, создайте его заново.', 'error')
         elif not any(qty.strip() and float(qty) > 0 for qty in qtys if qty):
             flash('Добавьте хотя бы одну позицию!', 'error')
         else:
             try:
+                # Блокируется только строка этого документа: правки и подтверждение
+                # одного документа идут по очереди, остальные документы не ждут
+                cur.execute(
+                    'SELECT validated, row_version FROM inbound_documents WHERE doc_id = %s FOR UPDATE;',
+                    (doc_id,)
+                )
+                current = cur.fetchone()
+                if current is None or current[0]:
+                    conn.rollback()
+                    flash('Документ удалён или уже подтверждён — изменения не сохранены.', 'error')
+                    return redirect(url_for('inbound_list'))
+                if str(current[1]) != request.form.get('row_version'):
+                    conn.rollback()
+                    flash('Документ изменён другим пользователем — проверьте данные и сохраните ещё раз.', 'error')
+                    return redirect(url_for('inbound_edit', doc_id=doc_id))
+                before = _inbound_contribution(cur, doc_id)
+                require_partition(cur, 'inbound_documents', doc_date)
                 cur.execute('''
                     UPDATE inbound_documents
-                    SET client_id = %s, doc_number = %s, doc_date = %s
+                    SET client_id = %s, warehouse_id = %s, doc_number = %s, doc_date = %s
                     WHERE doc_id = %s;
-                ''', (client_id, doc_number, doc_date, doc_id))
+                ''', (client_id, warehouse_id, doc_number, doc_date, doc_id))
                 cur.execute('DELETE FROM inbound_items WHERE doc_id = %s;', (doc_id,))
                 for i in range(len(skus)):
                     sku_id = skus[i]
@@ -640,6 +2058,10 @@ def inbound_edit(doc_id):
                             INSERT INTO inbound_items (doc_id, sku_id, qty, unit_type)
                             VALUES (%s, %s, %s, %s);
                         ''', (doc_id, sku_id, qty, unit))
+                snapshot_requirements(cur, 'inbound', 'doc_id = %s', (doc_id,))
+                record_capacity_event(
+                    cur, 'inbound', 'edit', doc_id, before, _inbound_contribution(cur, doc_id)
+                )
                 conn.commit()
                 flash('Поступление обновлено!', 'success')
                 return redirect(url_for('inbound_list'))
@@ -648,11 +2070,14 @@ def inbound_edit(doc_id):
                 flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
-    return render_template('inbound/edit.html', doc=doc, clients=clients, products=products, items=items)
+    return render_template(
+        'inbound/edit.html', doc=doc, clients=clients, products=products, items=items,
+        warehouses=warehouse_choices()
+    )
 
-@app.route('/inbound/delete/<int:doc_id>', methods=('GET', 'POST'))
+@route('/inbound/delete/<int:doc_id>', methods=('GET', 'POST'))
 def inbound_delete(doc_id):
-    conn = get_db_connection()
+    conn = get_db_connection(shard=locate_shard('inbound_documents', 'doc_id', doc_id))
     cur = conn.cursor()
     cur.execute('SELECT doc_number FROM inbound_documents WHERE doc_id = %s;', (doc_id,))
     doc = cur.fetchone()
@@ -661,7 +2086,9 @@ def inbound_delete(doc_id):
         return redirect(url_for('inbound_list'))
     if request.method == 'POST':
         try:
+            before = _inbound_contribution(cur, doc_id)
             cur.execute('DELETE FROM inbound_documents WHERE doc_id = %s;', (doc_id,))
+            record_capacity_event(cur, 'inbound', 'delete', doc_id, before)
             conn.commit()
             flash(f'Документ {doc[0]} удалён.', 'success')
             return redirect(url_for('inbound_list'))
@@ -671,9 +2098,9 @@ def inbound_delete(doc_id):
     conn.close()
     return render_template('inbound/delete.html', doc_number=doc[0])
 
-@app.route('/inbound/validate/<int:doc_id>', methods=('GET', 'POST'))
+@route('/inbound/validate/<int:doc_id>', methods=('GET', 'POST'))
 def inbound_validate(doc_id):
-    conn = get_db_connection()
+    conn = get_db_connection(shard=locate_shard('inbound_documents', 'doc_id', doc_id))
     cur = conn.cursor()
     cur.execute('''
         SELECT d.doc_number, c.name
@@ -687,36 +2114,48 @@ def inbound_validate(doc_id):
         return redirect(url_for('inbound_list'))
     if request.method == 'POST':
         try:
+            # Параллельное подтверждение того же документа ждёт здесь и видит validated = TRUE
+            cur.execute('SELECT validated FROM inbound_documents WHERE doc_id = %s FOR UPDATE;', (doc_id,))
+            current = cur.fetchone()
+            if current is None or current[0]:
+                conn.rollback()
+                flash(f'Поступление {doc[0]} уже подтверждено или удалено.', 'error')
+                return redirect(url_for('inbound_list'))
+            before = _inbound_contribution(cur, doc_id)
             cur.execute('UPDATE inbound_documents SET validated = TRUE WHERE doc_id = %s;', (doc_id,))
+            # Потребность фиксируется по нормативам на момент подтверждения
+            snapshot_requirements(cur, 'inbound', 'doc_id = %s', (doc_id,))
+            record_capacity_event(
+                cur, 'inbound', 'validate', doc_id, before, _inbound_contribution(cur, doc_id)
+            )
             conn.commit()
             flash(f'Поступление {doc[0]} подтверждено!', 'success')
             return redirect(url_for('inbound_list'))
         except Exception as e:
+            conn.rollback()
             flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
     return render_template('inbound/validate.html', doc_number=doc[0], client_name=doc[1])
 
 # === Планы отгрузки ===
-@app.route('/plans/outbound')
+@route('/plans/outbound')
 def outbound_list():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT op.plan_id, c.name AS client, p.name AS product, op.date, op.qty, op.validated
+    # Порядок слияния шардов повторяет ORDER BY (номер документа NULL — в конце)
+    plans = fetch_sharded('''
+        SELECT op.plan_id, c.name AS client, p.name AS product, op.date, op.qty, op.validated,
+               op.doc_number, op.unit_type
         FROM outbound_plan op
         JOIN clients c ON op.client_id = c.client_id
         JOIN products p ON op.sku_id = p.sku_id
-        ORDER BY op.date DESC, op.plan_id;
-    ''')
-    plans = cur.fetchall()
-    cur.close()
-    conn.close()
+        ORDER BY op.date DESC, op.doc_number, op.plan_id;
+    ''', (), lambda row: (-row[3].toordinal(), row[6] is None, row[6] or '', row[0]), readonly=False)
     return render_template('plans/outbound_list.html', plans=plans)
 
-@app.route('/plans/outbound/create', methods=('GET', 'POST'))
+@route('/plans/outbound/create', methods=('GET', 'POST'))
 def outbound_create():
-    conn = get_db_connection()
+    # План пишется на шард своего склада
+    conn = get_db_connection(warehouse_id=request.form.get('warehouse_id'))
     cur = conn.cursor()
     cur.execute('SELECT client_id, name FROM clients ORDER BY name;')
     clients = cur.fetchall()
@@ -724,35 +2163,156 @@ def outbound_create():
     products = cur.fetchall()
     if request.method == 'POST':
         client_id = request.form.get('client_id')
-        sku_id = request.form.get('sku_id')
+        warehouse_id = request.form.get('warehouse_id')
+        doc_number = request.form.get('doc_number', '').strip()
         date = request.form.get('date')
-        qty = request.form.get('qty')
-        if not (client_id and sku_id and date and qty):
-            flash('Все поля обязательны!', 'error')
+        skus = request.form.getlist('sku_id')
+        qtys = request.form.getlist('qty')
+        units = request.form.getlist('unit_type')
+        idempotency_key = request.form.get('idempotency_key')
+        positions = []
+        for i in range(len(skus)):
+            qty_str = qtys[i] if i < len(qtys) else ''
+            unit = units[i] if i < len(units) else 'шт'
+            if not skus[i] or not qty_str.strip():
+                continue
+            try:
+                qty_val = float(qty_str)
+            except ValueError:
+                continue
+            if qty_val > 0:
+                positions.append((skus[i], qty_val, unit))
+        if not (client_id and warehouse_id and doc_number and date):
+            flash('Заполните реквизиты документа!', 'error')
+        elif not positions:
+            flash('Добавьте хотя бы одну позицию с количеством > 0!', 'error')
         else:
             try:
-                cur.execute(
-                    'INSERT INTO outbound_plan (client_id, sku_id, date, qty, validated) VALUES (%s, %s, %s, %s, %s);',
-                    (client_id, sku_id, date, qty, False)
+                if idempotency_key and claim_idempotency_key(cur, idempotency_key, 'outbound_create'):
+                    conn.rollback()
+                    flash('План отгрузки уже добавлен.', 'success')
+                    return redirect(url_for('outbound_list'))
+                require_partition(cur, 'outbound_plan', date)
+                # Все строки документа — одним INSERT
+                plan_ids = [row[0] for row in execute_values(
+                    cur,
+                    '''
+                        INSERT INTO outbound_plan (
+                            client_id, warehouse_id, doc_number, date, sku_id, qty, unit_type, validated
+                        )
+                        VALUES %s RETURNING plan_id;
+                    ''',
+                    [
+                        (client_id, warehouse_id, doc_number, date, sku_id, qty, unit, False)
+                        for sku_id, qty, unit in positions
+                    ],
+                    page_size=BULK_PAGE_SIZE,
+                    fetch=True
+                )]
+                # Новый план ещё не валидирован и в баланс не входит
+                record_capacity_event(
+                    cur, 'outbound', 'create', plan_ids[0],
+                    payload={'date': date, 'doc_number': doc_number, 'plan_ids': plan_ids}
                 )
+                if idempotency_key:
+                    store_idempotent_result(cur, idempotency_key, result_id=plan_ids[0])
                 conn.commit()
                 flash('План отгрузки добавлен!', 'success')
                 return redirect(url_for('outbound_list'))
             except Exception as e:
+                conn.rollback()
                 flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
-    return render_template('plans/outbound_create.html', clients=clients, products=products)
+    return render_template(
+        'plans/outbound_create.html', clients=clients, products=products, warehouses=warehouse_choices(),
+        idempotency_key=request.form.get('idempotency_key') or new_idempotency_key()
+    )
+
+@route('/plans/outbound/validate/<int:plan_id>', methods=('GET', 'POST'))
+def outbound_validate(plan_id):
+    """Подтверждение документа отгрузки: все его строки валидируются и попадают в снимок потребности"""
+    conn = get_db_connection(shard=locate_shard('outbound_plan', 'plan_id', plan_id))
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT op.client_id, op.date, op.doc_number, c.name
+        FROM outbound_plan op
+        JOIN clients c ON op.client_id = c.client_id
+        WHERE op.plan_id = %s;
+    ''', (plan_id,))
+    plan = cur.fetchone()
+    if not plan:
+        flash('План отгрузки не найден.', 'error')
+        return redirect(url_for('outbound_list'))
+    client_id, date, doc_number, client_name = plan
+    if doc_number:
+        cur.execute('''
+            SELECT plan_id FROM outbound_plan
+            WHERE client_id = %s AND date = %s AND doc_number = %s;
+        ''', (client_id, date, doc_number))
+        plan_ids = [row[0] for row in cur.fetchall()]
+    else:
+        plan_ids = [plan_id]
+    if request.method == 'POST':
+        try:
+            # Блокируются строки только этого документа; уже подтверждённые не трогаем
+            cur.execute('''
+                SELECT plan_id FROM outbound_plan
+                WHERE plan_id = ANY(%s) AND date = %s AND NOT validated
+                FOR UPDATE;
+            ''', (plan_ids, date))
+            plan_ids = [row[0] for row in cur.fetchall()]
+            if not plan_ids:
+                conn.rollback()
+                flash(f'План отгрузки {doc_number or plan_id} уже подтверждён.', 'error')
+                return redirect(url_for('outbound_list'))
+            before = _outbound_contribution(cur, plan_ids)
+            cur.execute(
+                'UPDATE outbound_plan SET validated = TRUE WHERE plan_id = ANY(%s) AND date = %s;',
+                (plan_ids, date)
+            )
+            snapshot_requirements(cur, 'outbound', 'plan_id = ANY(%s)', (plan_ids,))
+            record_capacity_event(
+                cur, 'outbound', 'validate', plan_id, before, _outbound_contribution(cur, plan_ids),
+                payload={'plan_ids': plan_ids}
+            )
+            conn.commit()
+            flash(f'План отгрузки {doc_number or plan_id} подтверждён!', 'success')
+            return redirect(url_for('outbound_list'))
+        except Exception as e:
+            conn.rollback()
+            flash(f'Ошибка: {e}', 'error')
+    # Строки без норматива отгрузки не дадут потребности — предупреждаем до подтверждения
+    cur.execute('''
+        SELECT p.name, op.unit_type
+        FROM outbound_plan op
+        JOIN products p ON op.sku_id = p.sku_id
+        WHERE op.plan_id = ANY(%s) AND op.date = %s
+          AND NOT EXISTS (
+              SELECT 1 FROM norm_lookup nl
+              WHERE nl.sku_id = op.sku_id
+                AND nl.operation_type = 'outbound'
+                AND nl.unit_type = op.unit_type
+          )
+        ORDER BY p.name;
+    ''', (plan_ids, date))
+    missing_norms = cur.fetchall()
+    cur.close()
+    conn.close()
+    return render_template(
+        'plans/outbound_validate.html', doc_number=doc_number or plan_id, client_name=client_name,
+        lines=len(plan_ids), missing_norms=missing_norms
+    )
 
 # === Расчёт потребности (A9) ===
-@app.route('/requirements', methods=('GET', 'POST'))
+@route('/requirements', methods=('GET', 'POST'))
+@cached_page('inbound_documents', 'inbound_items', 'outbound_plan', 'norm_lookup', 'zones', 'warehouses')
 def requirements_view():
-    """Просмотр рассчитанной потребности в ресурсах с фильтром по дате"""
+    """Просмотр рассчитанной потребности в ресурсах с фильтром по дате и складу"""
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    warehouse_id = request.args.get('warehouse_id', type=int)
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
         query = '''
             SELECT
                 r.date,
@@ -763,57 +2323,60 @@ def requirements_view():
             FROM v_resource_requirements r
             JOIN zones z ON r.zone_id = z.zone_id
         '''
+        conditions = []
         params = []
-        if start_date and end_date:
-            query += ' WHERE r.date BETWEEN %s AND %s'
-            params = [start_date, end_date]
-        elif start_date:
-            query += ' WHERE r.date >= %s'
-            params = [start_date]
-        elif end_date:
-            query += ' WHERE r.date <= %s'
-            params = [end_date]
+        if start_date:
+            conditions.append('r.date >= %s')
+            params.append(start_date)
+        if end_date:
+            conditions.append('r.date <= %s')
+            params.append(end_date)
+        if warehouse_id:
+            conditions.append('z.warehouse_id = %s')
+            params.append(warehouse_id)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
         query += ' ORDER BY r.date, r.doc_number, z.name;'
-        cur.execute(query, params)
-        requirements = cur.fetchall()
-        cur.close()
-        conn.close()
+        requirements = LazyRows(lambda: fetch_sharded(query, params, operator.itemgetter(0, 1, 2), warehouse_id))
         return render_template(
             'requirements/list.html',
             requirements=requirements,
             start_date=start_date,
-            end_date=end_date
+            end_date=end_date,
+            warehouse_id=warehouse_id,
+            warehouses=warehouse_choices()
         )
     except Exception as e:
         flash(f'Ошибка при загрузке потребности: {e}', 'error')
         return redirect(url_for('index'))
 
 # === CRUD: Справочник нормативов (A5) ===
-@app.route('/norms')
+@route('/norms')
+@cached_page('norms', 'clients', 'products')
 def norm_list():
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''
         SELECT
             n.norm_id,
-            c.name AS client_name,
-            p.name AS sku_name,
+            COALESCE(c.name, 'Все клиенты') AS client_name,
+            COALESCE(p.name, 'Все товары') AS sku_name,
             n.operation_type,
             n.zone_type,
             n.resource_subtype,
             n.unit_type,
             n.norm_value
         FROM norms n
-        JOIN clients c ON n.client_id = c.client_id
-        JOIN products p ON n.sku_id = p.sku_id
-        ORDER BY c.name, p.name;
+        LEFT JOIN clients c ON n.client_id = c.client_id
+        LEFT JOIN products p ON n.sku_id = p.sku_id
+        ORDER BY c.name NULLS FIRST, p.name NULLS FIRST;
     ''')
     norms = cur.fetchall()
     cur.close()
     conn.close()
     return render_template('norms/list.html', norms=norms)
 
-@app.route('/norms/create', methods=('GET', 'POST'))
+@route('/norms/create', methods=('GET', 'POST'))
 def norm_create():
     conn = get_db_connection()
     cur = conn.cursor()
@@ -829,16 +2392,29 @@ def norm_create():
         resource_subtype = request.form.get('resource_subtype')
         unit_type = request.form.get('unit_type')
         norm_val = request.form.get('norm_value')
-        if not all([client_id, sku_id, op_type, zone_type, resource_subtype, unit_type, norm_val]):
-            flash('Все поля обязательны!', 'error')
+        # Без товара — умолчание клиента, без клиента и товара — общее умолчание
+        client_id = client_id or None
+        sku_id = sku_id or None
+        if not all([op_type, zone_type, resource_subtype, unit_type, norm_val]):
+            flash('Заполните операцию, зону, ресурс, единицу измерения и норму!', 'error')
+        elif sku_id and not client_id:
+            flash('Для норматива по товару укажите клиента!', 'error')
         else:
             try:
+                ensure_subtypes({resource_subtype: None})
                 cur.execute('''
                     INSERT INTO norms (
                         client_id, sku_id, operation_type, zone_type,
                         resource_subtype, unit_type, norm_value
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s);
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING norm_id;
                 ''', (client_id, sku_id, op_type, zone_type, resource_subtype, unit_type, norm_val))
+                norm_id = cur.fetchone()[0]
+                # Баланс считается по снимкам потребности: норматив меняет его только после пересъёмки
+                record_capacity_event(
+                    cur, 'norm', 'create', norm_id,
+                    payload=_norm_payload(client_id, sku_id, op_type, zone_type, resource_subtype, unit_type, norm_val)
+                )
+                replicate_reference(cur, 'norms', [norm_id])
                 conn.commit()
                 flash('Норматив добавлен!', 'success')
                 return redirect(url_for('norm_list'))
@@ -850,9 +2426,15 @@ def norm_create():
                 flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
-    return render_template('norms/create.html', clients=clients, products=products)
+    return render_template(
+        'norms/create.html',
+        clients=clients,
+        products=products,
+        subtypes=subtype_catalog.by_category(),
+        categories=RESOURCE_CATEGORIES
+    )
 
-@app.route('/norms/edit/<int:id>', methods=('GET', 'POST'))
+@route('/norms/edit/<int:id>', methods=('GET', 'POST'))
 def norm_edit(id):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -877,16 +2459,27 @@ def norm_edit(id):
         resource_subtype = request.form.get('resource_subtype')
         unit_type = request.form.get('unit_type')
         norm_val = request.form.get('norm_value')
-        if not all([client_id, sku_id, op_type, zone_type, resource_subtype, unit_type, norm_val]):
-            flash('Все поля обязательны!', 'error')
+        # Без товара — умолчание клиента, без клиента и товара — общее умолчание
+        client_id = client_id or None
+        sku_id = sku_id or None
+        if not all([op_type, zone_type, resource_subtype, unit_type, norm_val]):
+            flash('Заполните операцию, зону, ресурс, единицу измерения и норму!', 'error')
+        elif sku_id and not client_id:
+            flash('Для норматива по товару укажите клиента!', 'error')
         else:
             try:
+                ensure_subtypes({resource_subtype: None})
                 cur.execute('''
                     UPDATE norms
                     SET client_id = %s, sku_id = %s, operation_type = %s, zone_type = %s,
                         resource_subtype = %s, unit_type = %s, norm_value = %s
                     WHERE norm_id = %s;
                 ''', (client_id, sku_id, op_type, zone_type, resource_subtype, unit_type, norm_val, id))
+                record_capacity_event(
+                    cur, 'norm', 'edit', id,
+                    payload=_norm_payload(client_id, sku_id, op_type, zone_type, resource_subtype, unit_type, norm_val)
+                )
+                replicate_reference(cur, 'norms', [id])
                 conn.commit()
                 flash('Норматив обновлён!', 'success')
                 return redirect(url_for('norm_list'))
@@ -898,32 +2491,81 @@ def norm_edit(id):
                 flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
-    return render_template('norms/edit.html', norm=norm, clients=clients, products=products)
+    return render_template(
+        'norms/edit.html',
+        norm=norm,
+        clients=clients,
+        products=products,
+        subtypes=subtype_catalog.by_category(),
+        categories=RESOURCE_CATEGORIES
+    )
 
-@app.route('/norms/delete/<int:id>', methods=('GET', 'POST'))
+@route('/norms/delete/<int:id>', methods=('GET', 'POST'))
 def norm_delete(id):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT operation_type, zone_type, resource_subtype FROM norms WHERE norm_id = %s;', (id,))
+    cur.execute('''
+        SELECT operation_type, zone_type, resource_subtype, client_id, sku_id, unit_type, norm_value
+        FROM norms WHERE norm_id = %s;
+    ''', (id,))
     norm = cur.fetchone()
     if not norm:
         flash('Норматив не найден.', 'error')
         return redirect(url_for('norm_list'))
     if request.method == 'POST':
-        cur.execute('DELETE FROM norms WHERE norm_id = %s;', (id,))
-        conn.commit()
-        flash('Норматив удалён.', 'success')
-        return redirect(url_for('norm_list'))
+        try:
+            cur.execute('DELETE FROM norms WHERE norm_id = %s;', (id,))
+            record_capacity_event(
+                cur, 'norm', 'delete', id,
+                payload=_norm_payload(norm[3], norm[4], norm[0], norm[1], norm[2], norm[5], norm[6])
+            )
+            replicate_reference(cur, 'norms', [id])
+            conn.commit()
+            flash('Норматив удалён.', 'success')
+            return redirect(url_for('norm_list'))
+        except Exception as e:
+            conn.rollback()
+            flash(f'Ошибка при удалении: {e}', 'error')
     cur.close()
     conn.close()
     op_desc = f"{norm[0]} / {norm[1]} / {norm[2]}"
     return render_template('norms/delete.html', description=op_desc)
 
-@app.route('/capacities')
+@route('/norms/coverage')
+def norm_coverage():
+    """Строки поступлений, посчитанные по нормативам-умолчаниям или без норматива"""
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    query = '''
+        SELECT date, doc_number, client_name, sku_name, unit_type, norm_level
+        FROM v_norm_coverage
+    '''
+    params = []
+    if start_date and end_date:
+        query += ' WHERE date BETWEEN %s AND %s'
+        params = [start_date, end_date]
+    elif start_date:
+        query += ' WHERE date >= %s'
+        params = [start_date]
+    elif end_date:
+        query += ' WHERE date <= %s'
+        params = [end_date]
+    query += ' ORDER BY norm_level NULLS FIRST, date, doc_number;'
+    lines = fetch_sharded(query, params, lambda row: (row[5] is not None, row[5] or '', row[0], row[1]))
+    counts = {'missing': 0, 'client': 0, 'global': 0}
+    for line in lines:
+        counts[line[5] or 'missing'] += 1
+    return render_template(
+        'norms/coverage.html',
+        lines=lines,
+        counts=counts,
+        start_date=start_date,
+        end_date=end_date
+    )
+
+@route('/capacities')
 def capacity_list():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
+    capacities = fetch_sharded('''
         SELECT
             ac.capacity_id,
             r.name AS resource_name,
@@ -933,345 +2575,2885 @@ def capacity_list():
         FROM available_capacities ac
         JOIN resources r ON ac.resource_id = r.resource_id
         ORDER BY ac.date DESC, r.name;
-    ''')
-    capacities = cur.fetchall()
+    ''', (), lambda row: (-row[3].toordinal(), row[1]), readonly=False)
+    return render_template('capacities/list.html', capacities=capacities)
+
+@route('/capacities/create', methods=('GET', 'POST'))
+def capacity_create():
+    # Доступность пишется на шард своего ресурса
+    conn = get_db_connection(shard=locate_shard('resources', 'resource_id', request.form.get('resource_id')))
+    cur = conn.cursor()
+    resources = resource_choices()
+    if request.method == 'POST':
+        resource_id = request.form.get('resource_id')
+        date = request.form.get('date')
+        hours = request.form.get('available_hours')
+        if not (resource_id and date and hours):
+            flash('Все поля обязательны!', 'error')
+        else:
+            try:
+                require_partition(cur, 'available_capacities', date)
+                cur.execute('''
+                    INSERT INTO available_capacities (resource_id, date, available_hours)
+                    VALUES (%s, %s, %s) RETURNING capacity_id;
+                ''', (resource_id, date, hours))
+                capacity_id = cur.fetchone()[0]
+                record_capacity_event(
+                    cur, 'capacity', 'create', capacity_id,
+                    after=_capacity_contribution(cur, 'capacity_id', capacity_id)
+                )
+                conn.commit()
+                flash('Доступность добавлена!', 'success')
+                return redirect(url_for('capacity_list'))
+            except psycopg2.errors.UniqueViolation:
+                flash('Для этого ресурса на эту дату уже задана доступность!', 'error')
+            except Exception as e:
+                flash(f'Ошибка: {e}', 'error')
     cur.close()
     conn.close()
-    return render_template('capacities/list.html', capacities=capacities)
+    return render_template('capacities/create.html', resources=resources)
+
+@route('/capacities/edit/<int:id>', methods=('GET', 'POST'))
+def capacity_edit(id):
+    shard = locate_shard('available_capacities', 'capacity_id', id)
+    conn = get_db_connection(shard=shard)
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT capacity_id, resource_id, date, available_hours
+        FROM available_capacities
+        WHERE capacity_id = %s;
+    ''', (id,))
+    capacity = cur.fetchone()
+    if not capacity:
+        flash('Запись не найдена.', 'error')
+        return redirect(url_for('capacity_list'))
+    resources = resource_choices()
+    if request.method == 'POST':
+        resource_id = request.form.get('resource_id')
+        date = request.form.get('date')
+        hours = request.form.get('available_hours')
+        if not (resource_id and date and hours):
+            flash('Все поля обязательны!', 'error')
+        elif locate_shard('resources', 'resource_id', resource_id) != shard:
+            flash('Ресурс лежит на шарде другого склада: выберите ресурс того же склада.', 'error')
+        else:
+            try:
+                before = _capacity_contribution(cur, 'capacity_id', id)
+                require_partition(cur, 'available_capacities', date)
+                cur.execute('''
+                    UPDATE available_capacities
+                    SET resource_id = %s, date = %s, available_hours = %s
+                    WHERE capacity_id = %s;
+                ''', (resource_id, date, hours, id))
+                record_capacity_event(
+                    cur, 'capacity', 'edit', id, before, _capacity_contribution(cur, 'capacity_id', id)
+                )
+                conn.commit()
+                flash('Доступность обновлена!', 'success')
+                return redirect(url_for('capacity_list'))
+            except psycopg2.errors.UniqueViolation:
+                flash('Для этого ресурса на эту дату уже задана доступность!', 'error')
+            except Exception as e:
+                flash(f'Ошибка: {e}', 'error')
+    cur.close()
+    conn.close()
+    return render_template('capacities/edit.html', capacity=capacity, resources=resources)
+
+@route('/capacities/delete/<int:id>', methods=('GET', 'POST'))
+def capacity_delete(id):
+    conn = get_db_connection(shard=locate_shard('available_capacities', 'capacity_id', id))
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT ac.date, r.name AS resource_name
+        FROM available_capacities ac
+        JOIN resources r ON ac.resource_id = r.resource_id
+        WHERE ac.capacity_id = %s;
+    ''', (id,))
+    capacity = cur.fetchone()
+    if not capacity:
+        flash('Запись не найдена.', 'error')
+        return redirect(url_for('capacity_list'))
+    if request.method == 'POST':
+        try:
+            before = _capacity_contribution(cur, 'capacity_id', id)
+            cur.execute('DELETE FROM available_capacities WHERE capacity_id = %s;', (id,))
+            record_capacity_event(cur, 'capacity', 'delete', id, before)
+            conn.commit()
+            flash('Запись удалена.', 'success')
+            return redirect(url_for('capacity_list'))
+        except Exception as e:
+            flash(f'Ошибка при удалении: {e}', 'error')
+    cur.close()
+    conn.close()
+    return render_template('capacities/delete.html', date=capacity[0], resource_name=capacity[1])
+
+@route('/balance', methods=('GET', 'POST'))
+@cached_page('inbound_requirement_snapshots', 'outbound_requirement_snapshots',
+             'available_capacities', 'resources', 'zones', 'warehouses')
+def balance_view():
+    """Просмотр баланса мощностей (A12) с фильтром по дате и складу"""
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    as_of = request.args.get('as_of')
+    try:
+        query = '''
+            SELECT
+                date,
+                zone_name,
+                resource_subtype,
+                ROUND(required_hours, 2) AS required_hours,
+                ROUND(available_hours, 2) AS available_hours,
+                ROUND(balance, 2) AS balance
+        '''
+        conditions = []
+        params = []
+        if as_of:
+            # Баланс, каким он был на момент времени — по истории (sql/011_history.sql)
+            query += ' FROM capacity_balance_as_of(%s)'
+            params.append(as_of)
+        else:
+            query += ' FROM v_capacity_balance'
+        if start_date:
+            conditions.append('date >= %s')
+            params.append(start_date)
+        if end_date:
+            conditions.append('date <= %s')
+            params.append(end_date)
+        if warehouse_id:
+            conditions.append('warehouse_id = %s')
+            params.append(warehouse_id)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY date, zone_name, resource_subtype;'
+        # Поток событий — журнал шарда склада, без склада он есть только при одном шарде;
+        # исторический срез не обновляется
+        live_updates = not as_of and (len(shard_names()) == 1 or bool(warehouse_id))
+        events_url = None
+        if live_updates:
+            # Позиция журнала берётся до чтения баланса: всё до неё в странице уже учтено,
+            # остальное придёт потоком (запись между двумя чтениями может прийти повторно)
+            conn = get_db_connection(warehouse_id=warehouse_id)
+            cur = conn.cursor()
+            events_url = capacity_events_url(format_event_position(capacity_events_position(cur)), warehouse_id)
+            cur.close()
+            conn.close()
+        # Без склада — баланс всех шардов, слитый по дате
+        balance_data = LazyRows(
+            lambda: fetch_sharded(query, params, REPORT_MERGE_KEYS['balance'], warehouse_id)
+        )
+        return render_template(
+            'balance/list.html',
+            balance_data=balance_data,
+            start_date=start_date,
+            end_date=end_date,
+            warehouse_id=warehouse_id,
+            as_of=as_of,
+            warehouses=warehouse_choices(),
+            live_updates=live_updates,
+            events_url=events_url
+        )
+    except Exception as e:
+        flash(f'Ошибка при загрузке баланса: {e}', 'error')
+        return redirect(url_for('index'))
+
+# === Сравнение баланса: два периода или два момента времени ===
+# Как совмещаются дни сторон: номер дня от начала периода или день недели (ISO, 1 — понедельник)
+BALANCE_COMPARE_ALIGN = {
+    'offset': 'date - %s::date',
+    'weekday': 'EXTRACT(isodow FROM date)::int',
+}
+
+# Сколько строк CSV сравнения копится перед отправкой клиенту
+BALANCE_COMPARE_CHUNK_ROWS = 1000
+
+BALANCE_COMPARE_COLUMNS = [
+    'slot', 'base_date', 'compare_date', 'warehouse_id', 'zone', 'resource_subtype',
+    'base_required', 'base_available', 'base_balance',
+    'compare_required', 'compare_available', 'compare_balance',
+    'delta_required', 'delta_available', 'delta_balance',
+    'pct_required', 'pct_available', 'pct_balance',
+]
+
+BALANCE_COMPARE_HEADERS = [
+    'День', 'Дата (база)', 'Дата (сравнение)', 'Склад', 'Зона', 'Ресурс',
+    'Требуемо, ч (база)', 'Доступно, ч (база)', 'Баланс, ч (база)',
+    'Требуемо, ч (сравнение)', 'Доступно, ч (сравнение)', 'Баланс, ч (сравнение)',
+    'Δ требуемо, ч', 'Δ доступно, ч', 'Δ баланс, ч', 'Δ требуемо, %', 'Δ доступно, %', 'Δ баланс, %',
+]
+
+
+def _compare_side(prefix, default=None):
+    """Сторона сравнения из параметров prefix_from, prefix_to, prefix_as_of:
+    {'from', 'to', 'as_of'}; период по умолчанию — как у default"""
+    side = {'as_of': request.args.get(f'{prefix}_as_of') or None}
+    if side['as_of']:
+        # Проверяем до запроса: ответ потоковый, и ошибка PostgreSQL в нём уже не станет 400
+        try:
+            datetime.fromisoformat(side['as_of'])
+        except ValueError:
+            raise ValueError(f'{prefix}_as_of: ожидается дата и время ГГГГ-ММ-ДДTЧЧ:ММ') from None
+    for bound in ('from', 'to'):
+        value = request.args.get(f'{prefix}_{bound}')
+        if value:
+            try:
+                side[bound] = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                raise ValueError(f'{prefix}_{bound}: ожидается дата ГГГГ-ММ-ДД') from None
+        elif default:
+            side[bound] = default[bound]
+        else:
+            raise ValueError(f'Укажите {prefix}_{bound} (ГГГГ-ММ-ДД)')
+    if side['from'] > side['to']:
+        raise ValueError(f'{prefix}_from позже {prefix}_to')
+    return side
+
+
+def _compare_cells(side, align, warehouse_id):
+    """Ячейки одной стороны, сложенные по (день, склад, зона, подтип): (SQL, параметры)"""
+    params = [side['from']] if align == 'offset' else []
+    if side['as_of']:
+        # Сценарий «на момент» — баланс по истории (sql/011_history.sql)
+        source = 'capacity_balance_as_of(%s::timestamptz)'
+        params.append(side['as_of'])
+    else:
+        source = 'v_capacity_balance'
+    conditions = ['date BETWEEN %s AND %s']
+    params += [side['from'], side['to']]
+    if warehouse_id:
+        conditions.append('warehouse_id = %s')
+        params.append(warehouse_id)
+    return f'''
+        SELECT {BALANCE_COMPARE_ALIGN[align]} AS slot, COALESCE(warehouse_id, 0) AS warehouse_id,
+               zone_name, resource_subtype, SUM(required_hours) AS required,
+               SUM(available_hours) AS available, SUM(balance) AS balance
+        FROM {source}
+        WHERE {' AND '.join(conditions)}
+        GROUP BY 1, 2, 3, 4
+    ''', params
+
+
+def _percent_change(base, compare):
+    return round((compare - base) / abs(base) * 100, 1) if base else None
+
+
+def compare_balance(base, compare, align='offset', warehouse_id=None):
+    """Строки сравнения (BALANCE_COMPARE_COLUMNS) в порядке дня, склада, зоны и подтипа.
+
+    Стороны совмещаются на каждом шарде одним запросом — FULL JOIN двух сгруппированных
+    балансов, — а строки шардов сливаются серверными курсорами. В памяти одновременно
+    только текущие строки, а не оба результата целиком; ячейка, которой нет на одной
+    из сторон, считается там нулевой."""
+    base_sql, base_params = _compare_cells(base, align, warehouse_id)
+    compare_sql, compare_params = _compare_cells(compare, align, warehouse_id)
+    query = f'''
+        WITH base AS ({base_sql}), compare AS ({compare_sql})
+        SELECT slot, warehouse_id, zone_name, resource_subtype,
+               b.required::float8, b.available::float8, b.balance::float8,
+               c.required::float8, c.available::float8, c.balance::float8
+        FROM base b
+        FULL JOIN compare c USING (slot, warehouse_id, zone_name, resource_subtype)
+        ORDER BY slot, warehouse_id, zone_name, resource_subtype;
+    '''
+    rows = iter_shards(query, base_params + compare_params, operator.itemgetter(0, 1, 2, 3), warehouse_id)
+    for slot, warehouse, zone, subtype, *hours in rows:
+        base_hours = [round(value or 0, 2) for value in hours[:3]]
+        compare_hours = [round(value or 0, 2) for value in hours[3:]]
+        yield [
+            slot,
+            base['from'] + timedelta(days=slot) if align == 'offset' else None,
+            compare['from'] + timedelta(days=slot) if align == 'offset' else None,
+            warehouse or None, zone, subtype,
+            *base_hours, *compare_hours,
+            *(round(c - b, 2) for b, c in zip(base_hours, compare_hours)),
+            *(_percent_change(b, c) for b, c in zip(base_hours, compare_hours)),
+        ]
+
+
+@route('/api/balance/compare')
+def api_balance_compare():
+    """Сравнение баланса двух сторон: периоды base_from/base_to и compare_from/compare_to
+    (по умолчанию — период базы) и, для сценариев «на момент», base_as_of / compare_as_of.
+
+    align=offset совмещает дни по номеру от начала периода, align=weekday — по дню
+    недели (несколько недель складываются). format=csv — файл для Excel, иначе JSON;
+    строки отдаются потоком по мере слияния шардов."""
+    align = request.args.get('align', 'offset')
+    if align not in BALANCE_COMPARE_ALIGN:
+        return jsonify({'error': f'Неизвестное совмещение: {align} (offset или weekday)'}), 400
+    try:
+        base = _compare_side('base')
+        compare = _compare_side('compare', base)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    rows = compare_balance(base, compare, align, warehouse_id)
+    try:
+        # Первая пачка читается до ответа: ошибки запроса ещё можно вернуть статусом
+        first = list(itertools.islice(rows, 1))
+    except psycopg2.DataError as e:
+        return jsonify({'error': (e.pgerror or str(e)).strip()}), 400
+    except psycopg2.Error as e:
+        logger.exception('Сравнение баланса не построено')
+        return jsonify({'error': f'Ошибка при сравнении баланса: {e}'}), 500
+    rows = itertools.chain(first, rows)
+
+    if request.args.get('format') == 'csv':
+        def stream_csv():
+            output = StringIO()
+            writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+            # BOM — чтобы Excel открыл UTF-8
+            output.write('\ufeff')
+            writer.writerow(BALANCE_COMPARE_HEADERS)
+            for count, row in enumerate(rows, 1):
+                writer.writerow(row)
+                if count % BALANCE_COMPARE_CHUNK_ROWS == 0:
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate()
+            yield output.getvalue()
+
+        response = Response(stream_with_context(stream_csv()), mimetype='text/csv')
+        response.headers['Content-Disposition'] = (
+            f"attachment; filename=balance_compare_{base['from']}_{compare['from']}_{align}.csv"
+        )
+        return response
+
+    def stream_json():
+        totals = {'base': [0.0] * 3, 'compare': [0.0] * 3}
+        head = {'align': align, 'base': base, 'compare': compare, 'columns': BALANCE_COMPARE_COLUMNS}
+        # Объект заголовка без закрывающей скобки: строки пишутся следом, по одной
+        yield json.dumps(head, ensure_ascii=False, default=str)[:-1] + ', "rows": ['
+        for count, row in enumerate(rows):
+            for i in range(3):
+                totals['base'][i] += row[6 + i]
+                totals['compare'][i] += row[9 + i]
+            yield (',' if count else '') + json.dumps(row, ensure_ascii=False, default=str)
+        summary = {}
+        for i, name in enumerate(('required', 'available', 'balance')):
+            b, c = round(totals['base'][i], 2), round(totals['compare'][i], 2)
+            summary[name] = {'base': b, 'compare': c, 'delta': round(c - b, 2), 'pct': _percent_change(b, c)}
+        yield '], "totals": ' + json.dumps(summary) + '}'
+
+    return Response(stream_with_context(stream_json()), mimetype='application/json')
+
+# === Баланс в колонках: отчёты, рекомендации, выгрузка ===
+# Даты в колонках — дни от 1970-01-01, как date32 в Arrow
+EPOCH = datetime(1970, 1, 1).date()
+
+
+class BalanceColumns:
+    """Ячейки баланса (дата, зона, подтип) в типизированных массивах.
+
+    Зона и подтип хранятся кодами словарей, часы — массивами double, дата — числом дней.
+    Строка занимает ~36 байт вместо кортежа из даты, двух строк и трёх Decimal;
+    объекты строк создаются только при обходе rows() и сразу освобождаются."""
+    __slots__ = (
+        'days', 'zone_codes', 'subtype_codes', 'required', 'available', 'balance',
+        'zones', 'subtypes', '_zone_index', '_subtype_index',
+    )
+
+    def __init__(self):
+        self.days = array('i')
+        self.zone_codes = array('i')
+        self.subtype_codes = array('i')
+        self.required = array('d')
+        self.available = array('d')
+        self.balance = array('d')
+        self.zones = []
+        self.subtypes = []
+        self._zone_index = {}
+        self._subtype_index = {}
+
+    def __len__(self):
+        return len(self.days)
+
+    def extend(self, rows):
+        """Дописывает строки (дни, зона, подтип, требуется, доступно, баланс) из курсора"""
+        zone_index, subtype_index = self._zone_index, self._subtype_index
+        for day, zone, subtype, required, available, balance in rows:
+            zone_code = zone_index.get(zone)
+            if zone_code is None:
+                zone_code = zone_index[zone] = len(self.zones)
+                self.zones.append(zone)
+            subtype_code = subtype_index.get(subtype)
+            if subtype_code is None:
+                subtype_code = subtype_index[subtype] = len(self.subtypes)
+                self.subtypes.append(subtype)
+            self.days.append(day)
+            self.zone_codes.append(zone_code)
+            self.subtype_codes.append(subtype_code)
+            self.required.append(required)
+            self.available.append(available)
+            self.balance.append(balance)
+
+    def date(self, i):
+        return EPOCH + timedelta(days=self.days[i])
+
+    def rows(self):
+        """Строки для предпросмотра и CSV, часы округлены до сотых"""
+        for i in range(len(self.days)):
+            yield (
+                self.date(i), self.zones[self.zone_codes[i]], self.subtypes[self.subtype_codes[i]],
+                f'{self.required[i]:.2f}', f'{self.available[i]:.2f}', f'{self.balance[i]:.2f}',
+            )
+
+    def record_batches(self, pa, schema, batch_size):
+        """Пачки Arrow поверх тех же массивов — без копирования по строкам"""
+        count = len(self.days)
+
+        def column(values, arrow_type):
+            return pa.Array.from_buffers(arrow_type, count, [None, pa.py_buffer(values)])
+
+        table = pa.RecordBatch.from_arrays([
+            column(self.days, pa.date32()),
+            pa.DictionaryArray.from_arrays(column(self.zone_codes, pa.int32()), pa.array(self.zones, pa.string())),
+            pa.DictionaryArray.from_arrays(
+                column(self.subtype_codes, pa.int32()), pa.array(self.subtypes, pa.string())
+            ),
+            column(self.required, pa.float64()),
+            column(self.available, pa.float64()),
+            column(self.balance, pa.float64()),
+        ], schema=schema)
+        for offset in range(0, count, batch_size):
+            yield table.slice(offset, batch_size)
+
+
+def fetch_balance_columns(conditions, params, warehouse_id=None):
+    """Баланс по условиям на v_capacity_balance в BalanceColumns, со всех шардов или со склада"""
+    query = '''
+        SELECT date - DATE '1970-01-01', zone_name, resource_subtype,
+               required_hours::float8, available_hours::float8, balance::float8
+        FROM v_capacity_balance
+    '''
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY date, zone_name, resource_subtype;'
+    columns = BalanceColumns()
+    columns.extend(iter_shards(query, params, REPORT_MERGE_KEYS['balance'], warehouse_id))
+    return columns
+
+# === Страница выбора отчёта ===
+@route('/reports')
+def report_select():
+    return render_template('reports/select.html')
+
+# === Формирование отчёта ===
+# Заголовки колонок CSV и предпросмотра по типу отчёта
+REPORT_HEADERS = {
+    'balance': ['Дата', 'Зона', 'Ресурс', 'Требуемо, ч', 'Доступно, ч', 'Баланс, ч'],
+    'load': ['Дата', 'Документ', 'Клиент', 'Товар', 'Кол-во', 'Ед.изм.'],
+    'requirement': ['Дата', 'Документ', 'Зона', 'Ресурс', 'Требуемо, ед.'],
+    'capacity': ['Дата', 'Ресурс', 'Подтип', 'Доступно, ч'],
+    'staffing': ['Дата', 'Мера', 'Склад', 'Зона', 'Ресурс', 'Сотрудник', 'Из зоны', 'Часы'],
+}
+
+RECOMMENDATION_HEADERS = [
+    'Дата', 'Зона', 'Ресурс', 'Баланс, ч', 'Тип', 'Рекомендация', 'Стоимость (минус — экономия), руб.',
+]
+
+
+def _report_route_class():
+    # Файл Parquet/Arrow и длинный период строятся выгрузкой, остальное — на странице
+    if (request.form.get('action') in COLUMNAR_FORMATS
+            or long_period(request.form.get('start_date'), request.form.get('end_date'))):
+        return 'export'
+    return 'heavy'
+
+
+@route('/reports/generate', methods=['POST'])
+@admission(_report_route_class, fallback='report_select')
+def generate_report():
+    report_type = request.form.get('report_type')
+    start_date = request.form.get('start_date')
+    end_date = request.form.get('end_date')
+    action = request.form.get('action')  # 'preview' или 'csv'
+
+    if not (report_type and start_date and end_date):
+        flash('Выберите тип отчёта и укажите период!', 'error')
+        return redirect(url_for('report_select'))
+
+    titles = {
+        'balance': 'Отчёт по балансу мощностей',
+        'load': 'Отчёт нагрузка за период',
+        'requirement': 'Отчёт потребность за период',
+        'capacity': 'Отчёт доступность за период',
+        'staffing': 'План смен по дефициту персонала'
+    }
+    title = titles.get(report_type, 'Отчёт')
+
+    # Колоночная выгрузка читает данные сама — серверным курсором, пачками
+    if action in COLUMNAR_FORMATS:
+        try:
+            return export_report_columnar(report_type, start_date, end_date, action)
+        except Exception as e:
+            flash(f'Ошибка при выгрузке отчёта: {e}', 'error')
+            return redirect(url_for('report_select'))
+
+    # Длинный период не собирается в памяти для страницы — отдаём CSV, записанный на диск
+    if long_period(start_date, end_date):
+        metrics.inc('admission_routed_total', endpoint='generate_report')
+        try:
+            return export_report_csv(report_type, start_date, end_date)
+        except Exception as e:
+            flash(f'Ошибка при выгрузке отчёта: {e}', 'error')
+            return redirect(url_for('report_select'))
+
+    data = []
+    headers = []
+    try:
+        # Отчёт сводный по всем складам: строки шардов сливаются по дате
+        key = REPORT_MERGE_KEYS.get(report_type)
+        if report_type == 'balance':
+            data = fetch_balance_columns(['date BETWEEN %s AND %s'], (start_date, end_date)).rows()
+            headers = REPORT_HEADERS['balance']
+        elif report_type == 'load':
+            raw_data = fetch_sharded('''
+                SELECT d.doc_date, d.doc_number, c.name, p.name, i.qty, i.unit_type
+                FROM inbound_documents d
+                JOIN inbound_items i ON d.doc_id = i.doc_id
+                JOIN clients c ON d.client_id = c.client_id
+                JOIN products p ON i.sku_id = p.sku_id
+                WHERE d.doc_date BETWEEN %s AND %s AND d.validated = TRUE
+                ORDER BY d.doc_date, d.doc_number;
+            ''', (start_date, end_date), key)
+            data = [(row[0], row[1], row[2], row[3], round(row[4], 2), row[5]) for row in raw_data]
+            headers = REPORT_HEADERS['load']
+        elif report_type == 'requirement':
+            raw_data = fetch_sharded('''
+                SELECT date, doc_number, zone_name, resource_type, required_units
+                FROM v_resource_requirements r
+                JOIN zones z ON r.zone_id = z.zone_id
+                WHERE date BETWEEN %s AND %s
+                ORDER BY date, doc_number;
+            ''', (start_date, end_date), key)
+            data = [(row[0], row[1], row[2], row[3], round(row[4], 2)) for row in raw_data]
+            headers = REPORT_HEADERS['requirement']
+        elif report_type == 'capacity':
+            raw_data = fetch_sharded('''
+                SELECT ac.date, r.name, r.subtype, ac.available_hours
+                FROM available_capacities ac
+                JOIN resources r ON ac.resource_id = r.resource_id
+                WHERE ac.date BETWEEN %s AND %s
+                ORDER BY ac.date, r.name;
+            ''', (start_date, end_date), key)
+            data = [(row[0], row[1], row[2], round(row[3], 2)) for row in raw_data]
+            headers = REPORT_HEADERS['capacity']
+        elif report_type == 'staffing':
+            data = fetch_staffing_plan(start_date, end_date)
+            headers = REPORT_HEADERS['staffing']
+    except Exception as e:
+        flash(f'Ошибка при формировании отчёта: {e}', 'error')
+        return redirect(url_for('report_select'))
+
+    # === Обработка действий ===
+    if action == 'csv':
+        output = StringIO()
+        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(headers)
+        for row in data:
+            writer.writerow(row)
+        output.seek(0)
+        response = make_response(output.getvalue())
+        response.headers['Content-Type'] = 'text/csv; charset=utf-8-sig'
+        response.headers['Content-Disposition'] = f'attachment; filename=report_{report_type}_{start_date}_{end_date}.csv'
+        return response
+    else:  # preview
+        return render_template('reports/preview.html', title=title, headers=headers, data=data, start_date=start_date, end_date=end_date)
+
+# === Колоночный экспорт отчётов (Parquet / Arrow IPC) ===
+# Форматы: action -> (расширение файла, MIME-тип)
+COLUMNAR_FORMATS = {
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+}
+
+# Размер пачки строк, читаемой из серверного курсора и записываемой одним RecordBatch
+EXPORT_BATCH_SIZE = 50000
+
+# Ключ слияния строк отчёта с разных шардов — колонки его ORDER BY
+REPORT_MERGE_KEYS = {
+    'balance': operator.itemgetter(0, 1, 2),
+    'load': operator.itemgetter(0, 1),
+    'requirement': operator.itemgetter(0, 1),
+    'capacity': operator.itemgetter(0, 1),
+}
+
+# Запросы для колоночной выгрузки: числа приводятся к float8 на стороне БД,
+# чтобы не создавать Decimal на каждую ячейку
+# (баланс выгружается из BalanceColumns)
+REPORT_EXPORT_QUERIES = {
+    'load': '''
+        SELECT d.doc_date, d.doc_number, c.name, p.name,
+               ROUND(i.qty, 2)::float8, i.unit_type
+        FROM inbound_documents d
+        JOIN inbound_items i ON d.doc_id = i.doc_id
+        JOIN clients c ON d.client_id = c.client_id
+        JOIN products p ON i.sku_id = p.sku_id
+        WHERE d.doc_date BETWEEN %s AND %s AND d.validated = TRUE
+        ORDER BY d.doc_date, d.doc_number;
+    ''',
+    'requirement': '''
+        SELECT date, doc_number, zone_name, resource_type,
+               ROUND(required_units, 2)::float8
+        FROM v_resource_requirements r
+        JOIN zones z ON r.zone_id = z.zone_id
+        WHERE date BETWEEN %s AND %s
+        ORDER BY date, doc_number;
+    ''',
+    'capacity': '''
+        SELECT ac.date, r.name, r.subtype,
+               ROUND(ac.available_hours, 2)::float8
+        FROM available_capacities ac
+        JOIN resources r ON ac.resource_id = r.resource_id
+        WHERE ac.date BETWEEN %s AND %s
+        ORDER BY ac.date, r.name;
+    ''',
+}
+
+# Схемы колонок: (имя, тип). Строки с малым числом значений — словарные
+REPORT_EXPORT_COLUMNS = {
+    'balance': [
+        ('date', 'date'), ('zone', 'dict'), ('resource_subtype', 'dict'),
+        ('required_hours', 'float'), ('available_hours', 'float'), ('balance', 'float'),
+    ],
+    'load': [
+        ('date', 'date'), ('doc_number', 'string'), ('client', 'dict'),
+        ('product', 'string'), ('qty', 'float'), ('unit_type', 'dict'),
+    ],
+    'requirement': [
+        ('date', 'date'), ('doc_number', 'string'), ('zone', 'dict'),
+        ('resource_type', 'dict'), ('required_units', 'float'),
+    ],
+    'capacity': [
+        ('date', 'date'), ('resource', 'string'), ('resource_subtype', 'dict'),
+        ('available_hours', 'float'),
+    ],
+    'staffing': [
+        ('date', 'date'), ('action', 'dict'), ('warehouse', 'dict'), ('zone', 'dict'),
+        ('resource_subtype', 'dict'), ('employee', 'string'), ('from_zone', 'dict'), ('hours', 'float'),
+    ],
+}
+
+
+class _DictionaryEncoder:
+    """Словарь колонки, общий для всех пачек файла: новые значения только дописываются,
+    поэтому Arrow IPC пишет дельты словаря, а не его замену"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, pa, column):
+        codes = self.codes
+        indices = []
+        for value in column:
+            if value is None:
+                indices.append(None)
+                continue
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(self.values)
+                self.values.append(value)
+            indices.append(code)
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, type=pa.int32()), pa.array(self.values, type=pa.string())
+        )
+
+
+def _arrow_schema(pa, columns):
+    types = {
+        'date': pa.date32(),
+        'float': pa.float64(),
+        'string': pa.string(),
+        'dict': pa.dictionary(pa.int32(), pa.string()),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def _export_row_batches(pa, schema, rows_iter):
+    """Пачки Arrow из потока строк: по EXPORT_BATCH_SIZE строк"""
+    encoders = {
+        i: _DictionaryEncoder()
+        for i, field in enumerate(schema) if pa.types.is_dictionary(field.type)
+    }
+    try:
+        while True:
+            rows = list(itertools.islice(rows_iter, EXPORT_BATCH_SIZE))
+            if not rows:
+                return
+            arrays = [
+                encoders[i].encode(pa, column) if i in encoders
+                else pa.array(column, type=field.type)
+                for i, (column, field) in enumerate(zip(zip(*rows), schema))
+            ]
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+    finally:
+        rows_iter.close()
+
+
+def export_report_columnar(report_type, start_date, end_date, fmt):
+    """Выгрузка отчёта в Parquet или Arrow IPC пачками из серверных курсоров шардов"""
+    if report_type not in REPORT_EXPORT_COLUMNS:
+        raise ValueError(f'неизвестный тип отчёта: {report_type}')
+    # pyarrow нужен только для этой выгрузки — не грузим его при старте
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(pa, REPORT_EXPORT_COLUMNS[report_type])
+    if report_type == 'balance':
+        # Баланс уже в колонках: пачки Arrow ссылаются на его массивы
+        balance = fetch_balance_columns(['date BETWEEN %s AND %s'], (start_date, end_date))
+        batches = balance.record_batches(pa, schema, EXPORT_BATCH_SIZE)
+    elif report_type == 'staffing':
+        # План строится в памяти целиком — выгружается теми же пачками
+        batches = _export_row_batches(pa, schema, (row for row in fetch_staffing_plan(start_date, end_date)))
+    else:
+        # Строки всех шардов: серверные курсоры, пачки, слияние по дате
+        batches = _export_row_batches(pa, schema, iter_shards(
+            REPORT_EXPORT_QUERIES[report_type], (start_date, end_date), REPORT_MERGE_KEYS[report_type]
+        ))
+    sink = None
+    try:
+        # Файл собирается на диске: в памяти держится не больше одной пачки.
+        # Открывается после запросов, которые могут упасть, и закрывается при любой ошибке
+        sink = tempfile.TemporaryFile()
+        if fmt == 'parquet':
+            writer = pq.ParquetWriter(sink, schema, compression='zstd')
+        else:
+            # Несжатый IPC-файл читается через memory map без копирования
+            writer = pa.ipc.new_file(
+                sink, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            )
+        with writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    except Exception:
+        if sink is not None:
+            sink.close()
+        raise
+    finally:
+        batches.close()
+
+    extension, mimetype = COLUMNAR_FORMATS[fmt]
+    sink.seek(0)
+    return send_file(
+        sink,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f'report_{report_type}_{start_date}_{end_date}.{extension}'
+    )
+
+# Сколько часов дефицита в день могут закрыть сверхурочные своих ресурсов; остальное — аренда
+RECOMMENDATION_OVERTIME_HOURS = float(os.getenv('RECOMMENDATION_OVERTIME_HOURS', 2.0))
+
+# Меры при дефиците: категория -> {мера: (текст, колонка стоимости часа в справочнике)}
+DEFICIT_MEASURES = {
+    'staff': {
+        'overtime': ('Привлечь сверхурочные часы для текущего сотрудника', 'overtime_cost_per_hour'),
+        'rent': ('Назначить дополнительного (временного) сотрудника на смену', 'rental_cost_per_hour'),
+    },
+    'equipment': {
+        'overtime': ('Продлить работу имеющейся техники сверх смены', 'overtime_cost_per_hour'),
+        'rent': ('Рассмотреть аренду дополнительной техники на пиковые дни', 'rental_cost_per_hour'),
+    },
+}
+
+
+def _deficit_measure(subtype, hours, day, today):
+    """Мера против дефицита hours часов в день day: (текст, стоимость или None).
+
+    Сверхурочные закрывают до RECOMMENDATION_OVERTIME_HOURS часов: если час сверхурочных
+    дешевле часа аренды, ими закрывается эта часть, а остаток — арендой; иначе арендой
+    закрывается весь дефицит. Аренда возможна, если её успеют заказать за
+    rental_lead_days. Пока стоимость часа не задана, мера выбирается по размеру
+    дефицита, как раньше."""
+    measures = DEFICIT_MEASURES[subtype['category']]
+    overtime_text, overtime_field = measures['overtime']
+    rent_text, rent_field = measures['rent']
+    overtime_cost, rent_cost = subtype[overtime_field], subtype[rent_field]
+    covered = min(hours, RECOMMENDATION_OVERTIME_HOURS)
+    rest = hours - covered
+    if (day - today).days < subtype['rental_lead_days']:
+        if not rest:
+            return overtime_text, None if overtime_cost is None else hours * overtime_cost
+        # Аренда не успевает, а сверхурочных мало — всё равно единственное, что можно сделать
+        return (f"{overtime_text} (аренду нужно заказывать за {subtype['rental_lead_days']} дн.)",
+                None if overtime_cost is None else hours * overtime_cost)
+    if overtime_cost is not None and rent_cost is not None:
+        use_overtime = overtime_cost <= rent_cost
+    else:
+        use_overtime = not rest and (overtime_cost is not None or rent_cost is None)
+    if not use_overtime:
+        return rent_text, None if rent_cost is None else hours * rent_cost
+    if not rest:
+        return overtime_text, None if overtime_cost is None else hours * overtime_cost
+    cost = None if rent_cost is None else covered * overtime_cost + rest * rent_cost
+    return (f"{overtime_text} ({round(covered, 2):g} ч), на остальные {round(rest, 2):g} ч — "
+            f"{rent_text[0].lower()}{rent_text[1:]}", cost)
+
+
+def generate_recommendations_from_balance(balance, subtypes=None, today=None):
+    """Рекомендации по ячейкам BalanceColumns; словари создаются только для выводимых ячеек.
+
+    Категория и стоимость часа подтипа берутся из справочника подтипов (subtype_catalog)."""
+    subtypes = subtype_catalog.get() if subtypes is None else subtypes
+    today = today or datetime.now().date()
+    # Подтип справочника — один раз на значение словаря BalanceColumns
+    known = [subtypes.get(name) for name in balance.subtypes]
+    recommendations = []
+    for i, value in enumerate(balance.balance):
+        subtype_code = balance.subtype_codes[i]
+        subtype = known[subtype_code]
+        cost = None
+        if value < 0:
+            if subtype is None or subtype['category'] is None:
+                rec_text = (f'Подтип «{balance.subtypes[subtype_code]}» без категории: '
+                            'задайте её и стоимость часа в справочнике подтипов')
+            else:
+                rec_text, cost = _deficit_measure(subtype, -value, balance.date(i), today)
+        elif value > 3.0:
+            rec_text = "Переназначить ресурс на другую зону или сократить смену"
+            if subtype is not None and subtype['cost_per_hour'] is not None:
+                cost = -value * subtype['cost_per_hour']
+        else:
+            continue
+        recommendations.append({
+            'date': balance.date(i),
+            'zone': balance.zones[balance.zone_codes[i]],
+            'resource': balance.subtypes[subtype_code],
+            'balance': round(value, 2),
+            'recommendation': rec_text,
+            'type': 'Дефицит' if value < 0 else 'Избыток',
+            'cost': None if cost is None else round(cost, 2),
+        })
+    return recommendations
+
+def _recommendations_route_class():
+    return 'export' if long_period(request.values.get('start_date'), request.values.get('end_date')) else 'heavy'
+
+
+@route('/recommendations', methods=['GET', 'POST'])
+@admission(_recommendations_route_class)
+def recommendations_view():
+    if request.method == 'POST':
+        start_date = request.form.get('start_date')
+        end_date = request.form.get('end_date')
+        action = request.form.get('action')
+    else:
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        action = None
+
+    if long_period(start_date, end_date):
+        metrics.inc('admission_routed_total', endpoint='recommendations_view')
+        try:
+            return export_recommendations_csv(start_date, end_date)
+        except Exception as e:
+            flash(f'Ошибка при выгрузке рекомендаций: {e}', 'error')
+            return redirect(url_for('index'))
+
+    try:
+        conditions = ['balance != 0']
+        params = []
+        if start_date:
+            conditions.append('date >= %s')
+            params.append(start_date)
+        if end_date:
+            conditions.append('date <= %s')
+            params.append(end_date)
+        # Рекомендации по всем складам: балансы шардов сливаются по дате
+        balance = fetch_balance_columns(conditions, params)
+        recommendations = generate_recommendations_from_balance(balance)
+
+        if action == 'csv':
+            output = StringIO()
+            writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(RECOMMENDATION_HEADERS)
+            for row in _recommendation_rows(recommendations):
+                writer.writerow(row)
+            output.seek(0)
+            response = make_response(output.getvalue())
+            response.headers['Content-Type'] = 'text/csv; charset=utf-8-sig'
+            response.headers['Content-Disposition'] = f'attachment; filename=recommendations_{start_date or "all"}_{end_date or "all"}.csv'
+            return response
+        else:
+            return render_template(
+                'recommendations/list.html',
+                recommendations=recommendations,
+                start_date=start_date,
+                end_date=end_date
+            )
+    except Exception as e:
+        flash(f'Ошибка при загрузке рекомендаций: {e}', 'error')
+        return redirect(url_for('index'))
+
+# === Пакет отчётов за период (ZIP) ===
+# Сколько отчётов пакета считается одновременно; каждый берёт соединения из пула шардов
+REPORT_BUNDLE_WORKERS = int(os.getenv('REPORT_BUNDLE_WORKERS', 4))
+
+# Порция копирования готового файла отчёта в архив
+REPORT_BUNDLE_CHUNK = 1024 * 1024
+
+
+def _csv_part(headers, rows):
+    """Отчёт в CSV во временном файле (UTF-8 с BOM — для Excel); строки пишутся по мере чтения"""
+    part = TextIOWrapper(tempfile.TemporaryFile(), encoding='utf-8-sig', newline='')
+    writer = csv.writer(part, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(headers)
+    for row in rows:
+        # Числа из REPORT_EXPORT_QUERIES приходят float8 — в файле, как и в CSV отчёта, сотые
+        writer.writerow([f'{value:.2f}' if isinstance(value, float) else value for value in row])
+    part.flush()
+    return part.detach()
+
+
+def _recommendation_rows(recommendations):
+    for rec in recommendations:
+        yield (rec['date'], rec['zone'], rec['resource'], rec['balance'], rec['type'], rec['recommendation'],
+               rec['cost'])
+
+
+def _bundle_balance(start_date, end_date):
+    """Баланс и рекомендации — из одного запроса баланса"""
+    balance = fetch_balance_columns(['date BETWEEN %s AND %s'], (start_date, end_date))
+    recommendations = _recommendation_rows(generate_recommendations_from_balance(balance))
+    return [
+        ('balance', _csv_part(REPORT_HEADERS['balance'], balance.rows())),
+        ('recommendations', _csv_part(RECOMMENDATION_HEADERS, recommendations)),
+    ]
+
+
+def _bundle_report(report_type, start_date, end_date):
+    rows = iter_shards(
+        REPORT_EXPORT_QUERIES[report_type], (start_date, end_date), REPORT_MERGE_KEYS[report_type]
+    )
+    return [(report_type, _csv_part(REPORT_HEADERS[report_type], rows))]
+
+
+def _send_csv_part(part, filename):
+    part.seek(0)
+    return send_file(part, mimetype='text/csv; charset=utf-8-sig', as_attachment=True, download_name=filename)
+
+
+def export_report_csv(report_type, start_date, end_date):
+    """Отчёт за длинный период: CSV пишется во временный файл по мере чтения серверных курсоров"""
+    if report_type == 'balance':
+        balance = fetch_balance_columns(['date BETWEEN %s AND %s'], (start_date, end_date))
+        part = _csv_part(REPORT_HEADERS['balance'], balance.rows())
+    elif report_type == 'staffing':
+        part = _csv_part(REPORT_HEADERS['staffing'], fetch_staffing_plan(start_date, end_date))
+    elif report_type in REPORT_EXPORT_QUERIES:
+        [(_, part)] = _bundle_report(report_type, start_date, end_date)
+    else:
+        raise ValueError(f'неизвестный тип отчёта: {report_type}')
+    return _send_csv_part(part, f'report_{report_type}_{start_date}_{end_date}.csv')
+
+
+def export_recommendations_csv(start_date, end_date):
+    """Рекомендации за длинный период — тем же CSV во временном файле"""
+    # Без границы период открыт с этой стороны (long_period)
+    conditions, params = ['balance != 0'], []
+    if start_date:
+        conditions.append('date >= %s')
+        params.append(start_date)
+    if end_date:
+        conditions.append('date <= %s')
+        params.append(end_date)
+    balance = fetch_balance_columns(conditions, params)
+    rows = _recommendation_rows(generate_recommendations_from_balance(balance))
+    return _send_csv_part(
+        _csv_part(RECOMMENDATION_HEADERS, rows),
+        f"recommendations_{start_date or 'all'}_{end_date or 'all'}.csv"
+    )
+
+
+def export_report_bundle(start_date, end_date):
+    """Все отчёты периода (баланс, нагрузка, потребность, доступность, рекомендации) одним ZIP.
+
+    Запросы отчётов идут параллельно в пуле потоков, каждый пишет свой CSV во временный
+    файл; готовые файлы по мере завершения дописываются в архив на диске. В памяти
+    держатся только пачки строк курсоров и колонки баланса."""
+    jobs = [functools.partial(_bundle_balance, start_date, end_date)] + [
+        functools.partial(_bundle_report, report_type, start_date, end_date)
+        for report_type in ('load', 'requirement', 'capacity')
+    ]
+    sink = tempfile.TemporaryFile()
+    executor = ThreadPoolExecutor(max_workers=REPORT_BUNDLE_WORKERS, thread_name_prefix='report-bundle')
+    # Копия контекста запроса — для read-your-writes при выборе реплики в потоках
+    futures = [executor.submit(copy_current_request_context(job)) for job in jobs]
+    try:
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+            for future in as_completed(futures):
+                for name, part in future.result():
+                    with part, bundle.open(f'{name}_{start_date}_{end_date}.csv', 'w') as entry:
+                        part.seek(0)
+                        shutil.copyfileobj(part, entry, REPORT_BUNDLE_CHUNK)
+    except Exception:
+        sink.close()
+        raise
+    finally:
+        executor.shutdown(cancel_futures=True)
+    sink.seek(0)
+    return send_file(
+        sink,
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name=f'reports_{start_date}_{end_date}.zip'
+    )
+
+
+@route('/reports/bundle', methods=['POST'])
+@admission('export', fallback='report_select')
+def report_bundle():
+    start_date = request.form.get('start_date')
+    end_date = request.form.get('end_date')
+    if not (start_date and end_date):
+        flash('Укажите период!', 'error')
+        return redirect(url_for('report_select'))
+    try:
+        return export_report_bundle(start_date, end_date)
+    except Exception as e:
+        flash(f'Ошибка при формировании пакета отчётов: {e}', 'error')
+        return redirect(url_for('report_select'))
+
+# === План смен: дефицит баланса -> сверхурочные, переводы, найм ===
+# Пределы рабочего времени одного сотрудника, ч: за день и за неделю (пн–вс)
+STAFFING_MAX_HOURS_PER_DAY = float(os.getenv('STAFFING_MAX_HOURS_PER_DAY', 12))
+STAFFING_MAX_HOURS_PER_WEEK = float(os.getenv('STAFFING_MAX_HOURS_PER_WEEK', 48))
+
+# Смена нового (временного) сотрудника, ч
+STAFFING_HIRE_SHIFT_HOURS = float(os.getenv('STAFFING_HIRE_SHIFT_HOURS', 8))
+
+STAFFING_MOVE = 'Перевод из другой зоны'
+STAFFING_OVERTIME = 'Сверхурочные'
+STAFFING_DAY_OFF = 'Выход в выходной'
+STAFFING_HIRE = 'Найм'
+
+
+def plan_staffing(balance_cells, staff_hours, staff_subtypes):
+    """Жадный план закрытия дефицита персонала.
+
+    balance_cells — (дата, склад, зона, подтип, баланс ч), staff_hours — (дата, склад,
+    resource_id, имя, подтип, зона, доступно ч), staff_subtypes — подтипы персонала.
+    Дефициты закрываются по датам, крупные первыми: сначала переводом простаивающих
+    сотрудников того же подтипа из зон склада с избытком, затем сверхурочными
+    работающих в этот день (своя зона первой), затем выходом свободных и наконец
+    наймом. Часы сотрудника не превышают дневной и недельный пределы; нанятые
+    повторно используются в следующие дни. Возвращает строки плана
+    (дата, мера, склад, зона, подтип, сотрудник, из зоны, часы)."""
+    names = {}
+    zone_of = {}
+    planned = collections.defaultdict(float)  # (сотрудник, дата) -> часы
+    weekly = collections.defaultdict(float)   # (сотрудник, понедельник) -> часы
+    team = collections.defaultdict(list)      # (склад, подтип) -> сотрудники
+    for date, warehouse_id, resource_id, name, subtype, zone, hours in staff_hours:
+        person = (warehouse_id, resource_id)
+        if person not in names:
+            names[person] = name
+            zone_of[person] = zone
+            team[warehouse_id, subtype].append(person)
+        planned[person, date] += hours
+        weekly[person, date - timedelta(days=date.weekday())] += hours
+
+    surplus = {}
+    deficits = []
+    for date, warehouse_id, zone, subtype, balance in balance_cells:
+        if subtype not in staff_subtypes:
+            continue
+        if balance > 0:
+            surplus[date, warehouse_id, zone, subtype] = balance
+        elif balance < 0:
+            deficits.append((date, -balance, warehouse_id, zone, subtype))
+    deficits.sort(key=lambda cell: (cell[0], -cell[1]))
+
+    lent = collections.defaultdict(float)  # (сотрудник, дата) -> часы, отданные другим зонам
+    hires = collections.defaultdict(list)  # (склад, подтип) -> нанятые
+    roster = []
+
+    def headroom(person, date, week, limit):
+        return min(limit - planned[person, date], STAFFING_MAX_HOURS_PER_WEEK - weekly[person, week])
+
+    for date, need, warehouse_id, zone, subtype in deficits:
+        week = date - timedelta(days=date.weekday())
+        members = team[warehouse_id, subtype]
+
+        # 1. Простаивающие часы зон с избытком — без роста часов сотрудника
+        idle = []
+        for person in members:
+            cell = (date, warehouse_id, zone_of[person], subtype)
+            if zone_of[person] != zone and surplus.get(cell, 0) > 0:
+                spare = min(planned[person, date] - lent[person, date], surplus[cell])
+                if spare > 0:
+                    idle.append((spare, person, cell))
+        idle.sort(key=lambda item: -item[0])
+        for spare, person, cell in idle:
+            if need <= 0:
+                break
+            hours = min(spare, need, surplus[cell])
+            if hours <= 0:
+                continue
+            surplus[cell] -= hours
+            lent[person, date] += hours
+            need -= hours
+            roster.append((date, STAFFING_MOVE, warehouse_id, zone, subtype, names[person], zone_of[person], hours))
+
+        # 2. Сверхурочные работающих сегодня, 3. выход свободных — больше запаса недели первыми
+        for working, action in ((True, STAFFING_OVERTIME), (False, STAFFING_DAY_OFF)):
+            if need <= 0:
+                break
+            candidates = []
+            for person in members:
+                if (planned[person, date] > 0) != working:
+                    continue
+                room = headroom(person, date, week, STAFFING_MAX_HOURS_PER_DAY)
+                if room > 0:
+                    candidates.append((zone_of[person] != zone, -room, person))
+            candidates.sort(key=lambda item: item[:2])
+            for _, room, person in candidates:
+                if need <= 0:
+                    break
+                hours = min(-room, need)
+                planned[person, date] += hours
+                weekly[person, week] += hours
+                need -= hours
+                roster.append((
+                    date, action, warehouse_id, zone, subtype, names[person],
+                    zone_of[person] if zone_of[person] != zone else None, hours
+                ))
+
+        # 4. Найм: сначала уже нанятые, у которых есть запас, затем новые
+        pool = hires[warehouse_id, subtype]
+        for person in pool:
+            if need <= 0:
+                break
+            hours = min(need, headroom(person, date, week, STAFFING_HIRE_SHIFT_HOURS))
+            if hours > 0:
+                planned[person, date] += hours
+                weekly[person, week] += hours
+                need -= hours
+                roster.append((date, STAFFING_HIRE, warehouse_id, zone, subtype, names[person], None, hours))
+        while need > 1e-9:
+            person = (warehouse_id, f'hire-{subtype}-{len(pool) + 1}')
+            names[person] = f'Новый сотрудник {len(pool) + 1} ({subtype})'
+            pool.append(person)
+            hours = min(need, STAFFING_HIRE_SHIFT_HOURS)
+            planned[person, date] += hours
+            weekly[person, week] += hours
+            need -= hours
+            roster.append((date, STAFFING_HIRE, warehouse_id, zone, subtype, names[person], None, hours))
+
+    roster.sort(key=lambda row: (row[0], row[2], row[3], row[4]))
+    return roster
+
+
+def fetch_staffing_plan(start_date, end_date):
+    """План смен за период по всем складам: строки отчёта с названиями складов и округлёнными часами"""
+    start = datetime.strptime(str(start_date), '%Y-%m-%d').date()
+    end = datetime.strptime(str(end_date), '%Y-%m-%d').date()
+    # Недельный предел считается по целым неделям: берём и дни до/после периода
+    week_start = start - timedelta(days=start.weekday())
+    week_end = end + timedelta(days=6 - end.weekday())
+    balance_cells = fetch_sharded('''
+        SELECT date, warehouse_id, zone_name, resource_subtype, balance::float8
+        FROM v_capacity_balance
+        WHERE date BETWEEN %s AND %s AND balance != 0
+        ORDER BY date, warehouse_id;
+    ''', (start, end), operator.itemgetter(0, 1))
+    staff_hours = fetch_sharded('''
+        SELECT ac.date, z.warehouse_id, r.resource_id, r.name, r.subtype, z.name, ac.available_hours::float8
+        FROM available_capacities ac
+        JOIN resources r ON ac.resource_id = r.resource_id
+        JOIN zones z ON r.zone_id = z.zone_id
+        WHERE r.type = 'staff' AND ac.date BETWEEN %s AND %s
+        ORDER BY ac.date, z.warehouse_id;
+    ''', (week_start, week_end), operator.itemgetter(0, 1))
+    staff_subtypes = {name for name, subtype in subtype_catalog.get().items() if subtype['category'] == 'staff'}
+    warehouses = dict(warehouse_choices())
+    return [
+        (date, action, warehouses.get(warehouse_id, warehouse_id), zone, subtype, employee, from_zone, round(hours, 2))
+        for date, action, warehouse_id, zone, subtype, employee, from_zone, hours
+        in plan_staffing(balance_cells, staff_hours, staff_subtypes)
+    ]
+
+
+# === Качество данных (sql/012_data_quality.sql) ===
+# Проверка -> название, пояснение, идёт ли по шардам складов (товары одинаковы на всех шардах),
+# колонки просмотра (ключ details, заголовок) и запрос находок
+# (scope_id, entity_id, day, details) с условием области {scope}
+DATA_QUALITY_CHECKS = {
+    'product_units': {
+        'title': 'Товары без кратности упаковки',
+        'description': 'Не заданы штуки в коробке или на паллете: коробки и паллеты не пересчитываются в штуки.',
+        'sharded': False,
+        'columns': [('sku', 'Товар'), ('client', 'Клиент'),
+                    ('units_per_box', 'Шт. в коробке'), ('units_per_pallet', 'Шт. на паллете')],
+        'scope': 'p.sku_id',
+        'sql': '''
+            SELECT p.sku_id, p.sku_id, NULL::date,
+                   jsonb_build_object('sku', p.name, 'client', c.name,
+                                      'units_per_box', p.units_per_box, 'units_per_pallet', p.units_per_pallet)
+            FROM products p
+            LEFT JOIN clients c ON c.client_id = p.client_id
+            WHERE (p.units_per_box IS NULL OR p.units_per_box <= 0
+                   OR p.units_per_pallet IS NULL OR p.units_per_pallet <= 0)
+              AND {scope}
+        ''',
+    },
+    'inbound_norm': {
+        'title': 'Строки поступлений без норматива',
+        'description': 'Ни на одном уровне нет нормы приёмки для товара и единицы: строка не попадает в потребность.',
+        'sharded': True,
+        'columns': [('doc_number', 'Документ'), ('client', 'Клиент'), ('sku', 'Товар'),
+                    ('qty', 'Количество'), ('unit_type', 'Ед.изм.')],
+        'scope': 'i.sku_id',
+        'sql': '''
+            SELECT i.sku_id, i.item_id, i.doc_date,
+                   jsonb_build_object('doc_number', d.doc_number, 'client', c.name, 'sku', p.name,
+                                      'qty', i.qty, 'unit_type', i.unit_type)
+            FROM inbound_items i
+            JOIN inbound_documents d ON d.doc_id = i.doc_id AND d.doc_date = i.doc_date
+            JOIN products p ON p.sku_id = i.sku_id
+            LEFT JOIN clients c ON c.client_id = d.client_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM norm_lookup nl
+                WHERE nl.sku_id = i.sku_id AND nl.operation_type = 'inbound' AND nl.unit_type = i.unit_type
+            ) AND {scope}
+        ''',
+    },
+    'capacity_gap': {
+        'title': 'Ресурсы без мощности в дни поступлений',
+        'description': 'В зоне есть потребность по подтипу, а у ресурса этого подтипа на этот день не введены часы.',
+        'sharded': True,
+        'columns': [('zone', 'Зона'), ('resource', 'Ресурс'), ('subtype', 'Подтип'),
+                    ('required_hours', 'Потребность, ч')],
+        'scope': 's.zone_id',
+        'day': 's.doc_date',
+        'sql': '''
+            SELECT s.zone_id, r.resource_id, s.doc_date,
+                   jsonb_build_object('zone', z.name, 'resource', r.name, 'subtype', r.subtype,
+                                      'required_hours', ROUND(SUM(s.required_hours), 2))
+            FROM inbound_requirement_snapshots s
+            JOIN zones z ON z.zone_id = s.zone_id
+            JOIN resources r ON r.zone_id = s.zone_id AND r.subtype_id = s.subtype_id
+            WHERE s.required_hours > 0
+              AND NOT EXISTS (
+                  SELECT 1 FROM available_capacities ac
+                  WHERE ac.resource_id = r.resource_id AND ac.date = s.doc_date
+              ) AND {scope}
+            GROUP BY s.zone_id, r.resource_id, s.doc_date, z.name, r.name, r.subtype
+        ''',
+    },
+    'zone_resources': {
+        'title': 'Зоны без ресурсов',
+        'description': 'К зоне не привязан ни один ресурс: её потребность нечем закрыть.',
+        'sharded': True,
+        'columns': [('zone', 'Зона'), ('zone_type', 'Тип'), ('warehouse', 'Склад')],
+        'scope': 'z.zone_id',
+        'sql': '''
+            SELECT z.zone_id, z.zone_id, NULL::date,
+                   jsonb_build_object('zone', z.name, 'zone_type', z.type, 'warehouse', w.name)
+            FROM zones z
+            LEFT JOIN warehouses w ON w.warehouse_id = z.warehouse_id
+            WHERE NOT EXISTS (SELECT 1 FROM resources r WHERE r.zone_id = z.zone_id) AND {scope}
+        ''',
+    },
+}
+DATA_QUALITY_PAGE_SIZE = 200
+
+metrics.describe('data_quality_scan_seconds_total', 'counter', 'Время прогонов проверок качества: check, mode')
+metrics.describe('data_quality_findings', 'gauge', 'Находки проверки качества после прогона: check, shard')
+
+
+def data_quality_checks(shard):
+    """Проверки, которые выполняются на шарде"""
+    return [name for name, check in DATA_QUALITY_CHECKS.items() if check['sharded'] or shard == DEFAULT_SHARD]
+
+
+def scan_data_quality_check(cur, name, full=False):
+    """Перепроверяет одну проверку в текущей транзакции: число находок после прогона или None,
+    если её уже прогоняет другой процесс.
+
+    Полный прогон ищет находки во всём наборе; обычный — только в областях
+    из очереди data_quality_dirty (товар или зона, с датой или за все дни)."""
+    check = DATA_QUALITY_CHECKS[name]
+    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('data_quality:' || %s));", (name,))
+    if not cur.fetchone()[0]:
+        return None
+    if full:
+        cur.execute('DELETE FROM data_quality_dirty WHERE check_name = %s;', (name,))
+        cur.execute('DELETE FROM data_quality_findings WHERE check_name = %s;', (name,))
+        scope = 'TRUE'
+    else:
+        cur.execute('''
+            CREATE TEMP TABLE data_quality_scope ON COMMIT DROP AS
+            WITH taken AS (
+                DELETE FROM data_quality_dirty WHERE check_name = %s RETURNING scope_id, day
+            )
+            SELECT DISTINCT scope_id, day FROM taken;
+        ''', (name,))
+        if not cur.rowcount:
+            cur.execute('DROP TABLE data_quality_scope;')
+            cur.execute('SELECT findings FROM data_quality_scans WHERE check_name = %s;', (name,))
+            row = cur.fetchone()
+            return row[0] if row else 0
+        # Временную таблицу автоочистка не анализирует, а без статистики планировщик ждёт от неё тысячи строк
+        cur.execute('ANALYZE data_quality_scope;')
+        # Область без даты перепроверяется за все дни
+        cur.execute('''
+            DELETE FROM data_quality_findings f USING data_quality_scope q
+            WHERE f.check_name = %s AND f.scope_id = q.scope_id AND (q.day IS NULL OR f.day = q.day);
+        ''', (name,))
+        if 'day' in check:
+            scope = f'''EXISTS (
+                SELECT 1 FROM data_quality_scope q
+                WHERE q.scope_id = {check['scope']} AND (q.day IS NULL OR q.day = {check['day']})
+            )'''
+        else:
+            scope = f"{check['scope']} IN (SELECT scope_id FROM data_quality_scope)"
+    cur.execute(f'''
+        INSERT INTO data_quality_findings (check_name, scope_id, entity_id, day, details)
+        SELECT %s, found.* FROM ({check['sql'].format(scope=scope)}) found
+        ON CONFLICT (check_name, entity_id, day)
+        DO UPDATE SET scope_id = EXCLUDED.scope_id, details = EXCLUDED.details, found_at = now();
+    ''', (name,))
+    if not full:
+        cur.execute('DROP TABLE data_quality_scope;')
+    # Счётчик для страницы: по индексу находок, без чтения самих строк
+    cur.execute('''
+        INSERT INTO data_quality_scans (check_name, findings, scanned_at, full_scan_at)
+        VALUES (%s, (SELECT COUNT(*) FROM data_quality_findings WHERE check_name = %s), now(),
+                CASE WHEN %s THEN now() END)
+        ON CONFLICT (check_name) DO UPDATE SET
+            findings = EXCLUDED.findings,
+            scanned_at = EXCLUDED.scanned_at,
+            full_scan_at = COALESCE(EXCLUDED.full_scan_at, data_quality_scans.full_scan_at)
+        RETURNING findings;
+    ''', (name, name, full))
+    return cur.fetchone()[0]
+
+
+def scan_data_quality(full=False, checks=None):
+    """Прогоняет проверки на всех шардах: {проверка: число находок}.
+
+    Каждая проверка шарда — своя транзакция. Очередь проверок, которые на шарде
+    не выполняются (товары — только на шарде по умолчанию), просто очищается."""
+    findings = collections.Counter()
+    for shard in shard_names():
+        own = data_quality_checks(shard)
+        conn = get_db_connection(shard=shard)
+        cur = conn.cursor()
+        try:
+            for name in checks or DATA_QUALITY_CHECKS:
+                if name not in own:
+                    cur.execute('DELETE FROM data_quality_dirty WHERE check_name = %s;', (name,))
+                    conn.commit()
+                    continue
+                started = time.perf_counter()
+                count = scan_data_quality_check(cur, name, full)
+                conn.commit()
+                metrics.inc('data_quality_scan_seconds_total', time.perf_counter() - started,
+                            check=name, mode='full' if full else 'incremental')
+                if count is None:
+                    logger.info('Проверку %s на шарде %s уже выполняет другой процесс', name, shard)
+                    continue
+                metrics.set('data_quality_findings', count, check=name, shard=shard)
+                findings[name] += count
+        finally:
+            cur.close()
+            conn.close()
+    return findings
+
+
+def data_quality_summary():
+    """Сводка проверок со всех шардов: находки, ожидающие перепроверки области и время прогонов"""
+    summary = {
+        name: {'findings': 0, 'pending': 0, 'scanned_at': None, 'full_scan_at': None}
+        for name in DATA_QUALITY_CHECKS
+    }
+    for shard in shard_names():
+        own = data_quality_checks(shard)
+        conn = get_db_connection(shard=shard, readonly=True)
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT check_name, findings, scanned_at, full_scan_at FROM data_quality_scans
+            WHERE check_name = ANY(%s);
+        ''', (own,))
+        for name, count, scanned_at, full_scan_at in cur.fetchall():
+            state = summary[name]
+            state['findings'] += count
+            # По шардам показываем самый старый прогон
+            for field, value in (('scanned_at', scanned_at), ('full_scan_at', full_scan_at)):
+                if state[field] is None or (value is not None and value < state[field]):
+                    state[field] = value
+        cur.execute('''
+            SELECT check_name, COUNT(*) FROM data_quality_dirty
+            WHERE check_name = ANY(%s) GROUP BY check_name;
+        ''', (own,))
+        for name, count in cur.fetchall():
+            summary[name]['pending'] += count
+        cur.close()
+        conn.close()
+    return summary
+
+
+# Фоновая перепроверка, запущенная со страницы: в процессе — не больше одной
+_data_quality_scan_lock = threading.Lock()
+
+
+def _scan_data_quality_in_background():
+    try:
+        findings = scan_data_quality()
+        logger.info('Перепроверка качества данных: находок %s', sum(findings.values()))
+    except Exception:
+        logger.exception('Фоновая перепроверка качества данных упала')
+    finally:
+        _data_quality_scan_lock.release()
+
+
+@route('/data-quality', methods=['GET', 'POST'])
+def data_quality():
+    """Счётчики проверок качества данных; POST — перепроверка изменённых областей в фоне.
+
+    Проверки идут дольше statement_timeout страницы, поэтому выполняются вне запроса
+    (как и `flask data-quality scan` по расписанию); результат виден на странице после прогона."""
+    if request.method == 'POST':
+        if _data_quality_scan_lock.acquire(blocking=False):
+            threading.Thread(target=_scan_data_quality_in_background, name='data-quality-scan', daemon=True).start()
+            flash('Проверка запущена в фоне — обновите страницу через минуту', 'success')
+        else:
+            flash('Проверка уже выполняется', 'error')
+        return redirect(url_for('data_quality'))
+    summary = data_quality_summary()
+    return render_template('data_quality/list.html', checks=DATA_QUALITY_CHECKS, summary=summary)
+
+
+@route('/data-quality/<check>')
+@cached_page('data_quality_findings')
+def data_quality_findings(check):
+    """Находки одной проверки постранично: по дню и строке, со всех шардов"""
+    if check not in DATA_QUALITY_CHECKS:
+        flash('Проверка не найдена.', 'error')
+        return redirect(url_for('data_quality'))
+    spec = DATA_QUALITY_CHECKS[check]
+    after_day = request.args.get('after_day') or None
+    after = request.args.get('after', type=int)
+    query = '''
+        SELECT day, entity_id, details FROM data_quality_findings
+        WHERE check_name = %s
+    '''
+    params = [check]
+    # Постранично по ключу: следующая страница начинается после последней строки предыдущей
+    if after is not None and after_day:
+        query += ' AND (day, entity_id) > (%s::date, %s)'
+        params += [after_day, after]
+    elif after is not None:
+        query += ' AND day IS NULL AND entity_id > %s'
+        params.append(after)
+    query += ' ORDER BY day, entity_id LIMIT %s;'
+    params.append(DATA_QUALITY_PAGE_SIZE + 1)
+    # Каждый шард отдаёт не больше страницы; после слияния остаётся первая страница общего порядка
+    rows = fetch_sharded(query, params, operator.itemgetter(0, 1))[:DATA_QUALITY_PAGE_SIZE + 1]
+    next_page = None
+    if len(rows) > DATA_QUALITY_PAGE_SIZE:
+        rows = rows[:DATA_QUALITY_PAGE_SIZE]
+        day, entity_id, _ = rows[-1]
+        next_page = {'after_day': day or '', 'after': entity_id}
+    return render_template(
+        'data_quality/findings.html',
+        check=check,
+        spec=spec,
+        findings=rows,
+        next_page=next_page
+    )
+
+
+# === Глобальный поиск ===
+# Источники: вид -> (таблица, ключ, поле поиска, есть ли полнотекстовый индекс,
+#                     маршрут карточки, имя параметра маршрута, подпись вида)
+SEARCH_SOURCES = {
+    'client': ('clients', 'client_id', 'name', True, 'client_edit', 'id', 'Клиент'),
+    'product': ('products', 'sku_id', 'name', True, 'product_edit', 'id', 'Товар'),
+    'inbound': ('inbound_documents', 'doc_id', 'doc_number', False, 'inbound_edit', 'doc_id', 'Поступление'),
+    'resource': ('resources', 'resource_id', 'name', True, 'resource_edit', 'id', 'Ресурс'),
+}
+
+# Источники, строки которых лежат на шарде своего склада
+SEARCH_SHARDED = ('inbound', 'resource')
+
+SEARCH_PER_PAGE = 20
+SEARCH_MAX_PER_PAGE = 50
+
+
+def _search_query(kinds):
+    """Собирает UNION по источникам: в каждой ветке — выборка по своему индексу
+    с собственным LIMIT, чтобы не ранжировать таблицы целиком"""
+    branches = []
+    for kind in kinds:
+        table, key, column, has_fts, *_ = SEARCH_SOURCES[kind]
+        # Ближайшие по сходству со словами запроса: KNN по GiST-индексу pg_trgm
+        branches.append(f'''
+            (SELECT '{kind}' AS kind, {key} AS id, {column} AS label,
+                    word_similarity(%(q)s, {column}) AS rank
+             FROM {table}
+             WHERE %(q)s <%% {column}
+             ORDER BY %(q)s <<-> {column}
+             LIMIT %(window)s)
+        ''')
+        if has_fts:
+            # Совпадения по словам с учётом словоформ — GIN-индекс по tsvector
+            branches.append(f'''
+                (SELECT '{kind}', {key}, {column},
+                        word_similarity(%(q)s, {column})
+                        + ts_rank_cd(to_tsvector('russian', {column}), query, 32)
+                 FROM {table}, websearch_to_tsquery('russian', %(q)s) AS query
+                 WHERE to_tsvector('russian', {column}) @@ query
+                 ORDER BY 4 DESC
+                 LIMIT %(window)s)
+            ''')
+    return f'''
+        SELECT kind, id, label, MAX(rank) AS rank
+        FROM ({" UNION ALL ".join(branches)}) AS hits
+        GROUP BY kind, id, label
+        ORDER BY rank DESC, label
+        LIMIT %(limit)s OFFSET %(offset)s;
+    '''
+
+
+@route('/search')
+def search():
+    """Поиск по клиентам, товарам, документам и ресурсам с ранжированием и страницами.
+
+    ?format=json отдаёт результаты для подсказок при вводе."""
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('kind')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', SEARCH_PER_PAGE, type=int), 1), SEARCH_MAX_PER_PAGE)
+    kinds = [kind] if kind in SEARCH_SOURCES else list(SEARCH_SOURCES)
+
+    results = []
+    has_next = False
+    if len(q) >= 2:
+        offset = (page - 1) * per_page
+        rows = []
+        for shard in shard_names():
+            # Справочники одинаковы на всех шардах — их ищем только на основном
+            shard_kinds = [k for k in kinds if shard == DEFAULT_SHARD or k in SEARCH_SHARDED]
+            if not shard_kinds:
+                continue
+            conn = get_db_connection(shard=shard)
+            cur = conn.cursor()
+            cur.execute(_search_query(shard_kinds), {
+                'q': q,
+                # Каждой ветке и каждому шарду хватает offset + per_page + 1 лучших строк
+                'window': offset + per_page + 1,
+                'limit': offset + per_page + 1,
+                'offset': 0,
+            })
+            rows.extend(cur.fetchall())
+            cur.close()
+            conn.close()
+        rows.sort(key=lambda row: (-row[3], row[2]))
+        rows = rows[offset:offset + per_page + 1]
+        has_next = len(rows) > per_page
+        for row_kind, row_id, label, rank in rows[:per_page]:
+            _, _, _, _, endpoint, arg, kind_name = SEARCH_SOURCES[row_kind]
+            results.append({
+                'kind': row_kind,
+                'kind_name': kind_name,
+                'id': row_id,
+                'label': label,
+                'rank': round(float(rank), 3),
+                'url': url_for(endpoint, **{arg: row_id}),
+            })
+
+    if request.args.get('format') == 'json':
+        return jsonify({'q': q, 'page': page, 'has_next': has_next, 'results': results})
+    return render_template(
+        'search/results.html',
+        q=q,
+        kind=kind,
+        kinds=SEARCH_SOURCES,
+        page=page,
+        has_next=has_next,
+        results=results
+    )
+
+# === JSON API: пакетная синхронизация справочников ===
+# Описание сущностей: таблица, ключ, колонки с типами (для приведения VALUES),
+# обязательные поля и естественный ключ — цель ON CONFLICT при вставке.
+# events — источник событий capacity_events для пакета и колонка доступностей,
+# по которой считается вклад строк в баланс (None — часы пакет не меняет)
+BULK_ENTITIES = {
+    'clients': {
+        'table': 'clients',
+        'key': 'client_id',
+        'columns': [('name', 'text'), ('contact_person', 'text')],
+        'required': ['name'],
+    },
+    'products': {
+        'table': 'products',
+        'key': 'sku_id',
+        'columns': [
+            ('client_id', 'integer'), ('name', 'text'), ('weight_per_unit', 'numeric'),
+            ('units_per_box', 'numeric'), ('units_per_pallet', 'numeric'),
+        ],
+        'required': ['client_id', 'name', 'weight_per_unit', 'units_per_box', 'units_per_pallet'],
+    },
+    'zones': {
+        'table': 'zones',
+        'key': 'zone_id',
+        'columns': [
+            ('warehouse_id', 'integer'), ('name', 'text'), ('type', 'text'), ('max_capacity', 'numeric'),
+        ],
+        'required': ['warehouse_id', 'name', 'type'],
+        # Строки лежат на шарде склада: (родительская таблица, колонка-ссылка)
+        'shard_by': ('warehouses', 'warehouse_id'),
+    },
+    'resources': {
+        'table': 'resources',
+        'key': 'resource_id',
+        'columns': [('type', 'text'), ('subtype', 'text'), ('name', 'text'), ('zone_id', 'integer')],
+        'required': ['type', 'subtype', 'name'],
+        # Колонки названия и категории подтипа: новые подтипы заводятся до записи пакета
+        'subtype': ('subtype', 'type'),
+        'events': ('resource', 'resource_id'),
+        'shard_by': ('zones', 'zone_id'),
+    },
+    'norms': {
+        'table': 'norms',
+        'key': 'norm_id',
+        'columns': [
+            ('client_id', 'integer'), ('sku_id', 'integer'), ('operation_type', 'text'),
+            ('zone_type', 'text'), ('resource_subtype', 'text'), ('unit_type', 'text'),
+            ('norm_value', 'numeric'),
+        ],
+        # client_id и sku_id могут быть пустыми: это умолчания клиента и общие
+        'required': ['operation_type', 'zone_type', 'resource_subtype', 'unit_type', 'norm_value'],
+        'subtype': ('resource_subtype', None),
+        'natural_key': [
+            'client_id', 'sku_id', 'operation_type', 'zone_type', 'resource_subtype', 'unit_type',
+        ],
+        # Баланс считается по снимкам потребности: норматив меняет его только после пересъёмки
+        'events': ('norm', None),
+    },
+}
+
+# Сколько строк уходит в один INSERT/UPDATE ... VALUES
+BULK_PAGE_SIZE = 1000
+
+
+def _bulk_error_text(e):
+    if isinstance(e, psycopg2.errors.UniqueViolation):
+        return 'Такая запись уже существует'
+    if isinstance(e, psycopg2.errors.ForeignKeyViolation):
+        return 'Нарушена ссылочная целостность'
+    return (e.pgerror or str(e)).strip()
+
+
+def _bulk_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _bulk_execute(cur, sql, rows, template):
+    """Выполняет execute_values для пачки [(index, values)] под точкой сохранения.
+
+    Если пачка падает, откатывается только она и строки прогоняются по одной —
+    так находятся ошибки конкретных строк без отката всей транзакции.
+    Возвращает ([(index, returned_row)], {index: текст ошибки})."""
+    if not rows:
+        return [], {}
+    cur.execute('SAVEPOINT bulk_batch;')
+    try:
+        returned = execute_values(
+            cur, sql, [values for _, values in rows],
+            template=template, page_size=BULK_PAGE_SIZE, fetch=True
+        )
+        cur.execute('RELEASE SAVEPOINT bulk_batch;')
+        return returned, {}
+    except psycopg2.Error:
+        cur.execute('ROLLBACK TO SAVEPOINT bulk_batch;')
+    returned, errors = [], {}
+    for index, values in rows:
+        cur.execute('SAVEPOINT bulk_row;')
+        try:
+            returned.extend(execute_values(cur, sql, [values], template=template, fetch=True))
+            cur.execute('RELEASE SAVEPOINT bulk_row;')
+        except psycopg2.Error as e:
+            cur.execute('ROLLBACK TO SAVEPOINT bulk_row;')
+            errors[index] = _bulk_error_text(e)
+    return returned, errors
+
+
+def _bulk_missing_rows(cur, spec, indexed_keys):
+    """Разбирает строки, не вернувшиеся из UPDATE/DELETE: нет записи или устарела версия"""
+    if not indexed_keys:
+        return {}
+    cur.execute(
+        f'SELECT {spec["key"]}, row_version FROM {spec["table"]} WHERE {spec["key"]} = ANY(%s);',
+        ([key for _, key in indexed_keys],)
+    )
+    current = dict(cur.fetchall())
+    return {
+        index: (f'Запись изменена другим пользователем (текущая версия {current[key]})'
+                if key in current else 'Запись не найдена')
+        for index, key in indexed_keys
+    }
+
+
+def bulk_upsert(cur, spec, rows):
+    """Пакетная вставка/обновление строк справочника в текущей транзакции.
+
+    Строки с ключом обновляются одним UPDATE ... FROM (VALUES ...) с проверкой
+    row_version, строки без ключа — одним INSERT ... ON CONFLICT по естественному ключу."""
+    key, table = spec['key'], spec['table']
+    names = [name for name, _ in spec['columns']]
+    results = {}
+    errors = {}
+
+    to_update, to_insert, seen, seen_ids = [], [], {}, {}
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors[index] = 'Строка должна быть объектом'
+            continue
+        missing = [name for name in spec['required'] if row.get(name) in (None, '')]
+        if missing:
+            errors[index] = f'Не заполнены поля: {", ".join(missing)}'
+            continue
+        values = [row.get(name) for name in names]
+        if row.get(key) is not None:
+            row_id = _bulk_int(row[key])
+            if row_id is None:
+                errors[index] = f'Некорректный {key}'
+                continue
+            # UPDATE ... FROM изменит строку один раз, а отчитаться пришлось бы за каждый дубль
+            if row_id in seen_ids:
+                errors[index] = f'Дублирует строку {seen_ids[row_id]} в этом пакете'
+                continue
+            seen_ids[row_id] = index
+            to_update.append((index, [row_id, row.get('row_version')] + values))
+            continue
+        if 'natural_key' in spec:
+            # ON CONFLICT DO UPDATE не может дважды изменить одну строку в одном запросе
+            natural = tuple(row.get(name) for name in spec['natural_key'])
+            if natural in seen:
+                errors[index] = f'Дублирует строку {seen[natural]} в этом пакете'
+                continue
+            seen[natural] = index
+        to_insert.append((index, values))
+
+    if to_update:
+        template = '(' + ', '.join(
+            ['%s::integer', '%s::integer'] + [f'%s::{sql_type}' for _, sql_type in spec['columns']]
+        ) + ')'
+        sql = f'''
+            UPDATE {table} AS t
+            SET {", ".join(f"{name} = v.{name}" for name in names)}
+            FROM (VALUES %s) AS v({key}, row_version, {", ".join(names)})
+            WHERE t.{key} = v.{key}
+              AND (v.row_version IS NULL OR t.row_version = v.row_version)
+            RETURNING t.{key}, t.row_version;
+        '''
+        returned, failed = _bulk_execute(cur, sql, to_update, template)
+        errors.update(failed)
+        versions = dict(returned)
+        stale = []
+        for index, values in to_update:
+            if index in failed:
+                continue
+            if values[0] in versions:
+                results[index] = {'id': values[0], 'row_version': versions[values[0]], 'status': 'updated'}
+            else:
+                stale.append((index, values[0]))
+        errors.update(_bulk_missing_rows(cur, spec, stale))
+
+    if to_insert:
+        template = '(' + ', '.join(f'%s::{sql_type}' for _, sql_type in spec['columns']) + ')'
+        conflict = ''
+        if 'natural_key' in spec:
+            updated = [name for name in names if name not in spec['natural_key']]
+            conflict = (
+                f'ON CONFLICT ({", ".join(spec["natural_key"])}) DO UPDATE SET '
+                + ', '.join(f'{name} = EXCLUDED.{name}' for name in updated)
+            )
+        sql = f'''
+            INSERT INTO {table} ({", ".join(names)}) VALUES %s
+            {conflict}
+            RETURNING {key}, row_version, (xmax = 0) AS inserted;
+        '''
+        returned, failed = _bulk_execute(cur, sql, to_insert, template)
+        errors.update(failed)
+        # INSERT ... VALUES возвращает строки в порядке VALUES
+        succeeded = [index for index, _ in to_insert if index not in failed]
+        for index, (row_id, version, inserted) in zip(succeeded, returned):
+            results[index] = {
+                'id': row_id, 'row_version': version,
+                'status': 'inserted' if inserted else 'updated',
+            }
+    return results, errors
+
+
+def _bulk_row_keys(spec, rows):
+    """Ключи существующих строк, переданные в пакете (для вклада в баланс «до»)"""
+    keys = set()
+    for row in rows:
+        row_id = _bulk_int(row.get(spec['key']) if isinstance(row, dict) else row)
+        if row_id is not None:
+            keys.add(row_id)
+    return keys
+
+
+def _bulk_shard(spec, rows):
+    """Шард, на который пишется пакет; None — строки пакета лежат на разных шардах.
+
+    Справочники без shard_by одинаковы на всех шардах: пишутся на основной
+    и копируются на остальные (replicate_reference).
+    Существующая строка пишется туда, где лежит; новая — на шард склада своего
+    родителя (склада или зоны), а без родителя — на основной шард."""
+    if 'shard_by' not in spec:
+        return DEFAULT_SHARD
+    parent_table, column = spec['shard_by']
+    keys = _bulk_row_keys(spec, rows)
+    existing = locate_shards(spec['table'], spec['key'], keys) if keys else {}
+    parents = {
+        _bulk_int(row.get(column)) for row in rows
+        if isinstance(row, dict) and _bulk_int(row.get(column)) is not None
+    }
+    if parent_table == 'warehouses':
+        parent_shards = {parent: shard_for(parent) for parent in parents}
+    else:
+        parent_shards = locate_shards(parent_table, column, parents) if parents else {}
+    shards = set(existing.values())
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        parent = _bulk_int(row.get(column))
+        if parent is not None:
+            shards.add(parent_shards.get(parent, DEFAULT_SHARD))
+        elif _bulk_int(row.get(spec['key'])) not in existing:
+            shards.add(DEFAULT_SHARD)
+    if len(shards) > 1:
+        return None
+    return shards.pop() if shards else DEFAULT_SHARD
+
+
+def record_bulk_events(cur, spec, operation, results, before_keys, before):
+    """Пишет событие пакета в capacity_events в той же транзакции, что и сам пакет"""
+    source, column = spec['events']
+    ids = sorted({result['id'] for result in results.values()})
+    if not ids:
+        return
+    after = _capacity_contribution(cur, column, before_keys | set(ids)) if column else None
+    record_capacity_event(cur, source, operation, None, before, after, payload={'ids': ids})
+
+
+def bulk_delete(cur, spec, rows):
+    """Пакетное удаление по ключу с проверкой row_version (если она передана)"""
+    key, table = spec['key'], spec['table']
+    results, errors, to_delete, seen_ids = {}, {}, [], {}
+    for index, row in enumerate(rows):
+        # Строка — либо {"<key>": id, "row_version": n}, либо просто id
+        row_id = _bulk_int(row.get(key) if isinstance(row, dict) else row)
+        if row_id is None:
+            errors[index] = f'Не указан или некорректен {key}'
+            continue
+        if row_id in seen_ids:
+            errors[index] = f'Дублирует строку {seen_ids[row_id]} в этом пакете'
+            continue
+        seen_ids[row_id] = index
+        to_delete.append((index, (row_id, row.get('row_version') if isinstance(row, dict) else None)))
+    sql = f'''
+        DELETE FROM {table} AS t
+        USING (VALUES %s) AS v({key}, row_version)
+        WHERE t.{key} = v.{key}
+          AND (v.row_version IS NULL OR t.row_version = v.row_version)
+        RETURNING t.{key};
+    '''
+    returned, failed = _bulk_execute(cur, sql, to_delete, '(%s::integer, %s::integer)')
+    errors.update(failed)
+    deleted = {row[0] for row in returned}
+    stale = []
+    for index, (row_id, _) in to_delete:
+        if index in failed:
+            continue
+        if row_id in deleted:
+            results[index] = {'id': row_id, 'status': 'deleted'}
+        else:
+            stale.append((index, row_id))
+    errors.update(_bulk_missing_rows(cur, spec, stale))
+    return results, errors
+
+
+@route('/api/<entity>', methods=['GET'])
+def api_entity_list(entity):
+    """Выгрузка справочника с версиями строк (постранично, по ключу)"""
+    spec = BULK_ENTITIES.get(entity)
+    if not spec:
+        return jsonify({'error': f'Неизвестный справочник: {entity}'}), 404
+    after = request.args.get('after', 0, type=int)
+    limit = max(min(request.args.get('limit', 1000, type=int), 10000), 1)
+    names = [spec['key']] + [name for name, _ in spec['columns']] + ['row_version']
+    sql = (
+        f'SELECT {", ".join(names)} FROM {spec["table"]} '
+        f'WHERE {spec["key"]} > %s ORDER BY {spec["key"]} LIMIT %s;'
+    )
+    if 'shard_by' in spec:
+        # Каждый шард отдаёт limit первых строк, из слияния берём limit общих первых
+        found = fetch_sharded(sql, (after, limit), operator.itemgetter(0), readonly=False)[:limit]
+    else:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(sql, (after, limit))
+        found = cur.fetchall()
+        cur.close()
+        conn.close()
+    rows = [dict(zip(names, row)) for row in found]
+    return jsonify({'rows': rows, 'next_after': rows[-1][spec['key']] if len(rows) == limit else None})
+
+
+@route('/api/<entity>', methods=['PUT', 'DELETE'])
+def api_entity_bulk(entity):
+    """Пакетная синхронизация справочника: PUT — upsert, DELETE — удаление.
+
+    Тело: {"rows": [...], "atomic": false}. Все строки обрабатываются в одной
+    транзакции; ошибки возвращаются по номерам строк. При "atomic": true любая
+    ошибка откатывает весь пакет. Заголовок Idempotency-Key делает повтор
+    запроса безопасным: применённый пакет не выполняется второй раз."""
+    spec = BULK_ENTITIES.get(entity)
+    if not spec:
+        return jsonify({'error': f'Неизвестный справочник: {entity}'}), 404
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('rows'), list):
+        return jsonify({'error': 'Ожидается JSON вида {"rows": [...]}'}), 400
+    rows = payload['rows']
+    atomic = bool(payload.get('atomic'))
+    # Ретрай с тем же ключом получает ответ первого запроса, а не повторное применение пакета
+    idempotency_key = request.headers.get('Idempotency-Key')
+    endpoint = f'{request.method} /api/{entity}'
+    shard = _bulk_shard(spec, rows)
+    if shard is None:
+        return jsonify({'error': 'Строки пакета относятся к складам разных шардов: разбейте пакет по шардам'}), 400
+
+    if request.method == 'PUT' and 'subtype' in spec:
+        name_column, category_column = spec['subtype']
+        try:
+            ensure_subtypes({
+                row[name_column]: row.get(category_column) if category_column else None
+                for row in rows if isinstance(row, dict) and isinstance(row.get(name_column), str) and row[name_column]
+            })
+        except psycopg2.Error as e:
+            return jsonify({'error': str(e)}), 500
+
+    conn = get_db_connection(shard=shard)
+    cur = conn.cursor()
+    try:
+        if idempotency_key:
+            previous = claim_idempotency_key(cur, idempotency_key, endpoint)
+            if previous:
+                conn.rollback()
+                if previous[0] != endpoint:
+                    return jsonify({'error': f'Ключ уже использован для {previous[0]}'}), 422
+                response = jsonify(previous[3])
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response, previous[2]
+        before_keys, before = set(), None
+        if 'events' in spec and spec['events'][1]:
+            before_keys = _bulk_row_keys(spec, rows)
+            before = _capacity_contribution(cur, spec['events'][1], before_keys)
+        if request.method == 'PUT':
+            results, errors = bulk_upsert(cur, spec, rows)
+        else:
+            results, errors = bulk_delete(cur, spec, rows)
+        rejected = bool(errors and atomic)
+        if rejected:
+            results = {}
+        elif 'events' in spec:
+            record_bulk_events(
+                cur, spec, 'bulk_upsert' if request.method == 'PUT' else 'bulk_delete',
+                results, before_keys, before
+            )
+        summary = {}
+        for result in results.values():
+            summary[result['status']] = summary.get(result['status'], 0) + 1
+        body = {
+            'summary': summary,
+            'results': [dict(index=index, **results[index]) for index in sorted(results)],
+            'errors': [{'index': index, 'error': errors[index]} for index in sorted(errors)],
+            'committed': not rejected,
+        }
+        status = 409 if rejected else 200
+        if rejected:
+            # Откат освобождает и ключ: исправленный пакет можно отправить с ним же
+            conn.rollback()
+        else:
+            if spec['table'] in REFERENCE_TABLES:
+                replicate_reference(cur, spec['table'], {result['id'] for result in results.values()})
+            if idempotency_key:
+                store_idempotent_result(cur, idempotency_key, status=status, response=body)
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+        conn.close()
+    return jsonify(body), status
+
+# === История изменений: срезы «на момент» (sql/011_history.sql) ===
+# Таблица -> (ключ строки, колонка даты для фильтра периода, лежит ли по шардам складов).
+# Справочники клиентов и нормативов одинаковы на всех шардах и читаются с шарда по умолчанию.
+HISTORY_TABLES = {
+    'clients': ('client_id', None, False),
+    'norms': ('norm_id', None, False),
+    'zones': ('zone_id', None, True),
+    'resources': ('resource_id', None, True),
+    'available_capacities': ('capacity_id', 'date', True),
+    'inbound_documents': ('doc_id', 'doc_date', True),
+    'inbound_items': ('item_id', 'doc_date', True),
+    'outbound_plan': ('plan_id', 'date', True),
+}
+
+
+def _fetch_history(table, sql, params, key, warehouse_id=None):
+    """Строки истории (ключ, данные, valid_from, valid_to) с нужных шардов"""
+    if HISTORY_TABLES[table][2]:
+        return fetch_sharded(sql, params, key, warehouse_id)
+    conn = get_db_connection(readonly=True)
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+
+def _history_record(row):
+    record = dict(row[1])
+    record['valid_from'] = row[2]
+    record['valid_to'] = row[3]
+    return record
+
+
+@route('/api/history/<table>')
+def api_history(table):
+    """Срез таблицы на момент времени (?as_of=2025-01-31T18:00), постранично по ключу.
+
+    Для таблиц с датой — необязательный период date_from / date_to."""
+    spec = HISTORY_TABLES.get(table)
+    if not spec:
+        return jsonify({'error': f'Нет истории таблицы: {table}'}), 404
+    as_of = request.args.get('as_of')
+    if not as_of:
+        return jsonify({'error': 'Укажите момент времени: ?as_of=2025-01-31T18:00'}), 400
+    # Проверяем до запроса: неверная дата иначе дошла бы до PostgreSQL и вернулась как 500
+    try:
+        datetime.fromisoformat(as_of)
+    except ValueError:
+        return jsonify({'error': 'as_of: ожидается дата и время ГГГГ-ММ-ДДTЧЧ:ММ'}), 400
+    key, date_column, _ = spec
+    after = request.args.get('after', 0, type=int)
+    limit = max(min(request.args.get('limit', 1000, type=int), 10000), 1)
+    conditions = ['valid @> %s::timestamptz', f'{key} > %s']
+    params = [as_of, after]
+    if date_column:
+        for arg, operator_sql in (('date_from', '>='), ('date_to', '<=')):
+            value = request.args.get(arg)
+            if not value:
+                continue
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                return jsonify({'error': f'{arg}: ожидается дата ГГГГ-ММ-ДД'}), 400
+            conditions.append(f'{date_column} {operator_sql} %s')
+            params.append(value)
+    rows = _fetch_history(
+        table,
+        f'''
+            SELECT {key}, to_jsonb(h) - 'valid', lower(valid), upper(valid)
+            FROM {table}_history h
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {key} LIMIT %s;
+        ''',
+        params + [limit], operator.itemgetter(0), request.args.get('warehouse_id', type=int)
+    )[:limit]
+    return jsonify({
+        'as_of': as_of,
+        'rows': [_history_record(row) for row in rows],
+        'next_after': rows[-1][0] if len(rows) == limit else None,
+    })
+
+
+@route('/api/history/<table>/<int:row_id>')
+def api_history_row(table, row_id):
+    """Все версии одной строки по времени: когда и как она менялась, какой была до удаления"""
+    spec = HISTORY_TABLES.get(table)
+    if not spec:
+        return jsonify({'error': f'Нет истории таблицы: {table}'}), 404
+    rows = _fetch_history(
+        table,
+        f'''
+            SELECT {spec[0]}, to_jsonb(h) - 'valid', lower(valid), upper(valid)
+            FROM {table}_history h
+            WHERE {spec[0]} = %s AND NOT isempty(valid)
+            ORDER BY lower(valid);
+        ''',
+        (row_id,), operator.itemgetter(2)
+    )
+    if not rows:
+        return jsonify({'error': 'Строка не найдена в истории'}), 404
+    return jsonify({'versions': [_history_record(row) for row in rows]})
+
+
+# === CDC: журнал событий, влияющих на баланс мощностей ===
+CAPACITY_EVENTS_CHANNEL = 'capacity_events'
+
+# Как часто поток SSE шлёт комментарий-пульс, если событий нет (сек.)
+SSE_HEARTBEAT_SECONDS = 15
+
+# Сколько событий читается из журнала за один запрос
+SSE_BATCH_SIZE = 1000
+
+# Сколько последних событий процесс держит в памяти для переподключившихся клиентов
+SSE_HISTORY_SIZE = 5000
+
+# Очередь одного SSE-клиента; переполнивший её клиент отключается и догоняет по Last-Event-ID
+SSE_QUEUE_SIZE = 1000
+
+# Пауза перед переподключением слушателя к БД (сек.)
+SSE_RECONNECT_SECONDS = 3
+
+# Как часто слушатель перечитывает журнал без NOTIFY (сек.): события транзакции ждут,
+# пока завершатся все более старые пишущие транзакции, а те могли событий не писать
+SSE_POLL_SECONDS = 1
+
+# Поток SSE держит поток воркера gthread, пока открыта вкладка. Поэтому браузеры
+# направляются на асинхронный сервер (analytics_async: /api/analytics/events/capacity),
+# если задан его адрес CAPACITY_EVENTS_URL; без него поток отдаёт этот воркер,
+# но не больше SSE_MAX_SUBSCRIBERS одновременно, сверх — 503 (см. gunicorn.conf.py)
+CAPACITY_EVENTS_URL = os.getenv('CAPACITY_EVENTS_URL')
+SSE_MAX_SUBSCRIBERS = int(os.getenv('SSE_MAX_SUBSCRIBERS', 1))
+# Через сколько мс браузер повторит подключение после отказа
+SSE_REJECT_RETRY_MS = 30000
+
+metrics.describe('sse_rejected_total', 'counter', 'Подключения SSE, отклонённые сверх SSE_MAX_SUBSCRIBERS')
+
+
+# Снимки потребности по типу операции: таблица, ключ строки, колонка даты
+REQUIREMENT_SNAPSHOTS = {
+    'inbound': ('inbound_requirement_snapshots', 'doc_id', 'doc_date'),
+    'outbound': ('outbound_requirement_snapshots', 'plan_id', 'date'),
+}
+
+
+def _inbound_contribution(cur, doc_id):
+    """Вклад документа поступления в баланс — по его снимку потребности:
+    {(дата, zone_id, подтип): (требуется, доступно)}"""
+    return _snapshot_contribution(cur, 'inbound', 'doc_id = %s', (doc_id,))
+
+
+def _outbound_contribution(cur, plan_ids):
+    """Вклад строк плана отгрузки в баланс — по их снимкам потребности"""
+    return _snapshot_contribution(cur, 'outbound', 'plan_id = ANY(%s)', (list(plan_ids),))
+
+
+def snapshot_requirements(cur, operation_type, where, params):
+    """Фиксирует снимок потребности валидированных документов, отобранных условием where
+    (по колонкам ключа и даты из REQUIREMENT_SNAPSHOTS): прежний снимок удаляется,
+    новый считается по текущим нормативам одним INSERT … SELECT."""
+    table, key, date_column = REQUIREMENT_SNAPSHOTS[operation_type]
+    cur.execute(f'''
+        DELETE FROM {table}
+        WHERE {where};
+    ''', params)
+    cur.execute(f'''
+        INSERT INTO {table} ({key}, {date_column}, zone_id, resource_subtype, subtype_id, required_hours)
+        SELECT {key}, {date_column}, zone_id, resource_type, subtype_id, required_units
+        FROM (
+            SELECT doc_id AS {key}, date AS {date_column}, zone_id, resource_type, subtype_id, required_units
+            FROM v_resource_requirements
+            WHERE validated AND operation_type = %s
+        ) r
+        WHERE {where};
+    ''', (operation_type,) + tuple(params))
+    return cur.rowcount
+
+
+def _snapshot_contribution(cur, operation_type, where, params):
+    table, key, date_column = REQUIREMENT_SNAPSHOTS[operation_type]
+    cur.execute(f'''
+        SELECT {date_column}, zone_id, resource_subtype, SUM(required_hours)
+        FROM {table}
+        WHERE {where}
+        GROUP BY {date_column}, zone_id, resource_subtype;
+    ''', params)
+    return {(d, zone, subtype): (hours, 0) for d, zone, subtype, hours in cur.fetchall()}
+
+
+def _capacity_contribution(cur, column, value):
+    """Вклад доступностей (по capacity_id или resource_id; ключ или список ключей) в баланс"""
+    values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+    cur.execute(f'''
+        SELECT ac.date, r.zone_id, r.subtype, SUM(ac.available_hours)
+        FROM available_capacities ac
+        JOIN resources r ON ac.resource_id = r.resource_id
+        WHERE ac.{column} = ANY(%s) AND r.zone_id IS NOT NULL
+        GROUP BY ac.date, r.zone_id, r.subtype;
+    ''', (values,))
+    return {(d, zone, subtype): (0, hours) for d, zone, subtype, hours in cur.fetchall()}
+
+
+def _norm_payload(client_id, sku_id, operation_type, zone_type, resource_subtype, unit_type, norm_value):
+    return {
+        'client_id': client_id,
+        'sku_id': sku_id,
+        'operation_type': operation_type,
+        'zone_type': zone_type,
+        'resource_subtype': resource_subtype,
+        'unit_type': unit_type,
+        'norm_value': str(norm_value),
+    }
+
+
+def record_capacity_event(cur, source, operation, entity_id, before=None, after=None, payload=None):
+    """Пишет события в журнал capacity_events в текущей транзакции.
+
+    before/after — вклад изменяемой сущности в баланс до и после изменения;
+    по каждой затронутой ячейке (дата, zone_id, подтип) пишется строка с приращениями,
+    имя зоны и склад берутся из zones. Если часы не изменились, пишется одно событие
+    без ячейки. NOTIFY уходит слушателям только после фиксации транзакции."""
+    before = before or {}
+    after = after or {}
+    rows = []
+    for key in sorted(set(before) | set(after), key=lambda k: (k[0], k[1] or 0, k[2] or '')):
+        old_required, old_available = before.get(key, (0, 0))
+        new_required, new_available = after.get(key, (0, 0))
+        required_delta = new_required - old_required
+        available_delta = new_available - old_available
+        if required_delta or available_delta:
+            rows.append(key + (required_delta, available_delta))
+    if not rows:
+        rows.append((None, None, None, 0, 0))
+    execute_values(
+        cur,
+        '''
+            INSERT INTO capacity_events (
+                source, operation, entity_id, date, zone_id, warehouse_id, zone_name, resource_subtype,
+                required_delta, available_delta, payload
+            )
+            SELECT v.source, v.operation, v.entity_id, v.date, v.zone_id, z.warehouse_id, z.name,
+                   v.resource_subtype, v.required_delta, v.available_delta, v.payload
+            FROM (VALUES %s) AS v(
+                source, operation, entity_id, date, zone_id, resource_subtype,
+                required_delta, available_delta, payload
+            )
+            LEFT JOIN zones z ON z.zone_id = v.zone_id;
+        ''',
+        [(source, operation, entity_id) + row + (Json(payload) if payload else None,) for row in rows],
+        template='(%s, %s, %s::integer, %s::date, %s::integer, %s, %s::numeric, %s::numeric, %s::jsonb)',
+        page_size=BULK_PAGE_SIZE
+    )
+    cur.execute('SELECT pg_notify(%s, %s);', (CAPACITY_EVENTS_CHANNEL, source))
+
+
+def _capacity_event_json(row):
+    (event_id, created_at, source, operation, entity_id, date,
+     zone_id, warehouse_id, zone, subtype, required_delta, available_delta, payload) = row
+    return {
+        'event_id': event_id,
+        'created_at': created_at.isoformat(),
+        'source': source,
+        'operation': operation,
+        'entity_id': entity_id,
+        'date': date.isoformat() if date else None,
+        'zone_id': zone_id,
+        'warehouse_id': warehouse_id,
+        'zone': zone,
+        'resource_subtype': subtype,
+        'required_delta': float(required_delta),
+        'available_delta': float(available_delta),
+        'balance_delta': float(available_delta - required_delta),
+        'payload': payload,
+    }
+
+
+# Граница чтения журнала: события транзакций младше самой старой незавершённой ещё
+# могут дополниться событиями с меньшими event_id и не читаются
+_SETTLED_EVENTS = 'tx_id < pg_snapshot_xmin(pg_current_snapshot())::text::bigint'
+
+
+def parse_event_position(value):
+    """Позиция в журнале из Last-Event-ID или ?after= («tx_id-event_id») -> (tx_id, event_id)"""
+    tx_id, _, event_id = (value or '').partition('-')
+    if tx_id.isdigit() and event_id.isdigit():
+        return int(tx_id), int(event_id)
+    return None
+
+
+def format_event_position(position):
+    return '%d-%d' % position
+
+
+# Запросы к журналу — общие с асинхронным сервером (analytics_async)
+CAPACITY_EVENTS_POSITION_SQL = f'''
+    SELECT tx_id, event_id
+    FROM capacity_events
+    WHERE {_SETTLED_EVENTS}
+    ORDER BY tx_id DESC, event_id DESC
+    LIMIT 1;
+'''
+
+CAPACITY_EVENTS_AFTER_SQL = f'''
+    SELECT tx_id, event_id, created_at, source, operation, entity_id, date,
+           zone_id, warehouse_id, zone_name, resource_subtype, required_delta, available_delta, payload
+    FROM capacity_events
+    WHERE (tx_id, event_id) > (%s, %s) AND {_SETTLED_EVENTS}
+    ORDER BY tx_id, event_id
+    LIMIT %s;
+'''
+
+
+def capacity_events_url(after, warehouse_id=None):
+    """Адрес потока событий для страницы: асинхронный сервер, если он задан, иначе этот"""
+    args = {'after': after}
+    if warehouse_id:
+        args['warehouse_id'] = warehouse_id
+    if CAPACITY_EVENTS_URL:
+        return f'{CAPACITY_EVENTS_URL}?{urlencode(args)}'
+    return url_for('capacity_events_stream', **args)
+
+
+def capacity_events_position(cur):
+    """Позиция последнего события, после которого журнал уже не дополнится"""
+    cur.execute(CAPACITY_EVENTS_POSITION_SQL)
+    row = cur.fetchone()
+    return tuple(row) if row else (0, 0)
+
+
+def _fetch_capacity_events(cur, after, limit=SSE_BATCH_SIZE):
+    """События журнала после позиции after в порядке фиксации: [((tx_id, event_id), JSON-строка)]"""
+    cur.execute(CAPACITY_EVENTS_AFTER_SQL, after + (limit,))
+    return [
+        ((row[0], row[1]), json.dumps(_capacity_event_json(row[1:]), ensure_ascii=False))
+        for row in cur.fetchall()
+    ]
+
+
+class _Subscription:
+    __slots__ = ('queue', 'overflowed')
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.overflowed = False
+
+
+class CapacityEventBroadcaster:
+    """Раздаёт события журнала всем SSE-клиентам процесса.
+
+    На процесс (воркер) держится одно LISTEN-соединение в фоновом потоке;
+    браузеры подписываются на очереди в памяти и соединений с БД не занимают.
+    Недавние события хранятся в кольцевом буфере для переподключений по Last-Event-ID;
+    позиции событий — (tx_id, event_id), см. _fetch_capacity_events. Журнал у каждого
+    шарда свой, поэтому и раздатчик — на шард."""
+
+    def __init__(self, shard=DEFAULT_SHARD, history_size=SSE_HISTORY_SIZE):
+        self.shard = shard
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = collections.deque(maxlen=history_size)
+        self._position = None
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        with self._lock:
+            # После fork поток слушателя не наследуется — запускаем свой в каждом воркере
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # Подписчики родителя после fork не наши; при перезапуске упавшего потока
+                # в том же процессе живые подписки сохраняются
+                self._pid = os.getpid()
+                self._subscribers.clear()
+            self._thread = threading.Thread(target=self._run, name=f'capacity-events-{self.shard}', daemon=True)
+            self._thread.start()
+
+    def subscribe(self, position=None):
+        """Подписка и пропущенные после position события: (подписка, [(позиция, data)])"""
+        self._ensure_started()
+        subscription = _Subscription()
+        with self._lock:
+            self._subscribers.add(subscription)
+            if position is None:
+                return subscription, []
+            backlog = [event for event in self._history if event[0] > position]
+            covered = (
+                (self._history and self._history[0][0] <= position)
+                or (self._position is not None and position >= self._position)
+            )
+        if covered:
+            return subscription, backlog
+        # Клиент отстал сильнее буфера — дочитываем журнал из БД один раз
+        conn = get_db_connection(shard=self.shard)
+        try:
+            cur = conn.cursor()
+            backlog = _fetch_capacity_events(cur, position, SSE_HISTORY_SIZE)
+            cur.close()
+        finally:
+            conn.close()
+        return subscription, backlog
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _publish_new(self, cur):
+        while True:
+            events = _fetch_capacity_events(cur, self._position)
+            with self._lock:
+                for event in events:
+                    self._history.append(event)
+                    for subscription in list(self._subscribers):
+                        try:
+                            subscription.queue.put_nowait(event)
+                        except queue.Full:
+                            # Медленный клиент отключается и догонит по Last-Event-ID
+                            subscription.overflowed = True
+                            self._subscribers.discard(subscription)
+                if events:
+                    self._position = events[-1][0]
+            if len(events) < SSE_BATCH_SIZE:
+                return
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = connect_db(self.shard)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN {CAPACITY_EVENTS_CHANNEL};')
+                if self._position is None:
+                    self._position = capacity_events_position(cur)
+                while True:
+                    # После переподключения дочитываем всё, что пришло без нас; по таймауту —
+                    # события, которые ждали завершения более старых транзакций
+                    self._publish_new(cur)
+                    if select.select([conn], [], [], SSE_POLL_SECONDS) != ([], [], []):
+                        conn.poll()
+                        conn.notifies.clear()
+            except psycopg2.Error as e:
+                logger.warning('Слушатель событий баланса (шард %s): %s; переподключение', self.shard, e)
+                time.sleep(SSE_RECONNECT_SECONDS)
+            except Exception:
+                # Любая другая ошибка не должна останавливать поток: без него подписчики молча замрут
+                logger.exception('Слушатель событий баланса (шард %s) упал; перезапуск', self.shard)
+                time.sleep(SSE_RECONNECT_SECONDS)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+capacity_events = {shard: CapacityEventBroadcaster(shard) for shard in shard_names()}
+
+# Места для потоков SSE в процессе: каждый занимает поток воркера на всё время вкладки
+_sse_slots = threading.BoundedSemaphore(SSE_MAX_SUBSCRIBERS)
+
+
+@route('/events/capacity')
+def capacity_events_stream():
+    """Поток изменений баланса (Server-Sent Events).
+
+    Клиент, переподключаясь, присылает Last-Event-ID и получает пропущенные
+    события; дальше новые события раздаются из общего слушателя процесса.
+    ?warehouse_id= выбирает шард склада: позиции журналов разных шардов несравнимы.
+    Поток занимает поток воркера, поэтому их не больше SSE_MAX_SUBSCRIBERS на процесс;
+    в продакшене поток отдаёт асинхронный сервер (CAPACITY_EVENTS_URL)."""
+    if not _sse_slots.acquire(blocking=False):
+        metrics.inc('sse_rejected_total')
+        return Response(
+            f'retry: {SSE_REJECT_RETRY_MS}\n\n', status=503, mimetype='text/event-stream',
+            headers={'Retry-After': str(SSE_REJECT_RETRY_MS // 1000), 'Cache-Control': 'no-cache'}
+        )
+    try:
+        position = parse_event_position(request.headers.get('Last-Event-ID') or request.args.get('after'))
+        broadcaster = capacity_events[shard_for(request.args.get('warehouse_id', type=int))]
+        subscription, backlog = broadcaster.subscribe(position)
+    except Exception:
+        _sse_slots.release()
+        raise
+
+    def stream():
+        last_sent = position or (0, 0)
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                if backlog:
+                    event_position, data = backlog.pop(0)
+                else:
+                    try:
+                        event_position, data = subscription.queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+                    except queue.Empty:
+                        if subscription.overflowed:
+                            return
+                        # Пульс, чтобы прокси не рвали простаивающее соединение
+                        yield ': heartbeat\n\n'
+                        continue
+                # Догрузка из БД и очередь могут пересекаться
+                if event_position <= last_sent:
+                    continue
+                last_sent = event_position
+                yield f'id: {format_event_position(event_position)}\nevent: capacity\ndata: {data}\n\n'
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    response = Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Место освобождается, когда сервер закрывает ответ — и если поток так и не начался
+    response.call_on_close(_sse_slots.release)
+    return response
+
+
+@route('/metrics')
+def metrics_view():
+    """Метрики для Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@cli_command
+@click.command('purge-events')
+@click.option('--days', default=7, show_default=True, help='Сколько дней хранить события.')
+def purge_events(days):
+    """Удаляет из журнала capacity_events события старше заданного срока (на всех шардах)."""
+    deleted = 0
+    for shard in shard_names():
+        conn = get_db_connection(shard=shard)
+        cur = conn.cursor()
+        cur.execute("DELETE FROM capacity_events WHERE created_at < now() - %s * interval '1 day';", (days,))
+        deleted += cur.rowcount
+        conn.commit()
+        cur.close()
+        conn.close()
+    click.echo(f'Удалено событий: {deleted}')
+
+
+@cli_command
+@click.command('purge-idempotency-keys')
+@click.option('--hours', default=24, show_default=True, help='Сколько часов хранить ключи.')
+def purge_idempotency_keys(hours):
+    """Удаляет ключи идемпотентности старше заданного срока: после него повтор выполнится заново."""
+    deleted = 0
+    for shard in shard_names():
+        conn = get_db_connection(shard=shard)
+        cur = conn.cursor()
+        cur.execute("DELETE FROM idempotency_keys WHERE created_at < now() - %s * interval '1 hour';", (hours,))
+        deleted += cur.rowcount
+        conn.commit()
+        cur.close()
+        conn.close()
+    click.echo(f'Удалено ключей: {deleted}')
+
+@cli_command
+@click.group('snapshots')
+def snapshots_cli():
+    """Снимки потребности валидированных поступлений."""
+
+
+@snapshots_cli.command('rebuild')
+@click.option('--from', 'date_from', required=True, help='Начало периода (ГГГГ-ММ-ДД).')
+@click.option('--to', 'date_to', required=True, help='Конец периода (ГГГГ-ММ-ДД).')
+@click.option('--operation', type=click.Choice(['all', *REQUIREMENT_SNAPSHOTS]), default='all',
+              show_default=True, help='Поступления, отгрузки или всё.')
+@click.option('--doc-id', type=int, help='Пересчитать только один документ (plan_id для отгрузки).')
+def snapshots_rebuild(date_from, date_to, operation, doc_id):
+    """Пересчитывает снимки потребности по текущим нормативам (после их изменения)."""
+    if doc_id is not None and operation == 'all':
+        raise click.UsageError('--doc-id требует --operation inbound или outbound')
+    operations = list(REQUIREMENT_SNAPSHOTS) if operation == 'all' else [operation]
+    # Документы лежат на шардах своих складов — пересчитываем каждый шард своей транзакцией
+    for shard in shard_names():
+        conn = get_db_connection(shard=shard)
+        cur = conn.cursor()
+        for operation_type in operations:
+            table, key, date_column = REQUIREMENT_SNAPSHOTS[operation_type]
+            where = f'{date_column} BETWEEN %s AND %s'
+            params = (date_from, date_to)
+            if doc_id is not None:
+                where += f' AND {key} = %s'
+                params += (doc_id,)
+            before = _snapshot_contribution(cur, operation_type, where, params)
+            rows = snapshot_requirements(cur, operation_type, where, params)
+            record_capacity_event(
+                cur, 'snapshot', 'rebuild', doc_id,
+                before, _snapshot_contribution(cur, operation_type, where, params),
+                payload={'operation_type': operation_type, 'from': date_from, 'to': date_to}
+            )
+            click.echo(f'{shard}: {table}: снимки пересчитаны за {date_from} — {date_to}, строк {rows}')
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+@cli_command
+@click.group('shards')
+def shards_cli():
+    """Шарды по складам (карта в DB_SHARDS)."""
+
+
+@shards_cli.command('check')
+def shards_check():
+    """Проверяет подключение к каждому шарду и показывает его склады."""
+    for shard in shard_names():
+        warehouses = sorted(w for w, name in WAREHOUSE_SHARDS.items() if name == shard)
+        settings = _db_settings(shard)
+        try:
+            conn = get_db_connection(shard=shard)
+            cur = conn.cursor()
+            cur.execute('SELECT COUNT(*) FROM zones;')
+            state = f'зон: {cur.fetchone()[0]}'
+            cur.close()
+            conn.close()
+        except psycopg2.Error as e:
+            state = f'ошибка: {e}'.strip()
+        click.echo(f"{shard}: {settings['host']}/{settings['database']}, "
+                   f"склады: {warehouses or 'прочие'}, {state}")
 
-@app.route('/capacities/create', methods=('GET', 'POST'))
-def capacity_create():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT resource_id, name, subtype FROM resources ORDER BY name;')
-    resources = cur.fetchall()
-    if request.method == 'POST':
-        resource_id = request.form.get('resource_id')
-        date = request.form.get('date')
-        hours = request.form.get('available_hours')
-        if not (resource_id and date and hours):
-            flash('Все поля обязательны!', 'error')
-        else:
-            try:
-                cur.execute('''
-                    INSERT INTO available_capacities (resource_id, date, available_hours)
-                    VALUES (%s, %s, %s);
-                ''', (resource_id, date, hours))
-                conn.commit()
-                flash('Доступность добавлена!', 'success')
-                return redirect(url_for('capacity_list'))
-            except psycopg2.errors.UniqueViolation:
-                flash('Для этого ресурса на эту дату уже задана доступность!', 'error')
-            except Exception as e:
-                flash(f'Ошибка: {e}', 'error')
-    cur.close()
-    conn.close()
-    return render_template('capacities/create.html', resources=resources)
 
-@app.route('/capacities/edit/<int:id>', methods=('GET', 'POST'))
-def capacity_edit(id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT capacity_id, resource_id, date, available_hours
-        FROM available_capacities
-        WHERE capacity_id = %s;
-    ''', (id,))
-    capacity = cur.fetchone()
-    if not capacity:
-        flash('Запись не найдена.', 'error')
-        return redirect(url_for('capacity_list'))
-    cur.execute('SELECT resource_id, name, subtype FROM resources ORDER BY name;')
-    resources = cur.fetchall()
-    if request.method == 'POST':
-        resource_id = request.form.get('resource_id')
-        date = request.form.get('date')
-        hours = request.form.get('available_hours')
-        if not (resource_id and date and hours):
-            flash('Все поля обязательны!', 'error')
-        else:
-            try:
-                cur.execute('''
-                    UPDATE available_capacities
-                    SET resource_id = %s, date = %s, available_hours = %s
-                    WHERE capacity_id = %s;
-                ''', (resource_id, date, hours, id))
-                conn.commit()
-                flash('Доступность обновлена!', 'success')
-                return redirect(url_for('capacity_list'))
-            except psycopg2.errors.UniqueViolation:
-                flash('Для этого ресурса на эту дату уже задана доступность!', 'error')
-            except Exception as e:
-                flash(f'Ошибка: {e}', 'error')
-    cur.close()
-    conn.close()
-    return render_template('capacities/edit.html', capacity=capacity, resources=resources)
+@shards_cli.command('apply')
+@click.argument('sql_file', type=click.File(encoding='utf-8'))
+def shards_apply(sql_file):
+    """Выполняет SQL-файл (миграцию) на всех шардах."""
+    sql = sql_file.read()
+    for shard in shard_names():
+        conn = get_db_connection(shard=shard)
+        cur = conn.cursor()
+        cur.execute(sql)
+        conn.commit()
+        cur.close()
+        conn.close()
+        click.echo(f'{shard}: применён {sql_file.name}')
 
-@app.route('/capacities/delete/<int:id>', methods=('GET', 'POST'))
-def capacity_delete(id):
+
+@shards_cli.command('sync-reference')
+def shards_sync_reference():
+    """Копирует справочники с основного шарда на остальные целиком.
+
+    Маршруты копируют каждую правку сами (replicate_reference); команда нужна для
+    нового шарда и после сбоя между commit основного шарда и остальных."""
+    shards = [shard for shard in shard_names() if shard != DEFAULT_SHARD]
+    if not shards:
+        click.echo('Шард один — копировать некуда')
+        return
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('''
-        SELECT ac.date, r.name AS resource_name
-        FROM available_capacities ac
-        JOIN resources r ON ac.resource_id = r.resource_id
-        WHERE ac.capacity_id = %s;
-    ''', (id,))
-    capacity = cur.fetchone()
-    if not capacity:
-        flash('Запись не найдена.', 'error')
-        return redirect(url_for('capacity_list'))
-    if request.method == 'POST':
-        try:
-            cur.execute('DELETE FROM available_capacities WHERE capacity_id = %s;', (id,))
-            conn.commit()
-            flash('Запись удалена.', 'success')
-            return redirect(url_for('capacity_list'))
-        except Exception as e:
-            flash(f'Ошибка при удалении: {e}', 'error')
-    cur.close()
-    conn.close()
-    return render_template('capacities/delete.html', date=capacity[0], resource_name=capacity[1])
-
-@app.route('/balance', methods=('GET', 'POST'))
-def balance_view():
-    """Просмотр баланса мощностей (A12) с фильтром по дате"""
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+    targets = [get_db_connection(shard=shard) for shard in shards]
     try:
-        conn = get_db_connection()
+        # Удаление — от ссылающихся таблиц к родителям, вставка — наоборот
+        for table in reversed(REFERENCE_TABLES):
+            _copy_reference(cur, targets, table, upsert=False)
+        for table in REFERENCE_TABLES:
+            _copy_reference(cur, targets, table, delete=False)
+            click.echo(f'{table}: скопировано строк {cur.rowcount}')
+        for target in targets:
+            target.commit()
+    finally:
+        for target in targets:
+            target.close()
+        cur.close()
+        conn.close()
+    click.echo(f"Справочники скопированы на шарды: {', '.join(shards)}")
+
+
+# Таблицы, строки которых пишутся на шард склада: их ключи не должны пересекаться между шардами
+SHARDED_KEYS = {
+    'zones': 'zone_id',
+    'resources': 'resource_id',
+    'available_capacities': 'capacity_id',
+    'inbound_documents': 'doc_id',
+    'inbound_items': 'item_id',
+    'outbound_plan': 'plan_id',
+}
+
+
+@shards_cli.command('keys')
+def shards_keys():
+    """Разводит последовательности ключей по шардам: шард i выдаёт ключи i, i + N, i + 2N...
+
+    Маршруты находят строку по ключу на любом шарде (locate_shard), поэтому
+    ключи не должны совпадать. Запускается после добавления шарда в DB_SHARDS."""
+    shards = shard_names()
+    top = dict.fromkeys(SHARDED_KEYS, 0)
+    for shard in shards:
+        conn = get_db_connection(shard=shard)
         cur = conn.cursor()
-        query = '''
-            SELECT
-                date,
-                zone_name,
-                resource_subtype,
-                ROUND(required_hours, 2) AS required_hours,
-                ROUND(available_hours, 2) AS available_hours,
-                ROUND(balance, 2) AS balance
-            FROM v_capacity_balance
-        '''
-        params = []
-        if start_date and end_date:
-            query += ' WHERE date BETWEEN %s AND %s'
-            params = [start_date, end_date]
-        elif start_date:
-            query += ' WHERE date >= %s'
-            params = [start_date]
-        elif end_date:
-            query += ' WHERE date <= %s'
-            params = [end_date]
-        query += ' ORDER BY date, zone_name, resource_subtype;'
-        cur.execute(query, params)
-        balance_data = cur.fetchall()
+        for table, key in SHARDED_KEYS.items():
+            cur.execute(f'SELECT COALESCE(MAX({key}), 0) FROM {table};')
+            top[table] = max(top[table], cur.fetchone()[0])
         cur.close()
         conn.close()
-        return render_template(
-            'balance/list.html',
-            balance_data=balance_data,
-            start_date=start_date,
-            end_date=end_date
-        )
-    except Exception as e:
-        flash(f'Ошибка при загрузке баланса: {e}', 'error')
-        return redirect(url_for('index'))
+    step = len(shards)
+    for index, shard in enumerate(shards):
+        conn = get_db_connection(shard=shard)
+        cur = conn.cursor()
+        for table, key in SHARDED_KEYS.items():
+            cur.execute('SELECT pg_get_serial_sequence(%s, %s);', (table, key))
+            sequence = cur.fetchone()[0]
+            # Первый свободный ключ шарда выше максимума по всем шардам
+            start = (top[table] // step + 1) * step + index
+            cur.execute(f'ALTER SEQUENCE {sequence} INCREMENT BY {step} RESTART WITH {start};')
+        conn.commit()
+        cur.close()
+        conn.close()
+        click.echo(f'{shard}: ключи с остатком {index} по модулю {step}')
 
-# === Страница выбора отчёта ===
-@app.route('/reports')
-def report_select():
-    return render_template('reports/select.html')
 
-# === Формирование отчёта ===
-@app.route('/reports/generate', methods=['POST'])
-def generate_report():
-    report_type = request.form.get('report_type')
-    start_date = request.form.get('start_date')
-    end_date = request.form.get('end_date')
-    action = request.form.get('action')  # 'preview' или 'csv'
+@cli_command
+@click.group('partitions')
+def partitions_cli():
+    """Обслуживание помесячных секций таблиц с датой."""
 
-    if not (report_type and start_date and end_date):
-        flash('Выберите тип отчёта и укажите период!', 'error')
-        return redirect(url_for('report_select'))
 
-    titles = {
-        'balance': 'Отчёт по балансу мощностей',
-        'load': 'Отчёт нагрузка за период',
-        'requirement': 'Отчёт потребность за период',
-        'capacity': 'Отчёт доступность за период'
-    }
-    title = titles.get(report_type, 'Отчёт')
+@partitions_cli.command('create')
+@click.option('--months-ahead', default=12, show_default=True, help='На сколько месяцев вперёд создать секции.')
+def partitions_create(months_ahead):
+    """Заранее создаёт секции с текущего месяца на months-ahead вперёд (на всех шардах).
 
-    data = []
-    headers = []
-    try:
-        conn = get_db_connection()
+    Веб-запросы секций не создают: команда запускается по расписанию, например
+    ежедневно из cron — `flask partitions create --months-ahead 12`. Документ на месяц
+    дальше горизонта отклоняется с подсказкой запустить её с большим --months-ahead."""
+    for shard in shard_names():
+        conn = get_db_connection(shard=shard)
         cur = conn.cursor()
-        if report_type == 'balance':
-            cur.execute('''
-                SELECT date, zone_name, resource_subtype, required_hours, available_hours, balance
-                FROM v_capacity_balance
-                WHERE date BETWEEN %s AND %s
-                ORDER BY date, zone_name, resource_subtype;
-            ''', (start_date, end_date))
-            raw_data = cur.fetchall()
-            data = [(row[0], row[1], row[2], round(row[3], 2), round(row[4], 2), round(row[5], 2)) for row in raw_data]
-            headers = ['Дата', 'Зона', 'Ресурс', 'Требуемо, ч', 'Доступно, ч', 'Баланс, ч']
-        elif report_type == 'load':
-            cur.execute('''
-                SELECT d.doc_date, d.doc_number, c.name, p.name, i.qty, i.unit_type
-                FROM inbound_documents d
-                JOIN inbound_items i ON d.doc_id = i.doc_id
-                JOIN clients c ON d.client_id = c.client_id
-                JOIN products p ON i.sku_id = p.sku_id
-                WHERE d.doc_date BETWEEN %s AND %s AND d.validated = TRUE
-                ORDER BY d.doc_date, d.doc_number;
-            ''', (start_date, end_date))
-            raw_data = cur.fetchall()
-            data = [(row[0], row[1], row[2], row[3], round(row[4], 2), row[5]) for row in raw_data]
-            headers = ['Дата', 'Документ', 'Клиент', 'Товар', 'Кол-во', 'Ед.изм.']
-        elif report_type == 'requirement':
-            cur.execute('''
-                SELECT date, doc_number, zone_name, resource_type, required_units
-                FROM v_resource_requirements r
-                JOIN zones z ON r.zone_id = z.zone_id
-                WHERE date BETWEEN %s AND %s
-                ORDER BY date, doc_number;
-            ''', (start_date, end_date))
-            raw_data = cur.fetchall()
-            data = [(row[0], row[1], row[2], row[3], round(row[4], 2)) for row in raw_data]
-            headers = ['Дата', 'Документ', 'Зона', 'Ресурс', 'Требуемо, ед.']
-        elif report_type == 'capacity':
+        for table in PARTITIONED_TABLES:
             cur.execute('''
-                SELECT ac.date, r.name, r.subtype, ac.available_hours
-                FROM available_capacities ac
-                JOIN resources r ON ac.resource_id = r.resource_id
-                WHERE ac.date BETWEEN %s AND %s
-                ORDER BY ac.date, r.name;
-            ''', (start_date, end_date))
-            raw_data = cur.fetchall()
-            data = [(row[0], row[1], row[2], round(row[3], 2)) for row in raw_data]
-            headers = ['Дата', 'Ресурс', 'Подтип', 'Доступно, ч']
+                SELECT ensure_month_partitions(%s, current_date, (current_date + %s * interval '1 month')::date);
+            ''', (table, months_ahead))
+        conn.commit()
         cur.close()
         conn.close()
-    except Exception as e:
-        flash(f'Ошибка при формировании отчёта: {e}', 'error')
-        return redirect(url_for('report_select'))
+    click.echo(f'Секции созданы на {months_ahead} мес. вперёд')
 
-    # === Обработка действий ===
-    if action == 'csv':
-        output = StringIO()
-        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(headers)
-        for row in data:
-            writer.writerow(row)
-        output.seek(0)
-        response = make_response(output.getvalue())
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8-sig'
-        response.headers['Content-Disposition'] = f'attachment; filename=report_{report_type}_{start_date}_{end_date}.csv'
-        return response
-    else:  # preview
-        return render_template('reports/preview.html', title=title, headers=headers, data=data, start_date=start_date, end_date=end_date)
 
-def generate_recommendations_from_balance(balance_data):
-    recommendations = []
-    for row in balance_data:
-        date, zone, resource, required, available, balance = row
-        balance = float(balance)
-        rec_text = ""
-        is_staff = any(t in resource for t in ['Приёмщик', 'Грузчик', 'Контролёр'])
-        is_equipment = any(t in resource for t in ['Ричтрак', 'Паллетоперевозчик', 'Тележка'])
-        if balance < -2.0:
-            if is_staff:
-                rec_text = "Назначить дополнительного сотрудника на смену"
-            elif is_equipment:
-                rec_text = "Рассмотреть аренду дополнительной техники на пиковые дни"
-        elif balance < 0:
-            if is_staff:
-                rec_text = "Привлечь сверхурочные часы для текущего сотрудника"
-            elif is_equipment:
-                rec_text = "Проверить график ТО — возможно, техника простаивает"
-        elif balance > 3.0:
-            rec_text = "Переназначить ресурс на другую зону или сократить смену"
-        else:
-            continue
-        recommendations.append({
-            'date': date,
-            'zone': zone,
-            'resource': resource,
-            'balance': round(balance, 2),
-            'recommendation': rec_text,
-            'type': 'Дефицит' if balance < 0 else 'Избыток'
-        })
-    return recommendations
+@partitions_cli.command('archive')
+@click.option('--keep-months', default=36, show_default=True, help='Сколько последних месяцев оставить в работе.')
+def partitions_archive(keep_months):
+    """Переносит месяцы старше keep-months в сжатый архив partition_archive (на всех шардах)."""
+    for shard in shard_names():
+        conn = get_db_connection(shard=shard)
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT (date_trunc('month', current_date) - %s * interval '1 month')::date;", (keep_months,)
+        )
+        before = cur.fetchone()[0]
+        for table, date_column in PARTITIONED_TABLES.items():
+            cur.execute('SELECT archive_month_partitions(%s, %s);', (table, before))
+            click.echo(f'{shard}/{table}: в архив перенесено месяцев: {cur.fetchone()[0]} (до {before})')
+            # Отсоединение секции триггеры не видят: версии её строк закрываются здесь
+            cur.execute(f'''
+                UPDATE {table}_history SET valid = tstzrange(lower(valid), greatest(lower(valid), now()))
+                WHERE upper_inf(valid) AND {date_column} < %s;
+            ''', (before,))
+        conn.commit()
+        cur.close()
+        conn.close()
 
-@app.route('/recommendations', methods=['GET', 'POST'])
-def recommendations_view():
-    if request.method == 'POST':
-        start_date = request.form.get('start_date')
-        end_date = request.form.get('end_date')
-        action = request.form.get('action')
-    else:
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        action = None
 
-    try:
-        conn = get_db_connection()
+@cli_command
+@click.group('history')
+def history_cli():
+    """История изменений (sql/011_history.sql)."""
+
+
+@history_cli.command('purge')
+@click.option('--days', default=730, show_default=True, help='Сколько дней хранить закрытые версии.')
+def history_purge(days):
+    """Удаляет версии, переставшие быть текущими раньше заданного срока (на всех шардах)."""
+    for shard in shard_names():
+        conn = get_db_connection(shard=shard)
         cur = conn.cursor()
-        query = '''
-            SELECT
-                date, zone_name, resource_subtype,
-                required_hours, available_hours, balance
-            FROM v_capacity_balance
-            WHERE balance != 0
-        '''
-        params = []
-        if start_date and end_date:
-            query += ' AND date BETWEEN %s AND %s'
-            params = [start_date, end_date]
-        elif start_date:
-            query += ' AND date >= %s'
-            params = [start_date]
-        elif end_date:
-            query += ' AND date <= %s'
-            params = [end_date]
-        query += ' ORDER BY date, zone_name, resource_subtype;'
-        cur.execute(query, params)
-        balance_data = cur.fetchall()
+        snapshot_tables = [table for table, _, _ in REQUIREMENT_SNAPSHOTS.values()]
+        for table in [*HISTORY_TABLES, *snapshot_tables]:
+            cur.execute(f'''
+                DELETE FROM {table}_history
+                WHERE isempty(valid) OR upper(valid) < now() - %s * interval '1 day';
+            ''', (days,))
+            click.echo(f'{shard}/{table}: удалено версий: {cur.rowcount}')
+        conn.commit()
         cur.close()
         conn.close()
-        recommendations = generate_recommendations_from_balance(balance_data)
 
-        if action == 'csv':
-            output = StringIO()
-            writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(['Дата', 'Зона', 'Ресурс', 'Баланс, ч', 'Тип', 'Рекомендация'])
-            for rec in recommendations:
-                writer.writerow([
-                    rec['date'],
-                    rec['zone'],
-                    rec['resource'],
-                    rec['balance'],
-                    rec['type'],
-                    rec['recommendation']
-                ])
-            output.seek(0)
-            response = make_response(output.getvalue())
-            response.headers['Content-Type'] = 'text/csv; charset=utf-8-sig'
-            response.headers['Content-Disposition'] = f'attachment; filename=recommendations_{start_date or "all"}_{end_date or "all"}.csv'
-            return response
-        else:
-            return render_template(
-                'recommendations/list.html',
-                recommendations=recommendations,
-                start_date=start_date,
-                end_date=end_date
-            )
-    except Exception as e:
-        flash(f'Ошибка при загрузке рекомендаций: {e}', 'error')
-        return redirect(url_for('index'))
 
-# === Запуск приложения ===
+@cli_command
+@click.group('data-quality')
+def data_quality_cli():
+    """Проверки качества данных (sql/012_data_quality.sql)."""
+
+
+@data_quality_cli.command('scan')
+@click.option('--full', is_flag=True, help='Проверить весь набор, а не только изменённые области.')
+@click.option('--check', 'checks', multiple=True, type=click.Choice(list(DATA_QUALITY_CHECKS)),
+              help='Только эта проверка (можно несколько раз).')
+def data_quality_scan(full, checks):
+    """Перепроверяет изменённые области или, с --full, весь набор (на всех шардах).
+
+    Запускается по расписанию, например из cron: `flask data-quality scan` каждые
+    10 минут и `flask data-quality scan --full` раз в сутки ночью. Параллельный прогон
+    той же проверки пропускается (advisory-блокировка), так что пересечения безопасны."""
+    findings = scan_data_quality(full=full, checks=checks or None)
+    for name, count in findings.items():
+        click.echo(f"{DATA_QUALITY_CHECKS[name]['title']}: {count}")
+
+
+# === Фабрика приложения ===
+# Каталог скомпилированных шаблонов, общий для воркеров; по умолчанию — во временном каталоге пользователя
+TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR')
+
+
+def create_app():
+    """Создаёт Flask-приложение. Продакшен: gunicorn -c gunicorn.conf.py 'app:create_app()'"""
+    app = Flask(__name__)
+    app.secret_key = os.getenv('SECRET_KEY', 'warehouse_capacity_secret_key_2025')  # Обязателен для flash-сообщений
+    # Новый воркер берёт байт-код шаблонов с диска, а не компилирует их заново
+    app.jinja_options = {
+        **app.jinja_options,
+        'bytecode_cache': FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+        'extensions': [FragmentCacheExtension],
+    }
+    for rule, view_func, options in _routes:
+        app.add_url_rule(rule, view_func=view_func, **options)
+    for command in _cli_commands:
+        app.cli.add_command(command)
+    app.after_request(invalidate_table_versions)
+    app.after_request(remember_write_position)
+    app.after_request(flush_metrics)
+    app.teardown_appcontext(release_db_connections)
+    app.add_template_filter(html_cells, 'cells')
+    before_render_template.connect(_template_render_started, app)
+    template_rendered.connect(_template_rendered, app)
+    return app
+
+
+@cli_command
+@click.command('compile-templates')
+@with_appcontext
+def compile_templates():
+    """Заполняет кеш байт-кода шаблонов (при выкладке, до старта воркеров)."""
+    names = current_app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        current_app.jinja_env.get_template(name)
+    click.echo(f'Скомпилировано шаблонов: {len(names)}')
+
+
+# Приложение уровня модуля — для `flask run`, `python app.py` и `gunicorn app:app`
+app = create_app()
+
+
+# === Запуск приложения (сервер разработки) ===
 if __name__ == '__main__':
     print("🚀 Запуск приложения 'Информационная система оценки мощностей склада'...")
     port = int(os.environ.get('PORT', 5001))
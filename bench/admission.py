@@ -0,0 +1,157 @@
+"""Допуск тяжёлых запросов: быстрые страницы под нагрузкой отчётами.
+
+Поднимает gunicorn (gunicorn.conf.py) и одновременно гоняет клиентов, строящих
+отчёт /reports/generate за период, и клиентов, открывающих лёгкую страницу
+(по умолчанию /inbound). Печатает p50/p95 лёгкой страницы без отчётов и под ними,
+сколько отчётов допущено и сколько отклонено (redirect с flash), а также
+метрики admission_* из /metrics. С --max-p95 завершается с кодом 1, если p95
+лёгкой страницы под нагрузкой больше max-p95 мс.
+
+Запуск (нужна заполненная БД из .env):
+    python bench/admission.py --from 2020-01-01 --to 2025-01-01 --report requirement --max-p95 500
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, path, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            conn.request('GET', path)
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'сервер на порту {port} не поднялся')
+
+
+def light_load(port, path, clients, stop):
+    """Задержки лёгкой страницы, мс, пока не выставлен stop"""
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+        own = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            conn.request('GET', path)
+            conn.getresponse().read()
+            own.append((time.perf_counter() - started) * 1000)
+        conn.close()
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=client) for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    return workers, latencies
+
+
+def report_load(port, body, clients, stop, outcomes):
+    """Клиенты отчётов: 200 — отчёт построен, 302 — отклонён допуском"""
+    def client():
+        while not stop.is_set():
+            # Своя сессия на каждый запрос: клиенты — разные пользователи
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+            conn.request('POST', '/reports/generate', body,
+                         {'Content-Type': 'application/x-www-form-urlencoded'})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            outcomes.append(response.status)
+
+    workers = [threading.Thread(target=client) for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def percentiles(latencies):
+    if not latencies:
+        return 0.0, 0.0
+    latencies.sort()
+    pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)]  # noqa: E731
+    return pick(0.5), pick(0.95)
+
+
+def measure(port, path, light_clients, duration, body=None, report_clients=0):
+    stop = threading.Event()
+    outcomes = []
+    workers, latencies = light_load(port, path, light_clients, stop)
+    if report_clients:
+        workers += report_load(port, body, report_clients, stop, outcomes)
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return percentiles(latencies), outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from', dest='date_from', required=True)
+    parser.add_argument('--to', dest='date_to', required=True)
+    parser.add_argument('--report', default='requirement', help='тип отчёта /reports/generate')
+    parser.add_argument('--path', default='/inbound', help='лёгкая страница')
+    parser.add_argument('--light-clients', type=int, default=4)
+    parser.add_argument('--report-clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='секунд на каждый замер')
+    parser.add_argument('--max-p95', type=float, help='допустимый p95 лёгкой страницы под нагрузкой, мс')
+    args = parser.parse_args()
+    body = urlencode({'report_type': args.report, 'start_date': args.date_from,
+                      'end_date': args.date_to, 'action': 'preview'})
+
+    port = _free_port()
+    # Общий каталог метрик: /metrics собирает admission_* со всех воркеров
+    metrics_dir = tempfile.mkdtemp(prefix='bench-metrics-')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:create_app()'],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, BIND=f'127.0.0.1:{port}', GUNICORN_ACCESS_LOG=os.devnull,
+                 GUNICORN_TIMEOUT='600', METRICS_DIR=metrics_dir),
+    )
+    try:
+        wait_ready(port, args.path)
+        (p50, p95), _ = measure(port, args.path, args.light_clients, args.duration)
+        print(f'{args.path} без отчётов:  p50 {p50:>8.1f} мс, p95 {p95:>8.1f} мс')
+        (p50, p95), outcomes = measure(port, args.path, args.light_clients, args.duration,
+                                       body, args.report_clients)
+        print(f'{args.path} под отчётами: p50 {p50:>8.1f} мс, p95 {p95:>8.1f} мс')
+        print(f'Отчёты {args.report} {args.date_from} — {args.date_to}: построено {outcomes.count(200)}, '
+              f'отклонено {outcomes.count(302)}, прочих ответов {len(outcomes) - outcomes.count(200) - outcomes.count(302)}')
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.request('GET', '/metrics')
+        for line in conn.getresponse().read().decode().splitlines():
+            if line.startswith('admission_'):
+                print(' ', line)
+        conn.close()
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+    if args.max_p95 is not None and p95 > args.max_p95:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
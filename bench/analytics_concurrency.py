@@ -0,0 +1,173 @@
+"""Конкурентность аналитики: синхронные страницы gunicorn против асинхронного пути (analytics_async).
+
+Поднимает оба сервера с одинаковым числом воркеров: gunicorn.conf.py (потоки gthread)
+и uvicorn с analytics_async:app. Для каждого числа одновременных клиентов нагружает
+/balance и /api/analytics/balance с теми же параметрами и печатает запросы/сек,
+p50/p95 и ошибки. Синхронный путь упирается в воркеры × потоки, асинхронный — в пул
+соединений и саму БД.
+
+С --check-cancel дополнительно обрывает запрос клиента через 0.2 с и смотрит
+в pg_stat_activity, остался ли запрос баланса выполняться в БД.
+
+Запуск (нужна заполненная БД из .env):
+    python bench/analytics_concurrency.py --query 'start_date=2025-01-01&end_date=2025-03-31' --check-cancel
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import connect_db  # noqa: E402
+
+SYNC_PATH = '/balance'
+ASYNC_PATH = '/api/analytics/balance'
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_servers(workers, threads):
+    """(процесс, порт) синхронного и асинхронного серверов"""
+    sync_port, async_port = _free_port(), _free_port()
+    sync_server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:create_app()'],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        # Без кеша фрагментов: иначе повторные страницы не доходят до БД
+        env=dict(os.environ, WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads),
+                 BIND=f'127.0.0.1:{sync_port}', GUNICORN_ACCESS_LOG=os.devnull, TEMPLATE_FRAGMENT_CACHE_MB='0'),
+    )
+    async_server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'analytics_async:app', '--port', str(async_port),
+         '--workers', str(workers), '--no-access-log'],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return {'sync': (sync_server, sync_port), 'async': (async_server, async_port)}
+
+
+def wait_ready(port, path, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            conn.request('GET', path)
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'сервер на порту {port} не поднялся')
+
+
+def load(port, path, clients, duration):
+    """Клиенты по keep-alive соединениям в течение duration: (запр/с, p50, p95, ошибки)"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        own = []
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    with lock:
+                        errors[0] += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+                continue
+            own.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=client) for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if not latencies:
+        return 0.0, 0.0, 0.0, errors[0]
+    latencies.sort()
+    percentile = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000  # noqa: E731
+    return len(latencies) / duration, percentile(0.5), percentile(0.95), errors[0]
+
+
+def running_balance_queries():
+    conn = connect_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT count(*) FROM pg_stat_activity
+        WHERE state = 'active' AND query LIKE '%%v_capacity_balance%%' AND pid <> pg_backend_pid();
+    ''')
+    count = cur.fetchone()[0]
+    conn.close()
+    return count
+
+
+def check_cancel(port, path):
+    """Обрывает запрос через 0.2 с: сколько запросов баланса ещё выполняется спустя 1 с"""
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall(f'GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+    time.sleep(0.2)
+    during = running_balance_queries()
+    s.close()
+    time.sleep(1)
+    return during, running_balance_queries()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--query', default='', help='параметры адреса баланса')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='потоков на воркер синхронного сервера')
+    parser.add_argument('--clients', default='1,8,32,128', help='числа одновременных клиентов')
+    parser.add_argument('--duration', type=float, default=10, help='секунд на каждый замер')
+    parser.add_argument('--check-cancel', action='store_true')
+    args = parser.parse_args()
+    suffix = f'?{args.query}' if args.query else ''
+    paths = {'sync': SYNC_PATH + suffix, 'async': ASYNC_PATH + suffix}
+
+    servers = start_servers(args.workers, args.threads)
+    try:
+        for name, (_, port) in servers.items():
+            wait_ready(port, paths[name])
+        print(f'Воркеров: {args.workers}, потоков у синхронного: {args.threads}; {args.duration:.0f} с на замер')
+        print(f'{"клиенты":>8} {"путь":>6} {"запр/с":>9} {"p50, мс":>9} {"p95, мс":>9} {"ошибки":>7}')
+        for clients in map(int, args.clients.split(',')):
+            for name, (_, port) in servers.items():
+                rps, p50, p95, errors = load(port, paths[name], clients, args.duration)
+                print(f'{clients:>8} {name:>6} {rps:>9.1f} {p50:>9.1f} {p95:>9.1f} {errors:>7}')
+        if args.check_cancel:
+            print('Обрыв клиента: запросов баланса в БД — во время запроса / через 1 с после обрыва')
+            for name, (_, port) in servers.items():
+                during, after = check_cancel(port, paths[name])
+                print(f'{name:>6} {during:>3} / {after}')
+    finally:
+        for server, _ in servers.values():
+            # SIGINT — быстрая остановка обоих серверов
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Сравнение баланса двух периодов: эндпоинт /api/balance/compare против двух выгрузок и сверки в памяти.
+
+Прежний путь — как у планировщиков с Excel: баланс каждого периода выгружается
+целиком (fetch_balance_columns), строки раскладываются в словари по (день от начала,
+зона, подтип) и сверяются. Новый — compare_balance: стороны совмещаются в БД,
+строки идут потоком. Печатает время и пик памяти Python (tracemalloc) обоих путей
+и число строк сравнения.
+
+Запуск (нужна заполненная БД из .env):
+    python bench/balance_compare.py --base 2025-01-06:2025-03-30 --compare 2025-03-31:2025-06-22
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def period(value):
+    start, end = value.split(':')
+    return {'from': datetime.strptime(start, '%Y-%m-%d').date(),
+            'to': datetime.strptime(end, '%Y-%m-%d').date(), 'as_of': None}
+
+
+def two_exports(base, compare):
+    """Оба периода целиком в памяти, затем сверка словарями"""
+    sides = []
+    for side in (base, compare):
+        columns = app.fetch_balance_columns(['date BETWEEN %s AND %s'], (side['from'], side['to']))
+        first_day = (side['from'] - app.EPOCH).days
+        sides.append({
+            (columns.days[i] - first_day, columns.zones[columns.zone_codes[i]],
+             columns.subtypes[columns.subtype_codes[i]]): columns.balance[i]
+            for i in range(len(columns))
+        })
+    keys = sides[0].keys() | sides[1].keys()
+    diff = [(key, sides[1].get(key, 0) - sides[0].get(key, 0)) for key in sorted(keys)]
+    return len(diff)
+
+
+def streamed(base, compare):
+    return sum(1 for _ in app.compare_balance(base, compare))
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = func(*args)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base', type=period, required=True, help='ГГГГ-ММ-ДД:ГГГГ-ММ-ДД')
+    parser.add_argument('--compare', type=period, required=True, help='ГГГГ-ММ-ДД:ГГГГ-ММ-ДД')
+    args = parser.parse_args()
+
+    application = app.create_app()
+    with application.test_request_context('/api/balance/compare'):
+        print(f'{"путь":>18} {"время, с":>9} {"пик, МиБ":>9} {"строк":>9}')
+        for name, func in (('две выгрузки', two_exports), ('compare_balance', streamed)):
+            elapsed, peak, rows = measure(func, args.base, args.compare)
+            print(f'{name:>18} {elapsed:>9.2f} {peak / 2 ** 20:>9.1f} {rows:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Задержка расчёта баланса и потребности (поступления + отгрузки) за период.
+
+Выполняет запросы страниц /balance и /requirements напрямую к БД из .env
+по N раз, печатает p50/p95 и число строк. С --budget-ms завершается с кодом 1,
+если p95 любого запроса превышает бюджет.
+
+Запуск (нужна заполненная БД, по умолчанию — последний год):
+    python bench/balance_latency.py --budget-ms 300
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import connect_db  # noqa: E402
+
+QUERIES = {
+    'баланс': '''
+        SELECT date, zone_name, resource_subtype,
+               ROUND(required_hours, 2), ROUND(available_hours, 2), ROUND(balance, 2)
+        FROM v_capacity_balance
+        WHERE date BETWEEN %s AND %s
+        ORDER BY date, zone_name, resource_subtype;
+    ''',
+    'потребность': '''
+        SELECT r.date, r.doc_number, z.name, r.resource_type, ROUND(r.required_units, 2)
+        FROM v_resource_requirements r
+        JOIN zones z ON r.zone_id = z.zone_id
+        WHERE r.date BETWEEN %s AND %s
+        ORDER BY r.date, r.doc_number;
+    ''',
+}
+
+
+def measure(cur, sql, params, repeats):
+    latencies = []
+    rows = 0
+    for _ in range(repeats):
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        rows = len(cur.fetchall())
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    percentile = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+    return percentile(0.5), percentile(0.95), rows
+
+
+def main():
+    today = datetime.date.today()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from', dest='date_from', default=str(today - datetime.timedelta(days=365)))
+    parser.add_argument('--to', dest='date_to', default=str(today))
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--budget-ms', type=float, help='допустимый p95, мс')
+    args = parser.parse_args()
+
+    conn = connect_db()
+    cur = conn.cursor()
+    print(f'Период {args.date_from} — {args.date_to}, повторов: {args.repeats}')
+    print(f'{"запрос":>12} {"строк":>8} {"p50, мс":>9} {"p95, мс":>9}')
+    over_budget = False
+    for name, sql in QUERIES.items():
+        p50, p95, rows = measure(cur, sql, (args.date_from, args.date_to), args.repeats)
+        over_budget |= args.budget_ms is not None and p95 > args.budget_ms
+        print(f'{name:>12} {rows:>8} {p50:>9.1f} {p95:>9.1f}')
+    conn.close()
+    if over_budget:
+        print(f'p95 превышает бюджет {args.budget_ms} мс')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Память на баланс за период: кортежи из курсора против BalanceColumns.
+
+Строки генерируются так, как их отдаёт psycopg2 (новые объекты строк, Decimal, date
+на каждую ячейку), и проходят оба пути отчёта по балансу: прежний (fetchall +
+округлённая копия кортежей) и колоночный. Печатает удерживаемую и пиковую
+память по tracemalloc и время заполнения. БД не нужна.
+
+Запуск:
+    python bench/balance_memory.py --days 365 --zones 40 --subtypes 12
+"""
+import argparse
+import datetime
+import decimal
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import BalanceColumns, EPOCH  # noqa: E402
+
+
+def tuple_rows(args):
+    """Строки v_capacity_balance в том виде, в каком их отдаёт курсор"""
+    start = datetime.date(2025, 1, 1)
+    for day in range(args.days):
+        date = start + datetime.timedelta(days=day)
+        for zone in range(args.zones):
+            for subtype in range(args.subtypes):
+                required = decimal.Decimal(day % 17) / 3
+                available = decimal.Decimal(zone % 11) / 2
+                yield (date, f'Зона {zone}', f'Подтип {subtype}', required, available, available - required)
+
+
+def column_rows(args):
+    """Те же строки в запросе для BalanceColumns: дни числом, часы float8"""
+    start = (datetime.date(2025, 1, 1) - EPOCH).days
+    for day in range(args.days):
+        for zone in range(args.zones):
+            for subtype in range(args.subtypes):
+                required = (day % 17) / 3
+                available = (zone % 11) / 2
+                yield (start + day, f'Зона {zone}', f'Подтип {subtype}', required, available, available - required)
+
+
+def tuples_path(args):
+    raw_data = list(tuple_rows(args))
+    data = [(row[0], row[1], row[2], round(row[3], 2), round(row[4], 2), round(row[5], 2)) for row in raw_data]
+    return raw_data, data
+
+
+def columns_path(args):
+    columns = BalanceColumns()
+    columns.extend(column_rows(args))
+    return columns
+
+
+def measure(name, func, args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(args)
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    print(f'{name:>12} {retained / 2 ** 20:>12.1f} {peak / 2 ** 20:>10.1f} {elapsed:>8.2f}')
+    return retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--zones', type=int, default=40)
+    parser.add_argument('--subtypes', type=int, default=12)
+    args = parser.parse_args()
+
+    print(f'Ячеек баланса: {args.days * args.zones * args.subtypes}')
+    print(f'{"путь":>12} {"держит, МБ":>12} {"пик, МБ":>10} {"сек.":>8}')
+    before = measure('кортежи', tuples_path, args)
+    after = measure('колонки', columns_path, args)
+    print(f'Экономия памяти: в {before / after:.1f} раза')
+
+
+if __name__ == '__main__':
+    main()
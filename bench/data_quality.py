@@ -0,0 +1,85 @@
+"""Проверки качества данных: полный прогон против перепроверки изменённых областей.
+
+Выполняет полный прогон каждой проверки, затем ставит в очередь --dirty случайных
+областей (товаров или зон) и выполняет обычный прогон; печатает время обоих, число
+находок и время сводки и первой страницы просмотра. Запись в очередь делается напрямую,
+без изменения данных, — находки от этого не меняются. С --max-ms завершается с кодом 1,
+если обычный прогон какой-либо проверки дольше.
+
+Запуск (нужна заполненная БД из .env с применённой sql/012_data_quality.sql):
+    python bench/data_quality.py --dirty 500 --max-ms 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+# Откуда брать области для очереди: проверка -> запрос (scope_id, day)
+SCOPES = {
+    'product_units': 'SELECT sku_id, NULL::date FROM products',
+    'inbound_norm': 'SELECT sku_id, NULL::date FROM products',
+    'capacity_gap': 'SELECT DISTINCT zone_id, doc_date FROM inbound_requirement_snapshots',
+    'zone_resources': 'SELECT zone_id, NULL::date FROM zones',
+}
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def scan(conn, name, full):
+    cur = conn.cursor()
+    count = app.scan_data_quality_check(cur, name, full)
+    conn.commit()
+    cur.close()
+    return count
+
+
+def mark_dirty(conn, name, dirty):
+    cur = conn.cursor()
+    cur.execute(f'''
+        INSERT INTO data_quality_dirty (check_name, scope_id, day)
+        SELECT %s, s.* FROM ({SCOPES[name]}) s ORDER BY random() LIMIT %s;
+    ''', (name, dirty))
+    conn.commit()
+    cur.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dirty', type=int, default=500, help='областей в очереди перед обычным прогоном')
+    parser.add_argument('--max-ms', type=float, help='допустимое время обычного прогона проверки, мс')
+    args = parser.parse_args()
+
+    conn = app.connect_db()
+    too_slow = False
+    print(f'Шард по умолчанию; областей в очереди: {args.dirty}; мс')
+    print(f'{"проверка":>16} {"полный":>9} {"обычный":>9} {"находок":>9}')
+    for name in app.DATA_QUALITY_CHECKS:
+        full_ms, count = timed(scan, conn, name, True)
+        mark_dirty(conn, name, args.dirty)
+        incremental_ms, _ = timed(scan, conn, name, False)
+        too_slow |= args.max_ms is not None and incremental_ms > args.max_ms
+        print(f'{name:>16} {full_ms:>9.1f} {incremental_ms:>9.1f} {count:>9}')
+    conn.close()
+
+    application = app.create_app()
+    with application.test_client() as client:
+        elapsed, response = timed(client.get, '/data-quality')
+        print(f'{"сводка":>16} {elapsed:>9.1f} мс, {response.status_code}')
+        for name in app.DATA_QUALITY_CHECKS:
+            elapsed, response = timed(client.get, f'/data-quality/{name}')
+            print(f'{name:>16} {elapsed:>9.1f} мс первая страница, {response.status_code}')
+    if too_slow:
+        print(f'Обычный прогон дольше {args.max_ms} мс')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Баланс «на момент» по истории против живого баланса за неделю (sql/011_history.sql).
+
+Выполняет запрос страницы /balance за неделю по v_capacity_balance и по
+capacity_balance_as_of() на несколько моментов в прошлом, печатает p50/p95
+и отношение к живому запросу. С --max-ratio завершается с кодом 1, если p95
+исторического запроса больше p95 живого в max-ratio раз.
+
+Запуск (нужна заполненная БД с накопленной историей):
+    python bench/history_balance.py --from 2025-01-06 --max-ratio 1.5
+"""
+import argparse
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import connect_db  # noqa: E402
+from balance_latency import measure  # noqa: E402
+
+BALANCE_SQL = '''
+    SELECT date, zone_name, resource_subtype,
+           ROUND(required_hours, 2), ROUND(available_hours, 2), ROUND(balance, 2)
+    FROM {source}
+    WHERE date BETWEEN %s AND %s
+    ORDER BY date, zone_name, resource_subtype;
+'''
+
+# На сколько часов назад строится срез
+AS_OF_HOURS = (0, 24, 24 * 7, 24 * 30)
+
+
+def main():
+    today = datetime.date.today()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from', dest='date_from', default=str(today - datetime.timedelta(days=7)))
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--max-ratio', type=float, help='допустимое отношение p95 к живому запросу')
+    args = parser.parse_args()
+    date_from = datetime.date.fromisoformat(args.date_from)
+    date_to = date_from + datetime.timedelta(days=6)
+
+    conn = connect_db()
+    cur = conn.cursor()
+    print(f'Неделя {date_from} — {date_to}, повторов: {args.repeats}')
+    print(f'{"срез":>16} {"строк":>8} {"p50, мс":>9} {"p95, мс":>9} {"к живому":>9}')
+    live_p50, live_p95, rows = measure(
+        cur, BALANCE_SQL.format(source='v_capacity_balance'), (date_from, date_to), args.repeats
+    )
+    print(f'{"живой":>16} {rows:>8} {live_p50:>9.1f} {live_p95:>9.1f} {1:>9.2f}')
+    too_slow = False
+    for hours in AS_OF_HOURS:
+        p50, p95, rows = measure(
+            cur, BALANCE_SQL.format(source="capacity_balance_as_of(now() - %s * interval '1 hour')"),
+            (hours, date_from, date_to), args.repeats
+        )
+        ratio = p95 / live_p95 if live_p95 else 0
+        too_slow |= args.max_ratio is not None and ratio > args.max_ratio
+        print(f'{f"{hours} ч назад":>16} {rows:>8} {p50:>9.1f} {p95:>9.1f} {ratio:>9.2f}')
+    conn.close()
+    if too_slow:
+        print(f'Срез по истории медленнее живого запроса больше чем в {args.max_ratio} раз')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Пакет отчётов за период: параллельная сборка ZIP против отчётов по очереди.
+
+Строит каждый отчёт пакета по отдельности (как пять последовательных запросов),
+затем весь пакет export_report_bundle и печатает время каждого, их сумму, время
+пакета и его отношение к самому медленному отчёту. С --max-ratio завершается
+с кодом 1, если пакет дольше самого медленного отчёта больше чем в max-ratio раз.
+
+Запуск (нужна заполненная БД из .env):
+    python bench/report_bundle.py --from 2025-01-01 --to 2025-01-31 --max-ratio 1.3
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from', dest='date_from', required=True)
+    parser.add_argument('--to', dest='date_to', required=True)
+    parser.add_argument('--max-ratio', type=float, help='допустимое отношение пакета к самому медленному отчёту')
+    args = parser.parse_args()
+
+    application = app.create_app()
+    with application.test_request_context('/reports/bundle', method='POST'):
+        print(f'Период {args.date_from} — {args.date_to}')
+        singles = {}
+        elapsed, parts = timed(app._bundle_balance, args.date_from, args.date_to)
+        singles['balance + recommendations'] = elapsed
+        for report_type in ('load', 'requirement', 'capacity'):
+            elapsed, more = timed(app._bundle_report, report_type, args.date_from, args.date_to)
+            singles[report_type] = elapsed
+            parts += more
+        for name, part in parts:
+            part.seek(0, os.SEEK_END)
+            print(f'  {name:>16}: {part.tell() / 1024:>10.0f} КиБ')
+            part.close()
+        for name, elapsed in singles.items():
+            print(f'{name:>28} {elapsed:>7.2f} с')
+        slowest = max(singles.values())
+        print(f'{"по очереди, сумма":>28} {sum(singles.values()):>7.2f} с')
+
+        elapsed, response = timed(app.export_report_bundle, args.date_from, args.date_to)
+        response.response.file.seek(0, os.SEEK_END)
+        size = response.response.file.tell()
+        response.close()
+    ratio = elapsed / slowest if slowest else 0
+    print(f'{"пакет ZIP":>28} {elapsed:>7.2f} с, {size / 1024:.0f} КиБ, {ratio:.2f} к самому медленному')
+    if args.max_ratio is not None and ratio > args.max_ratio:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
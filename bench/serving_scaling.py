@@ -0,0 +1,112 @@
+"""Масштабирование пропускной способности по числу воркеров gunicorn.
+
+Для каждого числа воркеров (1, 2, 4, … до числа ядер) поднимает сервер
+с gunicorn.conf.py, нагружает указанный адрес параллельными клиентами
+и печатает запросы/сек, задержки p50/p95 и ускорение относительно одного воркера.
+
+Запуск (нужна заполненная БД из .env):
+    python bench/serving_scaling.py --path '/balance?start_date=2025-01-01&end_date=2025-01-31'
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _client(port, path, duration, result_queue):
+    """Один клиент: запросы по keep-alive соединению до истечения duration"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+    result_queue.put((latencies, errors))
+
+
+def _wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/reports')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('сервер не поднялся')
+
+
+def run(workers, args):
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(args.threads),
+               BIND=f'127.0.0.1:{args.port}', GUNICORN_ACCESS_LOG='/dev/null')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:create_app()'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_ready(args.port)
+        result_queue = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=_client, args=(args.port, args.path, args.duration, result_queue))
+            for _ in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        results = [result_queue.get() for _ in clients]
+        for client in clients:
+            client.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    latencies = sorted(latency for chunk, _ in results for latency in chunk)
+    errors = sum(count for _, count in results)
+    if not latencies:
+        return 0.0, 0.0, 0.0, errors
+    percentile = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+    return len(latencies) / args.duration, percentile(0.5), percentile(0.95), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='/balance', help='адрес для нагрузки')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--duration', type=float, default=15, help='секунд на каждый замер')
+    parser.add_argument('--clients', type=int, default=32, help='параллельных клиентов')
+    parser.add_argument('--threads', type=int, default=4, help='потоков на воркер')
+    args = parser.parse_args()
+
+    cores = multiprocessing.cpu_count()
+    counts = sorted({1, cores} | {2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores})
+    print(f'{args.path}: {args.clients} клиентов, {args.threads} потоков на воркер, ядер: {cores}')
+    print(f'{"воркеры":>8} {"запр/с":>10} {"p50, мс":>9} {"p95, мс":>9} {"ошибки":>7} {"ускорение":>10}')
+    baseline = None
+    for workers in counts:
+        rps, p50, p95, errors = run(workers, args)
+        baseline = baseline or rps or None
+        speedup = rps / baseline if baseline else 0
+        print(f'{workers:>8} {rps:>10.1f} {p50:>9.1f} {p95:>9.1f} {errors:>7} {speedup:>9.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Скорость и корректность плана смен (plan_staffing) на синтетических данных.
+
+Строит месяц на N сотрудников по нескольким складам, зонам и подтипам со случайным
+дефицитом и избытком, запускает планировщик и проверяет: дефицит закрыт полностью,
+избыток зон не перерасходован, дневной и недельный пределы часов не нарушены.
+БД не нужна. С --budget-s завершается с кодом 1, если план строится дольше.
+
+Запуск:
+    python bench/staffing_planner.py --staff 500 --days 31 --budget-s 5
+"""
+import argparse
+import collections
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+SUBTYPES = ['Приёмщик', 'Грузчик', 'Контролёр', 'Комплектовщик']
+
+
+def synthesize(staff, days, warehouses, zones, seed):
+    rng = random.Random(seed)
+    start = datetime.date(2025, 3, 3)
+    people = [
+        (rng.randrange(warehouses), resource_id, f'Сотрудник {resource_id}',
+         rng.choice(SUBTYPES), f'Зона {rng.randrange(zones)}')
+        for resource_id in range(1, staff + 1)
+    ]
+    staff_hours = []
+    available = collections.defaultdict(float)
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        for warehouse_id, resource_id, name, subtype, zone in people:
+            # Пять смен по 8 ч в неделю, выходные — по графику сотрудника
+            if (day + resource_id) % 7 < 5:
+                staff_hours.append((date, warehouse_id, resource_id, name, subtype, zone, 8.0))
+                available[date, warehouse_id, zone, subtype] += 8.0
+    balance_cells = [
+        (date, warehouse_id, zone, subtype, round(hours * rng.uniform(-0.4, 0.3), 2))
+        for (date, warehouse_id, zone, subtype), hours in available.items()
+    ]
+    return balance_cells, staff_hours
+
+
+def check(balance_cells, staff_hours, roster):
+    errors = []
+    covered = collections.defaultdict(float)
+    taken = collections.defaultdict(float)
+    hours = collections.defaultdict(float)
+    weekly = collections.defaultdict(float)
+    for date, warehouse_id, _, name, _, _, available in staff_hours:
+        hours[(warehouse_id, name), date] += available
+        weekly[(warehouse_id, name), date - datetime.timedelta(days=date.weekday())] += available
+    for date, action, warehouse_id, zone, subtype, employee, from_zone, planned in roster:
+        covered[date, warehouse_id, zone, subtype] += planned
+        if action == app.STAFFING_MOVE:
+            taken[date, warehouse_id, from_zone, subtype] += planned
+            continue
+        hours[(warehouse_id, employee), date] += planned
+        weekly[(warehouse_id, employee), date - datetime.timedelta(days=date.weekday())] += planned
+    for date, warehouse_id, zone, subtype, balance in balance_cells:
+        cell = (date, warehouse_id, zone, subtype)
+        if balance < 0 and abs(covered[cell] + balance) > 1e-6:
+            errors.append(f'дефицит {cell}: {balance}, закрыто {covered[cell]:.2f}')
+        if taken[cell] > max(balance, 0) + 1e-6:
+            errors.append(f'избыток {cell}: {balance}, отдано {taken[cell]:.2f}')
+    errors += [f'{name} {date}: {total} ч за день' for (name, date), total in hours.items()
+               if total > app.STAFFING_MAX_HOURS_PER_DAY + 1e-6]
+    errors += [f'{name} неделя {week}: {total} ч' for (name, week), total in weekly.items()
+               if total > app.STAFFING_MAX_HOURS_PER_WEEK + 1e-6]
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--staff', type=int, default=500)
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('--warehouses', type=int, default=3)
+    parser.add_argument('--zones', type=int, default=8, help='зон на складе')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--budget-s', type=float, help='допустимое время построения плана, с')
+    args = parser.parse_args()
+
+    balance_cells, staff_hours = synthesize(args.staff, args.days, args.warehouses, args.zones, args.seed)
+    deficits = sum(1 for cell in balance_cells if cell[4] < 0)
+    started = time.perf_counter()
+    roster = app.plan_staffing(balance_cells, staff_hours, set(SUBTYPES))
+    elapsed = time.perf_counter() - started
+
+    actions = collections.Counter(row[1] for row in roster)
+    hires = len({row[5] for row in roster if row[1] == app.STAFFING_HIRE})
+    print(f'Сотрудников {args.staff}, дней {args.days}, ячеек с дефицитом {deficits}')
+    print(f'План: {len(roster)} строк за {elapsed:.2f} с, нанято {hires}')
+    for action, count in actions.most_common():
+        print(f'  {action}: {count}')
+    errors = check(balance_cells, staff_hours, roster)
+    for error in errors[:20]:
+        print('ОШИБКА', error)
+    if errors or (args.budget_s is not None and elapsed > args.budget_s):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
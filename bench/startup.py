@@ -0,0 +1,129 @@
+"""Холодный старт: импорт, создание приложения и время до первого ответа.
+
+В свежих процессах (как новый воркер) измеряет импорт app, create_app() и первые
+ответы страниц без БД — с пустым и с заполненным кешем байт-кода шаблонов
+(TEMPLATE_CACHE_DIR). С --server дополнительно запускает gunicorn с одним воркером
+и меряет время от запуска до первого ответа. Печатает медианы по --repeats запускам.
+
+Запуск:
+    python bench/startup.py --repeats 10 --server
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Страницы без запросов к БД
+PAGES = ['/reports', '/search']
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+client = application.test_client()
+timings = []
+for path in sys.argv[1:]:
+    before = time.perf_counter()
+    client.get(path)
+    timings.append(time.perf_counter() - before)
+print(json.dumps({
+    'import': imported - started,
+    'create_app': created - imported,
+    'first_page': timings[0],
+    'all_pages': sum(timings),
+}))
+'''
+
+
+def probe(cache_dir):
+    env = dict(os.environ, TEMPLATE_CACHE_DIR=cache_dir)
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, *PAGES], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_first_response(cache_dir, timeout=30):
+    """Секунды от запуска gunicorn до первого ответа страницы"""
+    port = _free_port()
+    env = dict(os.environ, TEMPLATE_CACHE_DIR=cache_dir, WEB_CONCURRENCY='1', GUNICORN_ACCESS_LOG=os.devnull)
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+         'app:create_app()'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', PAGES[0])
+                if conn.getresponse().status == 200:
+                    return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError('сервер не ответил')
+    finally:
+        # SIGINT — быстрая остановка, без ожидания graceful_timeout
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--server', action='store_true', help='мерить и запуск gunicorn')
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='jinja-bench-')
+    try:
+        results = {'пустой кеш': [], 'тёплый кеш': []}
+        for _ in range(args.repeats):
+            shutil.rmtree(cache_dir)
+            os.mkdir(cache_dir)
+            results['пустой кеш'].append(probe(cache_dir))
+            results['тёплый кеш'].append(probe(cache_dir))
+
+        print(f'Медианы по {args.repeats} запускам, мс')
+        print(f'{"шаблоны":>12} {"импорт":>8} {"create_app":>11} {"1-й ответ":>10} {"все страницы":>13}')
+        for name, runs in results.items():
+            median = {key: statistics.median(run[key] for run in runs) * 1000 for key in runs[0]}
+            print(f'{name:>12} {median["import"]:>8.1f} {median["create_app"]:>11.1f} '
+                  f'{median["first_page"]:>10.1f} {median["all_pages"]:>13.1f}')
+
+        if args.server:
+            print('gunicorn, 1 воркер: от запуска до первого ответа, мс')
+            for name in results:
+                runs = []
+                for _ in range(args.repeats):
+                    if name == 'пустой кеш':
+                        shutil.rmtree(cache_dir)
+                        os.mkdir(cache_dir)
+                    runs.append(server_first_response(cache_dir))
+                print(f'{name:>12} {statistics.median(runs) * 1000:>8.1f}')
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""Нагрузочная проверка конкурентной записи поступлений (sql/010_idempotency_locks.sql).
+
+Параллельные клиенты бьют в запущенный сервер, итог проверяется прямо в БД:
+  • дубли формы создания с одним ключом идемпотентности — ровно один документ;
+  • одновременные правки документа с одной row_version — применяется ровно одна;
+  • правки вперемешку с подтверждением — после подтверждения документ не меняется,
+    снимок потребности совпадает с позициями;
+  • правки разных документов — не ждут друг друга (все проходят, печатается время);
+  • ретраи пакетного API с одним Idempotency-Key — пакет применяется один раз.
+Созданные записи удаляются в конце.
+
+Запуск (сервер и БД из .env):
+    python bench/stress_inbound.py --url http://127.0.0.1:5000 --clients 16
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import connect_db  # noqa: E402
+
+DOC_DATE = '2025-01-15'
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def request(base, method, path, form=None, body=None, headers=None):
+    """Запрос без перехода по редиректу: (код, Location, тело)"""
+    data = None
+    headers = dict(headers or {})
+    if form is not None:
+        data = urllib.parse.urlencode(form, doseq=True).encode()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    elif body is not None:
+        data = json.dumps(body).encode()
+        headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(base + path, data=data, method=method, headers=headers)
+    try:
+        with _opener.open(req, timeout=60) as response:
+            return response.status, response.headers.get('Location'), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get('Location'), e.read()
+
+
+def in_parallel(count, target):
+    """Запускает target(i) в count потоках одновременно; результаты по порядку"""
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def run(i):
+        barrier.wait()
+        results[i] = target(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check(ok, message):
+    print(('OK   ' if ok else 'FAIL ') + message)
+    return ok
+
+
+def create_doc(cur, client_id, sku_id, doc_number):
+    cur.execute('''
+        INSERT INTO inbound_documents (client_id, doc_number, doc_date)
+        VALUES (%s, %s, %s) RETURNING doc_id;
+    ''', (client_id, doc_number, DOC_DATE))
+    doc_id = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO inbound_items (doc_id, sku_id, qty, unit_type) VALUES (%s, %s, 1, 'шт');",
+        (doc_id, sku_id)
+    )
+    return doc_id
+
+
+def edit_form(client_id, sku_id, doc_number, qty, row_version):
+    return {
+        'client_id': client_id, 'doc_number': doc_number, 'doc_date': DOC_DATE,
+        'sku_id': [sku_id], 'qty': [qty], 'unit_type': ['шт'], 'row_version': row_version,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=16, help='Параллельных клиентов.')
+    args = parser.parse_args()
+    base = args.url.rstrip('/')
+    prefix = f'STRESS-{uuid.uuid4().hex[:8]}'
+
+    conn = connect_db()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute('SELECT client_id, sku_id FROM products ORDER BY sku_id LIMIT 1;')
+    row = cur.fetchone()
+    if not row:
+        sys.exit('Нужен хотя бы один товар в справочнике')
+    client_id, sku_id = row
+    passed = True
+    keys = []
+
+    try:
+        # 1. Дубли формы создания
+        doc_number = f'{prefix}-create'
+        key = uuid.uuid4().hex
+        keys.append(key)
+        in_parallel(args.clients, lambda i: request(base, 'POST', '/inbound/create', form={
+            'client_id': client_id, 'doc_number': doc_number, 'doc_date': DOC_DATE,
+            'sku_id': [sku_id], 'qty': ['5'], 'unit_type': ['шт'], 'idempotency_key': key,
+        }))
+        cur.execute('SELECT count(*) FROM inbound_documents WHERE doc_number = %s;', (doc_number,))
+        created = cur.fetchone()[0]
+        passed &= check(created == 1, f'create x{args.clients} с одним ключом: документов {created}')
+
+        # 2. Одновременные правки с одной версией
+        doc_number = f'{prefix}-edit'
+        doc_id = create_doc(cur, client_id, sku_id, doc_number)
+        in_parallel(args.clients, lambda i: request(
+            base, 'POST', f'/inbound/edit/{doc_id}',
+            form=edit_form(client_id, sku_id, doc_number, str(i + 2), '1')
+        ))
+        cur.execute('SELECT row_version FROM inbound_documents WHERE doc_id = %s;', (doc_id,))
+        version = cur.fetchone()[0]
+        cur.execute('SELECT count(*) FROM inbound_items WHERE doc_id = %s;', (doc_id,))
+        items = cur.fetchone()[0]
+        passed &= check(version == 2 and items == 1,
+                        f'edit x{args.clients} с версией 1: версия {version}, позиций {items}')
+
+        # 3. Правки вперемешку с подтверждением
+        doc_number = f'{prefix}-validate'
+        doc_id = create_doc(cur, client_id, sku_id, doc_number)
+
+        def edit_or_validate(i):
+            if i % 4 == 0:
+                return request(base, 'POST', f'/inbound/validate/{doc_id}', form={})
+            reader = connect_db()
+            try:
+                with reader.cursor() as c:
+                    c.execute('SELECT row_version FROM inbound_documents WHERE doc_id = %s;', (doc_id,))
+                    current = c.fetchone()[0]
+            finally:
+                reader.close()
+            return request(base, 'POST', f'/inbound/edit/{doc_id}',
+                           form=edit_form(client_id, sku_id, doc_number, str(i + 2), str(current)))
+
+        in_parallel(args.clients, edit_or_validate)
+        cur.execute('SELECT validated, row_version FROM inbound_documents WHERE doc_id = %s;', (doc_id,))
+        validated, version_validated = cur.fetchone()
+        # После подтверждения правки отклоняются: повторная попытка ничего не меняет
+        request(base, 'POST', f'/inbound/edit/{doc_id}',
+                form=edit_form(client_id, sku_id, doc_number, '999', str(version_validated)))
+        cur.execute('SELECT row_version FROM inbound_documents WHERE doc_id = %s;', (doc_id,))
+        version_after = cur.fetchone()[0]
+        cur.execute('''
+            SELECT count(*) FROM (
+                (SELECT zone_id, resource_type, required_units FROM v_resource_requirements
+                 WHERE operation_type = 'inbound' AND doc_id = %s
+                 EXCEPT
+                 SELECT zone_id, resource_subtype, required_hours FROM inbound_requirement_snapshots
+                 WHERE doc_id = %s)
+                UNION ALL
+                (SELECT zone_id, resource_subtype, required_hours FROM inbound_requirement_snapshots
+                 WHERE doc_id = %s
+                 EXCEPT
+                 SELECT zone_id, resource_type, required_units FROM v_resource_requirements
+                 WHERE operation_type = 'inbound' AND doc_id = %s)
+            ) diff;
+        ''', (doc_id, doc_id, doc_id, doc_id))
+        diff = cur.fetchone()[0]
+        passed &= check(validated and version_after == version_validated and diff == 0,
+                        f'edit+validate: подтверждён {validated}, правок после — '
+                        f'{version_after - version_validated}, расхождений со снимком {diff}')
+
+        # 4. Правки разных документов не сериализуются
+        doc_ids = [create_doc(cur, client_id, sku_id, f'{prefix}-many-{i}') for i in range(args.clients)]
+        started = time.perf_counter()
+        in_parallel(args.clients, lambda i: request(
+            base, 'POST', f'/inbound/edit/{doc_ids[i]}',
+            form=edit_form(client_id, sku_id, f'{prefix}-many-{i}', '3', '1')
+        ))
+        elapsed = time.perf_counter() - started
+        cur.execute('SELECT count(*) FROM inbound_documents WHERE doc_id = ANY(%s) AND row_version = 2;',
+                    (doc_ids,))
+        edited = cur.fetchone()[0]
+        passed &= check(edited == len(doc_ids),
+                        f'edit {len(doc_ids)} разных документов: применено {edited} за {elapsed * 1000:.0f} мс')
+
+        # 5. Ретраи пакетного API
+        name = f'{prefix}-client'
+        key = uuid.uuid4().hex
+        keys.append(key)
+        responses = in_parallel(args.clients, lambda i: request(
+            base, 'PUT', '/api/clients', body={'rows': [{'name': name}]},
+            headers={'Idempotency-Key': key}
+        ))
+        cur.execute('SELECT count(*) FROM clients WHERE name = %s;', (name,))
+        inserted = cur.fetchone()[0]
+        same = len({body for _, _, body in responses}) == 1
+        passed &= check(inserted == 1 and same,
+                        f'PUT /api/clients x{args.clients} с одним ключом: строк {inserted}, '
+                        f'ответы {"одинаковые" if same else "различаются"}')
+    finally:
+        cur.execute('DELETE FROM inbound_documents WHERE doc_number LIKE %s;', (prefix + '%',))
+        cur.execute('DELETE FROM clients WHERE name LIKE %s;', (prefix + '%',))
+        cur.execute('DELETE FROM idempotency_keys WHERE key = ANY(%s);', (keys,))
+        cur.close()
+        conn.close()
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
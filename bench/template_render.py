@@ -0,0 +1,144 @@
+"""Рендер больших таблиц: страницы баланса, потребности и предпросмотра отчёта.
+
+Рендерит шаблоны на синтетических строках без БД: прежний вид цикла строк
+(индексы row[i], вложенный цикл по ячейкам), текущие шаблоны без кеша фрагментов
+и, где есть {% cache %}, с ним — первый рендер (промах) и повторный (попадание). Печатает медианы и
+время рендера по шаблонам из метрик. С --budget-ms завершается с кодом 1, если
+рендер страницы без кеша дольше.
+
+Запуск:
+    python bench/template_render.py --rows 100000 --budget-ms 2000
+"""
+import argparse
+import datetime
+import decimal
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import g, render_template  # noqa: E402
+
+import app  # noqa: E402
+
+# Циклы строк в прежнем виде — для сравнения
+BASELINE = {
+    'balance/list.html': '''
+        {% for row in rows %}
+        <tr data-key="{{ row[0] }}|{{ row[1] }}|{{ row[2] }}" style="background-color: {% if row[5] < 0 %}#ffebee{% elif row[5] > 0 %}#e8f5e8{% else %}#fff3e0{% endif %};">
+            <td>{{ row[0] }}</td>
+            <td>{{ row[1] }}</td>
+            <td>{{ row[2] }}</td>
+            <td class="required">{{ row[3] }}</td>
+            <td class="available">{{ row[4] }}</td>
+            <td class="balance">{{ row[5] }}</td>
+            <td class="status">
+                {% if row[5] < 0 %}
+                    <span style="color:red;">⚠️ Дефицит</span>
+                {% elif row[5] > 0 %}
+                    <span style="color:green;">✅ Избыток</span>
+                {% else %}
+                    <span>— В балансе</span>
+                {% endif %}
+            </td>
+        </tr>
+        {% endfor %}''',
+    'requirements/list.html': '''
+        {% for req in rows %}
+        <tr>
+            <td>{{ req[0] }}</td>
+            <td>{{ req[1] }}</td>
+            <td>{{ req[2] }}</td>
+            <td>{{ req[3] }}</td>
+            <td>{{ req[4] }}</td>
+        </tr>
+        {% endfor %}''',
+    'reports/preview.html': '''
+            {% for row in rows %}
+                <tr>
+                    {% for cell in row %}
+                        <td>{{ cell }}</td>
+                    {% endfor %}
+                </tr>
+            {% endfor %}''',
+}
+
+
+def synthesize(rows, seed):
+    rng = random.Random(seed)
+    start = datetime.date(2025, 1, 1)
+    hours = lambda: decimal.Decimal(rng.randrange(0, 20000)) / 100  # noqa: E731
+    balance, requirements = [], []
+    for i in range(rows):
+        date = start + datetime.timedelta(days=i // 400)
+        zone = f'Зона {i % 20}'
+        required, available = hours(), hours()
+        balance.append((date, zone, f'Подтип {i % 7}', required, available, available - required))
+        requirements.append((date, f'ПР-{i // 5:06d}', zone, f'Подтип {i % 7}', required))
+    return {
+        'balance/list.html': dict(balance_data=balance, warehouses=[], live_updates=False),
+        'requirements/list.html': dict(requirements=requirements, warehouses=[]),
+        'reports/preview.html': dict(
+            data=balance, title='Баланс', headers=['Дата', 'Зона', 'Ресурс', 'Треб.', 'Дост.', 'Баланс'],
+            start_date=start, end_date=start + datetime.timedelta(days=rows // 400)
+        ),
+    }
+
+
+def median_ms(render, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        render()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--budget-ms', type=float, help='допустимое время рендера страницы без кеша, мс')
+    args = parser.parse_args()
+
+    application = app.create_app()
+    contexts = synthesize(args.rows, args.seed)
+    too_slow = False
+    print(f'Строк: {args.rows}, повторов: {args.repeats}; медианы, мс')
+    print(f'{"шаблон":>24} {"прежний цикл":>13} {"без кеша":>9} {"промах":>8} {"попадание":>10}')
+    for name, context in contexts.items():
+        with application.test_request_context('/bench'):
+            baseline = application.jinja_env.from_string(BASELINE[name])
+            rows = context.get('balance_data') or context.get('requirements') or context.get('data')
+            before = median_ms(lambda: baseline.render(rows=rows), args.repeats)
+            plain = median_ms(lambda: render_template(name, **context), args.repeats)
+
+            source, _, _ = application.jinja_env.loader.get_source(application.jinja_env, name)
+            if '{% cache' in source:
+                g.data_version = 'bench'
+                missed = median_ms(
+                    lambda: (app.fragment_cache.clear(), render_template(name, **context)), args.repeats
+                )
+                render_template(name, **context)
+                hit = median_ms(lambda: render_template(name, **context), args.repeats)
+                cached = f'{missed:>8.1f} {hit:>10.1f}'
+            else:
+                cached = f'{"—":>8} {"—":>10}'
+        too_slow |= args.budget_ms is not None and plain > args.budget_ms
+        print(f'{name:>24} {before:>13.1f} {plain:>9.1f} {cached}')
+
+    print('Метрики рендера (все прогоны):')
+    for line in app.metrics.render().splitlines():
+        if line.startswith(('template_render_seconds_total', 'template_renders_total')):
+            print(' ', line)
+    if too_slow:
+        print(f'Рендер страницы без кеша дольше {args.budget_ms} мс')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
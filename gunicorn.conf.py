@@ -0,0 +1,58 @@
+# gunicorn.conf.py — продакшен-режим: gunicorn -c gunicorn.conf.py 'app:create_app()'
+#
+# Многопроцессный сервер с потоками в каждом воркере. Параметры задаются
+# переменными окружения, значения по умолчанию — для одной машины.
+#
+# Плавная перезагрузка (новый код и конфигурация, текущие запросы дорабатывают):
+#     kill -HUP <pid мастера>
+# Изменение числа воркеров на ходу: kill -TTIN / -TTOU <pid мастера>
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '5001')}")
+
+# Процессы: по умолчанию 2 × ядра + 1; в каждом — потоки (gthread)
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# Пул соединений воркера не меньше числа его потоков (+ запас на SSE-догрузку)
+os.environ.setdefault('DB_POOL_MAX', str(threads + 2))
+
+# Долгие запросы держат потоки воркера: тяжёлые отчёты и их очередь, выгрузки и потоки
+# SSE страницы баланса — по threads // 8 каждый, вместе не больше половины потоков;
+# остальные всегда свободны для быстрых страниц и форм. У выгрузок свой слот и нет очереди.
+os.environ.setdefault('ADMISSION_CONCURRENCY', str(max(threads // 8, 1)))
+os.environ.setdefault('ADMISSION_QUEUE_SIZE', str(max(threads // 8, 1)))
+os.environ.setdefault('ADMISSION_EXPORT_CONCURRENCY', str(max(threads // 8, 1)))
+
+# SSE (/events/capacity) занимает поток на всё время открытой вкладки /balance, поэтому
+# потоков SSE в воркере не больше SSE_MAX_SUBSCRIBERS, сверх — 503 с retry. При HUP такие
+# потоки ждут graceful_timeout и обрываются (браузер переподключится по Last-Event-ID).
+# В продакшене поток отдаёт асинхронный сервер analytics_async: прокси направляет туда
+# /api/analytics/, а веб-приложению задаётся CAPACITY_EVENTS_URL=/api/analytics/events/capacity —
+# тогда вкладки баланса потоков воркера не занимают вовсе.
+os.environ.setdefault('SSE_MAX_SUBSCRIBERS', str(max(threads // 8, 1)))
+
+# Тяжёлые отчёты считаются долго: воркер, молчащий дольше timeout, перезапускается
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+# Сколько ждать завершения текущих запросов при перезагрузке и остановке
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Периодический перезапуск воркеров ограничивает рост памяти; джиттер — чтобы не все сразу
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# С preload приложение импортируется один раз в мастере (быстрее старт воркеров),
+# но HUP тогда не подхватывает новый код. По умолчанию выключено
+preload_app = os.getenv('GUNICORN_PRELOAD', '0') == '1'
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Соединения с БД не переживают fork: воркер открывает свой пул
+    import app
+    app.reset_pool()
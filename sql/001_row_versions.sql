@@ -0,0 +1,33 @@
+-- Версии строк справочников для оптимистичной блокировки (JSON API пакетной синхронизации).
+-- Применение: psql -d warehouse_capacity -f sql/001_row_versions.sql
+
+ALTER TABLE clients   ADD COLUMN IF NOT EXISTS row_version integer NOT NULL DEFAULT 1;
+ALTER TABLE products  ADD COLUMN IF NOT EXISTS row_version integer NOT NULL DEFAULT 1;
+ALTER TABLE zones     ADD COLUMN IF NOT EXISTS row_version integer NOT NULL DEFAULT 1;
+ALTER TABLE resources ADD COLUMN IF NOT EXISTS row_version integer NOT NULL DEFAULT 1;
+ALTER TABLE norms     ADD COLUMN IF NOT EXISTS row_version integer NOT NULL DEFAULT 1;
+
+-- Любое изменение строки (формой или через API) увеличивает её версию
+CREATE OR REPLACE FUNCTION bump_row_version() RETURNS trigger AS $$
+BEGIN
+    NEW.row_version := OLD.row_version + 1;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['clients', 'products', 'zones', 'resources', 'norms'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS trg_%1$s_row_version ON %1$s;', t);
+        EXECUTE format(
+            'CREATE TRIGGER trg_%1$s_row_version BEFORE UPDATE ON %1$s
+             FOR EACH ROW EXECUTE FUNCTION bump_row_version();', t);
+    END LOOP;
+END;
+$$;
+
+-- Естественный ключ норматива: цель ON CONFLICT при пакетной загрузке
+CREATE UNIQUE INDEX IF NOT EXISTS ux_norms_natural_key
+    ON norms (client_id, sku_id, operation_type, zone_type, resource_subtype, unit_type);
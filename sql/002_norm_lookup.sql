@@ -0,0 +1,258 @@
+-- Иерархические нормативы и скомпилированная таблица поиска норм.
+-- Уровни: товар (sku_id задан) → умолчание клиента (sku_id IS NULL)
+--         → общее умолчание (client_id IS NULL, sku_id IS NULL).
+-- Применение: psql -d warehouse_capacity -f sql/002_norm_lookup.sql  (PostgreSQL 15+)
+
+ALTER TABLE norms ALTER COLUMN client_id DROP NOT NULL;
+ALTER TABLE norms ALTER COLUMN sku_id DROP NOT NULL;
+ALTER TABLE norms DROP CONSTRAINT IF EXISTS norms_level_check;
+ALTER TABLE norms ADD CONSTRAINT norms_level_check
+    CHECK (sku_id IS NULL OR client_id IS NOT NULL);
+
+-- Умолчания хранятся с NULL в ключе: NULLS NOT DISTINCT не даёт завести два одинаковых
+DROP INDEX IF EXISTS ux_norms_natural_key;
+CREATE UNIQUE INDEX ux_norms_natural_key
+    ON norms (client_id, sku_id, operation_type, zone_type, resource_subtype, unit_type)
+    NULLS NOT DISTINCT;
+
+-- Плоская таблица: для каждого товара — действующая норма по каждому сочетанию
+-- (операция, ед. изм., тип зоны, подтип ресурса) с указанием уровня, откуда она взята
+CREATE TABLE IF NOT EXISTS norm_lookup (
+    sku_id           integer NOT NULL REFERENCES products (sku_id) ON DELETE CASCADE,
+    operation_type   text    NOT NULL,
+    unit_type        text    NOT NULL,
+    zone_type        text    NOT NULL,
+    resource_subtype text    NOT NULL,
+    norm_id          integer NOT NULL,
+    norm_value       numeric NOT NULL,
+    norm_level       text    NOT NULL CHECK (norm_level IN ('sku', 'client', 'global')),
+    PRIMARY KEY (sku_id, operation_type, unit_type, zone_type, resource_subtype)
+);
+
+-- Поиск норм по уровням: по товару, по клиенту (sku_id IS NULL)
+CREATE INDEX IF NOT EXISTS ix_norms_sku ON norms (sku_id);
+CREATE INDEX IF NOT EXISTS ix_products_client ON products (client_id);
+
+-- Пересборка norm_lookup для набора товаров (NULL — весь справочник).
+-- Три уровня — три соединения по равенству: планировщик берёт индексы, а не
+-- перебирает все пары товар × норматив, как при соединении по OR
+CREATE OR REPLACE FUNCTION rebuild_norm_lookup_skus(p_skus integer[])
+RETURNS void AS $$
+BEGIN
+    DELETE FROM norm_lookup WHERE p_skus IS NULL OR sku_id = ANY(p_skus);
+
+    INSERT INTO norm_lookup (
+        sku_id, operation_type, unit_type, zone_type, resource_subtype,
+        norm_id, norm_value, norm_level
+    )
+    SELECT DISTINCT ON (c.sku_id, c.operation_type, c.unit_type, c.zone_type, c.resource_subtype)
+        c.sku_id, c.operation_type, c.unit_type, c.zone_type, c.resource_subtype,
+        c.norm_id, c.norm_value, c.norm_level
+    FROM (
+        SELECT p.sku_id, n.operation_type, n.unit_type, n.zone_type, n.resource_subtype,
+               n.norm_id, n.norm_value, 'sku' AS norm_level, 1 AS rank
+        FROM products p
+        JOIN norms n ON n.sku_id = p.sku_id
+        WHERE p_skus IS NULL OR p.sku_id = ANY(p_skus)
+        UNION ALL
+        SELECT p.sku_id, n.operation_type, n.unit_type, n.zone_type, n.resource_subtype,
+               n.norm_id, n.norm_value, 'client', 2
+        FROM products p
+        JOIN norms n ON n.client_id = p.client_id AND n.sku_id IS NULL
+        WHERE p_skus IS NULL OR p.sku_id = ANY(p_skus)
+        UNION ALL
+        SELECT p.sku_id, n.operation_type, n.unit_type, n.zone_type, n.resource_subtype,
+               n.norm_id, n.norm_value, 'global', 3
+        FROM products p
+        CROSS JOIN norms n
+        WHERE n.client_id IS NULL AND n.sku_id IS NULL
+          AND (p_skus IS NULL OR p.sku_id = ANY(p_skus))
+    ) c
+    -- Самый конкретный уровень побеждает: сначала норма товара, затем клиента, затем общая
+    ORDER BY c.sku_id, c.operation_type, c.unit_type, c.zone_type, c.resource_subtype, c.rank;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересборка для области: товар, все товары клиента или весь справочник
+CREATE OR REPLACE FUNCTION rebuild_norm_lookup(p_client_id integer, p_sku_id integer)
+RETURNS void AS $$
+BEGIN
+    PERFORM rebuild_norm_lookup_skus(CASE
+        WHEN p_sku_id IS NOT NULL THEN ARRAY[p_sku_id]
+        WHEN p_client_id IS NOT NULL THEN ARRAY(SELECT sku_id FROM products WHERE client_id = p_client_id)
+    END);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Инкрементальная пересборка один раз на оператор: пакетная синхронизация нормативов
+-- пересобирает объединение затронутых областей (товары, товары клиентов), а не область
+-- каждой строки по очереди. Общее умолчание затрагивает все товары — пересборка целиком
+CREATE OR REPLACE FUNCTION norms_refresh_lookup() RETURNS trigger AS $$
+DECLARE
+    v_skus integer[] := '{}';
+    v_clients integer[] := '{}';
+    v_all boolean := FALSE;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT v_skus || array_agg(sku_id) FILTER (WHERE sku_id IS NOT NULL),
+               v_clients || array_agg(client_id) FILTER (WHERE sku_id IS NULL AND client_id IS NOT NULL),
+               v_all OR COALESCE(bool_or(sku_id IS NULL AND client_id IS NULL), FALSE)
+        INTO v_skus, v_clients, v_all
+        FROM old_rows;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT v_skus || array_agg(sku_id) FILTER (WHERE sku_id IS NOT NULL),
+               v_clients || array_agg(client_id) FILTER (WHERE sku_id IS NULL AND client_id IS NOT NULL),
+               v_all OR COALESCE(bool_or(sku_id IS NULL AND client_id IS NULL), FALSE)
+        INTO v_skus, v_clients, v_all
+        FROM new_rows;
+    END IF;
+    IF v_all THEN
+        PERFORM rebuild_norm_lookup_skus(NULL);
+    ELSIF cardinality(v_skus) + cardinality(v_clients) > 0 THEN
+        PERFORM rebuild_norm_lookup_skus(ARRAY(
+            SELECT unnest(v_skus)
+            UNION
+            SELECT sku_id FROM products WHERE client_id = ANY(v_clients)
+        ));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Таблицы переходов допускаются только у триггеров на одно событие
+DROP TRIGGER IF EXISTS trg_norms_refresh_lookup ON norms;
+DROP TRIGGER IF EXISTS trg_norms_refresh_lookup_insert ON norms;
+CREATE TRIGGER trg_norms_refresh_lookup_insert
+    AFTER INSERT ON norms REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION norms_refresh_lookup();
+DROP TRIGGER IF EXISTS trg_norms_refresh_lookup_update ON norms;
+CREATE TRIGGER trg_norms_refresh_lookup_update
+    AFTER UPDATE ON norms REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION norms_refresh_lookup();
+DROP TRIGGER IF EXISTS trg_norms_refresh_lookup_delete ON norms;
+CREATE TRIGGER trg_norms_refresh_lookup_delete
+    AFTER DELETE ON norms REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION norms_refresh_lookup();
+
+-- Новый товар или смена клиента у товара меняют набор применимых умолчаний
+CREATE OR REPLACE FUNCTION products_refresh_lookup() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM rebuild_norm_lookup_skus(ARRAY(SELECT sku_id FROM new_rows));
+    ELSE
+        PERFORM rebuild_norm_lookup_skus(ARRAY(
+            SELECT n.sku_id FROM new_rows n JOIN old_rows o ON o.sku_id = n.sku_id
+            WHERE n.client_id IS DISTINCT FROM o.client_id
+        ));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- UPDATE OF client_id несовместим с таблицами переходов: смена клиента ищется в них
+DROP TRIGGER IF EXISTS trg_products_refresh_lookup ON products;
+DROP TRIGGER IF EXISTS trg_products_refresh_lookup_insert ON products;
+CREATE TRIGGER trg_products_refresh_lookup_insert
+    AFTER INSERT ON products REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION products_refresh_lookup();
+DROP TRIGGER IF EXISTS trg_products_refresh_lookup_update ON products;
+CREATE TRIGGER trg_products_refresh_lookup_update
+    AFTER UPDATE ON products REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION products_refresh_lookup();
+
+SELECT rebuild_norm_lookup(NULL, NULL);
+
+-- Документ поступления и строка плана отгрузки относятся к складу: потребность
+-- распределяется по зонам нужного типа только этого склада, а не всех складов.
+-- Документы без склада (заведённые до этой миграции) по-прежнему ложатся на зоны
+-- этого типа всех складов — укажите склад и пересоберите снимки (flask snapshots rebuild).
+-- При единственном складе он проставляется сразу
+ALTER TABLE inbound_documents ADD COLUMN IF NOT EXISTS warehouse_id integer REFERENCES warehouses (warehouse_id);
+ALTER TABLE outbound_plan ADD COLUMN IF NOT EXISTS warehouse_id integer REFERENCES warehouses (warehouse_id);
+UPDATE inbound_documents SET warehouse_id = (SELECT min(warehouse_id) FROM warehouses)
+WHERE warehouse_id IS NULL AND (SELECT count(*) FROM warehouses) = 1;
+UPDATE outbound_plan SET warehouse_id = (SELECT min(warehouse_id) FROM warehouses)
+WHERE warehouse_id IS NULL AND (SELECT count(*) FROM warehouses) = 1;
+
+-- Потребность по строкам поступлений: один поиск по первичному ключу norm_lookup на строку
+DROP VIEW IF EXISTS v_capacity_balance;
+DROP VIEW IF EXISTS v_resource_requirements;
+
+CREATE VIEW v_resource_requirements AS
+SELECT
+    d.doc_date AS date,
+    d.doc_id,
+    d.doc_number,
+    d.validated,
+    z.zone_id,
+    z.name AS zone_name,
+    nl.resource_subtype AS resource_type,
+    SUM(i.qty / nl.norm_value) AS required_units
+FROM inbound_documents d
+JOIN inbound_items i ON i.doc_id = d.doc_id
+JOIN norm_lookup nl
+  ON nl.sku_id = i.sku_id
+ AND nl.operation_type = 'inbound'
+ AND nl.unit_type = i.unit_type
+JOIN zones z
+  ON z.type = nl.zone_type
+ AND (d.warehouse_id IS NULL OR z.warehouse_id = d.warehouse_id)
+GROUP BY d.doc_date, d.doc_id, d.doc_number, d.validated, z.zone_id, z.name, nl.resource_subtype;
+
+CREATE VIEW v_capacity_balance AS
+WITH required AS (
+    SELECT date, zone_id, zone_name, resource_type AS resource_subtype,
+           SUM(required_units) AS required_hours
+    FROM v_resource_requirements
+    WHERE validated
+    GROUP BY date, zone_id, zone_name, resource_type
+),
+available AS (
+    SELECT ac.date, r.zone_id, z.name AS zone_name, r.subtype AS resource_subtype,
+           SUM(ac.available_hours) AS available_hours
+    FROM available_capacities ac
+    JOIN resources r ON ac.resource_id = r.resource_id
+    JOIN zones z ON r.zone_id = z.zone_id
+    GROUP BY ac.date, r.zone_id, z.name, r.subtype
+)
+SELECT
+    COALESCE(rq.date, av.date) AS date,
+    COALESCE(rq.zone_name, av.zone_name) AS zone_name,
+    COALESCE(rq.resource_subtype, av.resource_subtype) AS resource_subtype,
+    COALESCE(rq.required_hours, 0) AS required_hours,
+    COALESCE(av.available_hours, 0) AS available_hours,
+    COALESCE(av.available_hours, 0) - COALESCE(rq.required_hours, 0) AS balance
+FROM required rq
+FULL JOIN available av
+  ON av.date = rq.date
+ AND av.zone_id = rq.zone_id
+ AND av.resource_subtype = rq.resource_subtype;
+
+-- Строки поступлений, посчитанные по умолчаниям или оставшиеся без нормы
+CREATE OR REPLACE VIEW v_norm_coverage AS
+SELECT
+    d.doc_date AS date,
+    d.doc_id,
+    d.doc_number,
+    c.name AS client_name,
+    p.name AS sku_name,
+    i.unit_type,
+    cov.norm_level
+FROM inbound_documents d
+JOIN inbound_items i ON i.doc_id = d.doc_id
+JOIN clients c ON c.client_id = d.client_id
+JOIN products p ON p.sku_id = i.sku_id
+LEFT JOIN LATERAL (
+    -- Худший уровень среди норм строки: 'global' хуже 'client', 'client' хуже 'sku'
+    SELECT CASE
+               WHEN bool_or(nl.norm_level = 'global') THEN 'global'
+               WHEN bool_or(nl.norm_level = 'client') THEN 'client'
+               WHEN COUNT(*) > 0 THEN 'sku'
+           END AS norm_level
+    FROM norm_lookup nl
+    WHERE nl.sku_id = i.sku_id
+      AND nl.operation_type = 'inbound'
+      AND nl.unit_type = i.unit_type
+) cov ON TRUE
+WHERE cov.norm_level IS DISTINCT FROM 'sku';
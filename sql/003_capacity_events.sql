@@ -0,0 +1,37 @@
+-- Журнал (outbox) событий, влияющих на баланс мощностей.
+-- Пишется маршрутами в той же транзакции, что и изменение данных;
+-- после фиксации транзакции слушатели канала capacity_events получают NOTIFY.
+-- Порядок чтения — (tx_id, event_id): event_id выдаётся при вставке, а транзакции
+-- фиксируются в другом порядке, поэтому читатели берут только события транзакций
+-- старше самой старой незавершённой (pg_snapshot_xmin) — новых среди них уже не появится.
+-- Нужен PostgreSQL 13+ (pg_current_xact_id).
+-- Применение: psql -d warehouse_capacity -f sql/003_capacity_events.sql
+
+CREATE TABLE IF NOT EXISTS capacity_events (
+    event_id         bigserial PRIMARY KEY,
+    -- Транзакция, записавшая событие (xid8 как число)
+    tx_id            bigint NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+    created_at       timestamptz NOT NULL DEFAULT now(),
+    source           text NOT NULL,      -- inbound, outbound, norm, capacity, resource
+    operation        text NOT NULL,      -- create, edit, delete, validate
+    entity_id        integer,
+    -- Затронутая ячейка баланса; NULL, если изменение не меняет часы
+    date             date,
+    zone_id          integer,
+    warehouse_id     integer,
+    zone_name        text,
+    resource_subtype text,
+    required_delta   numeric NOT NULL DEFAULT 0,
+    available_delta  numeric NOT NULL DEFAULT 0,
+    payload          jsonb
+);
+
+CREATE INDEX IF NOT EXISTS ix_capacity_events_created_at ON capacity_events (created_at);
+
+-- Журналы, созданные прежней версией скрипта
+ALTER TABLE capacity_events
+    ADD COLUMN IF NOT EXISTS tx_id bigint NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+    ADD COLUMN IF NOT EXISTS zone_id integer,
+    ADD COLUMN IF NOT EXISTS warehouse_id integer;
+
+CREATE INDEX IF NOT EXISTS ix_capacity_events_position ON capacity_events (tx_id, event_id);
@@ -0,0 +1,16 @@
+-- Поиск по клиентам, товарам, документам поступления и ресурсам.
+-- GiST-индексы pg_trgm отдают ближайшие по сходству строки (ORDER BY <<->) без полного
+-- перебора; GIN-индексы по tsvector находят совпадения по словам с учётом морфологии.
+-- Применение: psql -d warehouse_capacity -f sql/004_search.sql
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS ix_clients_name_trgm   ON clients   USING gist (name gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_products_name_trgm  ON products  USING gist (name gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_resources_name_trgm ON resources USING gist (name gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_inbound_documents_doc_number_trgm
+    ON inbound_documents USING gist (doc_number gist_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS ix_clients_name_fts   ON clients   USING gin (to_tsvector('russian', name));
+CREATE INDEX IF NOT EXISTS ix_products_name_fts  ON products  USING gin (to_tsvector('russian', name));
+CREATE INDEX IF NOT EXISTS ix_resources_name_fts ON resources USING gin (to_tsvector('russian', name));
@@ -0,0 +1,297 @@
+-- Помесячное секционирование таблиц с датой: available_capacities (date),
+-- inbound_documents (doc_date), outbound_plan (date). Запросы с фильтром по дате
+-- читают только нужные месяцы; старые месяцы переносятся в сжатый архив.
+-- Применение: psql -d warehouse_capacity -f sql/005_month_partitions.sql  (PostgreSQL 15+)
+
+BEGIN;
+
+-- Секция месяца: <таблица>_pYYYYMM
+CREATE OR REPLACE FUNCTION ensure_month_partitions(p_table text, p_from date, p_to date)
+RETURNS void AS $$
+DECLARE
+    month date := date_trunc('month', p_from);
+BEGIN
+    WHILE month <= p_to LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L);',
+            p_table || '_p' || to_char(month, 'YYYYMM'), p_table,
+            month, (month + interval '1 month')::date
+        );
+        month := (month + interval '1 month')::date;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции создаются заранее командой `flask partitions create` (по расписанию), а не
+-- при записи: DDL в веб-запросе берёт блокировку родительской таблицы
+DROP FUNCTION IF EXISTS ensure_month_partition(text, date);
+
+-- Перестраивает таблицу в секционированную с тем же составом колонок.
+-- Первичный ключ дополняется датой (ключ секционирования обязан в него входить),
+-- внешние ключи и уникальные ограничения переносятся, вторичные индексы пересоздаются.
+-- Уникальность без даты на секционированной таблице невозможна — такая таблица
+-- не конвертируется (ошибка откатывает весь скрипт), а не теряет ограничение молча.
+CREATE OR REPLACE FUNCTION convert_to_month_partitions(p_table text, p_date_column text, p_key text)
+RETURNS void AS $$
+DECLARE
+    legacy text := p_table || '_unpartitioned';
+    seq text;
+    bounds record;
+    con record;
+    indexes text[];
+    index_def text;
+    unique_without_date text;
+BEGIN
+    EXECUTE format('ALTER TABLE %I RENAME TO %I;', p_table, legacy);
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)
+         PARTITION BY RANGE (%I);', p_table, legacy, p_date_column);
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (%I, %I);', p_table, p_key, p_date_column);
+
+    seq := pg_get_serial_sequence(legacy, p_key);
+    IF seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I;', seq, p_table, p_key);
+    END IF;
+
+    FOR con IN
+        SELECT c.conname, c.contype, pg_get_constraintdef(c.oid) AS def,
+               a.attnum = ANY(c.conkey) AS has_date
+        FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attname = p_date_column
+        WHERE c.conrelid = legacy::regclass AND c.contype IN ('f', 'u')
+    LOOP
+        IF con.contype = 'u' AND NOT con.has_date THEN
+            RAISE EXCEPTION '%: уникальность % не включает колонку %', p_table, con.def, p_date_column
+                USING HINT = 'Добавьте дату в ограничение или удалите его до секционирования';
+        END IF;
+        EXECUTE format('ALTER TABLE %I ADD %s;', p_table, con.def);
+    END LOOP;
+
+    -- Индексы, не обслуживающие ограничения; строятся после загрузки строк
+    SELECT array_agg(pg_get_indexdef(i.indexrelid)),
+           min(pg_get_indexdef(i.indexrelid)) FILTER (
+               WHERE i.indisunique AND NOT a.attnum = ANY(i.indkey::int2[])
+           )
+    INTO indexes, unique_without_date
+    FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attname = p_date_column
+    WHERE i.indrelid = legacy::regclass
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid);
+    IF unique_without_date IS NOT NULL THEN
+        RAISE EXCEPTION '%: уникальный индекс без колонки %: %', p_table, p_date_column, unique_without_date
+            USING HINT = 'Добавьте дату в индекс или удалите его до секционирования';
+    END IF;
+
+    EXECUTE format('SELECT min(%1$I) AS lo, max(%1$I) AS hi FROM %2$I;', p_date_column, legacy)
+        INTO bounds;
+    PERFORM ensure_month_partitions(
+        p_table,
+        COALESCE(bounds.lo, current_date),
+        GREATEST(COALESCE(bounds.hi, current_date), current_date + 90)
+    );
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I;', p_table, legacy);
+    EXECUTE format('DROP TABLE %I;', legacy);
+    -- Имена индексов освободились вместе со старой таблицей
+    FOREACH index_def IN ARRAY COALESCE(indexes, '{}') LOOP
+        EXECUTE regexp_replace(index_def, ' ON \S+ USING ', format(' ON %I USING ', p_table));
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Представления ссылаются на старые таблицы — пересоздаются ниже
+DROP VIEW IF EXISTS v_norm_coverage;
+DROP VIEW IF EXISTS v_capacity_balance;
+DROP VIEW IF EXISTS v_resource_requirements;
+
+-- Строки поступления ссылаются на документ по (doc_id, doc_date): ссылка на
+-- секционированную таблицу возможна только по ключу, включающему дату
+ALTER TABLE inbound_items ADD COLUMN IF NOT EXISTS doc_date date;
+UPDATE inbound_items i SET doc_date = d.doc_date
+FROM inbound_documents d WHERE d.doc_id = i.doc_id;
+ALTER TABLE inbound_items DROP CONSTRAINT IF EXISTS inbound_items_doc_id_fkey;
+
+SELECT convert_to_month_partitions('inbound_documents', 'doc_date', 'doc_id');
+SELECT convert_to_month_partitions('available_capacities', 'date', 'capacity_id');
+SELECT convert_to_month_partitions('outbound_plan', 'date', 'plan_id');
+
+ALTER TABLE inbound_items ALTER COLUMN doc_date SET NOT NULL;
+ALTER TABLE inbound_items
+    ADD CONSTRAINT inbound_items_doc_fkey FOREIGN KEY (doc_id, doc_date)
+    REFERENCES inbound_documents (doc_id, doc_date) ON UPDATE CASCADE ON DELETE CASCADE;
+CREATE INDEX IF NOT EXISTS ix_inbound_items_doc ON inbound_items (doc_id, doc_date);
+
+-- Дата строки берётся из документа: маршруты её не передают
+CREATE OR REPLACE FUNCTION inbound_items_fill_doc_date() RETURNS trigger AS $$
+BEGIN
+    SELECT doc_date INTO NEW.doc_date FROM inbound_documents WHERE doc_id = NEW.doc_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_inbound_items_fill_doc_date ON inbound_items;
+CREATE TRIGGER trg_inbound_items_fill_doc_date
+    BEFORE INSERT ON inbound_items
+    FOR EACH ROW WHEN (NEW.doc_date IS NULL)
+    EXECUTE FUNCTION inbound_items_fill_doc_date();
+
+-- Холодный архив: одна строка на таблицу и месяц, строки месяца — сжатый jsonb (TOAST)
+CREATE TABLE IF NOT EXISTS partition_archive (
+    table_name  text NOT NULL,
+    month       date NOT NULL,
+    archived_at timestamptz NOT NULL DEFAULT now(),
+    row_count   integer NOT NULL,
+    rows        jsonb NOT NULL,
+    PRIMARY KEY (table_name, month)
+);
+
+DO $$
+BEGIN
+    ALTER TABLE partition_archive ALTER COLUMN rows SET COMPRESSION lz4;
+EXCEPTION WHEN feature_not_supported THEN
+    -- Сервер собран без lz4 — остаётся pglz
+    NULL;
+END;
+$$;
+
+-- Таблицы, ссылающиеся на строки секций: их строки архивируются вместе со строкой
+-- секции (под ключом payload_key) и удаляются до отсоединения секции. Следующие
+-- скрипты дописывают сюда свои таблицы, функция архивации определяется один раз.
+CREATE TABLE IF NOT EXISTS partition_archive_dependents (
+    table_name  text NOT NULL,
+    child_table text NOT NULL,
+    payload_key text NOT NULL,
+    key_columns text[] NOT NULL,    -- общие колонки строки секции и зависимой строки
+    PRIMARY KEY (table_name, child_table)
+);
+
+INSERT INTO partition_archive_dependents (table_name, child_table, payload_key, key_columns)
+VALUES ('inbound_documents', 'inbound_items', 'items', ARRAY['doc_id', 'doc_date'])
+ON CONFLICT (table_name, child_table) DO NOTHING;
+
+-- Переносит в архив и удаляет секции месяцев, целиком лежащих до p_before
+CREATE OR REPLACE FUNCTION archive_month_partitions(p_table text, p_before date)
+RETURNS integer AS $$
+DECLARE
+    part record;
+    dep record;
+    month date;
+    archived integer := 0;
+    payload text := 'to_jsonb(t)';
+    matches text;
+    deletes text[] := '{}';
+    statement text;
+BEGIN
+    FOR dep IN
+        SELECT * FROM partition_archive_dependents WHERE table_name = p_table ORDER BY child_table
+    LOOP
+        SELECT string_agg(format('c.%1$I = t.%1$I', col), ' AND ') INTO matches
+        FROM unnest(dep.key_columns) AS col;
+        payload := payload || format(
+            ' || jsonb_build_object(%L, (SELECT jsonb_agg(to_jsonb(c)) FROM %I c WHERE %s))',
+            dep.payload_key, dep.child_table, matches);
+        deletes := deletes || format('DELETE FROM %I c USING %%I t WHERE %s;', dep.child_table, matches);
+    END LOOP;
+
+    FOR part IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = p_table::regclass
+        ORDER BY c.relname
+    LOOP
+        month := to_date(right(part.relname, 6), 'YYYYMM');
+        CONTINUE WHEN (month + interval '1 month')::date > p_before;
+
+        EXECUTE format(
+            'INSERT INTO partition_archive (table_name, month, row_count, rows)
+             SELECT %L, %L, count(*), COALESCE(jsonb_agg(%s), ''[]'') FROM %I t
+             ON CONFLICT (table_name, month) DO UPDATE
+             SET rows = partition_archive.rows || EXCLUDED.rows,
+                 row_count = partition_archive.row_count + EXCLUDED.row_count,
+                 archived_at = now();',
+            p_table, month, payload, part.relname);
+        FOREACH statement IN ARRAY deletes LOOP
+            EXECUTE format(statement, part.relname);
+        END LOOP;
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I;', p_table, part.relname);
+        EXECUTE format('DROP TABLE %I;', part.relname);
+        archived := archived + 1;
+    END LOOP;
+    RETURN archived;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Представления: фильтр по дате должен доходить до секционированных таблиц.
+-- Баланс собирается через UNION ALL + GROUP BY (а не FULL JOIN по COALESCE(дата)),
+-- поэтому условие на date проталкивается в обе ветви и отсекает лишние секции
+CREATE VIEW v_resource_requirements AS
+SELECT
+    d.doc_date AS date,
+    d.doc_id,
+    d.doc_number,
+    d.validated,
+    z.zone_id,
+    z.name AS zone_name,
+    nl.resource_subtype AS resource_type,
+    SUM(i.qty / nl.norm_value) AS required_units
+FROM inbound_documents d
+JOIN inbound_items i ON i.doc_id = d.doc_id AND i.doc_date = d.doc_date
+JOIN norm_lookup nl
+  ON nl.sku_id = i.sku_id
+ AND nl.operation_type = 'inbound'
+ AND nl.unit_type = i.unit_type
+JOIN zones z
+  ON z.type = nl.zone_type
+ AND (d.warehouse_id IS NULL OR z.warehouse_id = d.warehouse_id)
+GROUP BY d.doc_date, d.doc_id, d.doc_number, d.validated, z.zone_id, z.name, nl.resource_subtype;
+
+CREATE VIEW v_capacity_balance AS
+SELECT
+    date,
+    zone_name,
+    resource_subtype,
+    SUM(required_hours) AS required_hours,
+    SUM(available_hours) AS available_hours,
+    SUM(available_hours) - SUM(required_hours) AS balance
+FROM (
+    SELECT date, zone_id, zone_name, resource_type AS resource_subtype,
+           required_units AS required_hours, 0 AS available_hours
+    FROM v_resource_requirements
+    WHERE validated
+    UNION ALL
+    SELECT ac.date, r.zone_id, z.name, r.subtype,
+           0, ac.available_hours
+    FROM available_capacities ac
+    JOIN resources r ON ac.resource_id = r.resource_id
+    JOIN zones z ON r.zone_id = z.zone_id
+) cells
+GROUP BY date, zone_id, zone_name, resource_subtype;
+
+CREATE VIEW v_norm_coverage AS
+SELECT
+    d.doc_date AS date,
+    d.doc_id,
+    d.doc_number,
+    c.name AS client_name,
+    p.name AS sku_name,
+    i.unit_type,
+    cov.norm_level
+FROM inbound_documents d
+JOIN inbound_items i ON i.doc_id = d.doc_id AND i.doc_date = d.doc_date
+JOIN clients c ON c.client_id = d.client_id
+JOIN products p ON p.sku_id = i.sku_id
+LEFT JOIN LATERAL (
+    -- Худший уровень среди норм строки: 'global' хуже 'client', 'client' хуже 'sku'
+    SELECT CASE
+               WHEN bool_or(nl.norm_level = 'global') THEN 'global'
+               WHEN bool_or(nl.norm_level = 'client') THEN 'client'
+               WHEN COUNT(*) > 0 THEN 'sku'
+           END AS norm_level
+    FROM norm_lookup nl
+    WHERE nl.sku_id = i.sku_id
+      AND nl.operation_type = 'inbound'
+      AND nl.unit_type = i.unit_type
+) cov ON TRUE
+WHERE cov.norm_level IS DISTINCT FROM 'sku';
+
+COMMIT;
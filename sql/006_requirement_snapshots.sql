@@ -0,0 +1,60 @@
+-- Снимок потребности документа поступления, зафиксированный при валидации.
+-- Баланс суммирует снимки и не пересчитывает нормативы: правка норматива не меняет
+-- исторический баланс до явной пересъёмки (flask snapshots rebuild).
+-- Применение: psql -d warehouse_capacity -f sql/006_requirement_snapshots.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS inbound_requirement_snapshots (
+    doc_id           integer NOT NULL,
+    doc_date         date NOT NULL,
+    zone_id          integer NOT NULL REFERENCES zones (zone_id) ON DELETE CASCADE,
+    resource_subtype text NOT NULL,
+    required_hours   numeric NOT NULL,
+    snapshot_at      timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (doc_id, zone_id, resource_subtype),
+    FOREIGN KEY (doc_id, doc_date)
+        REFERENCES inbound_documents (doc_id, doc_date) ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ix_inbound_requirement_snapshots_date
+    ON inbound_requirement_snapshots (doc_date);
+
+-- Снимки уже валидированных документов — по текущим нормативам
+INSERT INTO inbound_requirement_snapshots (doc_id, doc_date, zone_id, resource_subtype, required_hours)
+SELECT doc_id, date, zone_id, resource_type, required_units
+FROM v_resource_requirements
+WHERE validated
+ON CONFLICT (doc_id, zone_id, resource_subtype) DO NOTHING;
+
+DROP VIEW IF EXISTS v_capacity_balance;
+
+CREATE VIEW v_capacity_balance AS
+SELECT
+    date,
+    zone_name,
+    resource_subtype,
+    SUM(required_hours) AS required_hours,
+    SUM(available_hours) AS available_hours,
+    SUM(available_hours) - SUM(required_hours) AS balance
+FROM (
+    SELECT s.doc_date AS date, s.zone_id, z.name AS zone_name, s.resource_subtype,
+           s.required_hours, 0 AS available_hours
+    FROM inbound_requirement_snapshots s
+    JOIN zones z ON z.zone_id = s.zone_id
+    UNION ALL
+    SELECT ac.date, r.zone_id, z.name, r.subtype,
+           0, ac.available_hours
+    FROM available_capacities ac
+    JOIN resources r ON ac.resource_id = r.resource_id
+    JOIN zones z ON r.zone_id = z.zone_id
+) cells
+GROUP BY date, zone_id, zone_name, resource_subtype;
+
+-- Архивация месяца поступлений уносит в архив и снимки документов:
+-- иначе секцию нельзя отсоединить из-за ссылок на неё
+INSERT INTO partition_archive_dependents (table_name, child_table, payload_key, key_columns)
+VALUES ('inbound_documents', 'inbound_requirement_snapshots', 'requirements', ARRAY['doc_id', 'doc_date'])
+ON CONFLICT (table_name, child_table) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,114 @@
+-- Потребность отгрузки (подбор, отгрузка) в движке потребности и баланса.
+-- Строки плана отгрузки группируются в документ по номеру, считаются по нормативам
+-- с operation_type = 'outbound' и при валидации фиксируются в снимок, как поступления.
+-- Применение: psql -d warehouse_capacity -f sql/007_outbound_requirements.sql
+
+BEGIN;
+
+ALTER TABLE outbound_plan ADD COLUMN IF NOT EXISTS doc_number text;
+ALTER TABLE outbound_plan ADD COLUMN IF NOT EXISTS unit_type text NOT NULL DEFAULT 'шт';
+
+-- Строки одного документа отгрузки: выбираются при валидации документа целиком
+CREATE INDEX IF NOT EXISTS ix_outbound_plan_doc ON outbound_plan (client_id, doc_number, date);
+
+DROP VIEW IF EXISTS v_capacity_balance;
+DROP VIEW IF EXISTS v_resource_requirements;
+
+-- Потребность поступлений и отгрузок; doc_id отгрузки — plan_id строки плана
+CREATE VIEW v_resource_requirements AS
+SELECT
+    d.doc_date AS date,
+    d.doc_id,
+    d.doc_number::text AS doc_number,
+    d.validated,
+    z.zone_id,
+    z.name AS zone_name,
+    nl.resource_subtype AS resource_type,
+    SUM(i.qty / nl.norm_value) AS required_units,
+    'inbound'::text AS operation_type
+FROM inbound_documents d
+JOIN inbound_items i ON i.doc_id = d.doc_id AND i.doc_date = d.doc_date
+JOIN norm_lookup nl
+  ON nl.sku_id = i.sku_id
+ AND nl.operation_type = 'inbound'
+ AND nl.unit_type = i.unit_type
+JOIN zones z
+  ON z.type = nl.zone_type
+ AND (d.warehouse_id IS NULL OR z.warehouse_id = d.warehouse_id)
+GROUP BY d.doc_date, d.doc_id, d.doc_number, d.validated, z.zone_id, z.name, nl.resource_subtype
+UNION ALL
+SELECT
+    op.date,
+    op.plan_id,
+    COALESCE(op.doc_number, 'План ' || op.plan_id),
+    op.validated,
+    z.zone_id,
+    z.name,
+    nl.resource_subtype,
+    SUM(op.qty / nl.norm_value),
+    'outbound'
+FROM outbound_plan op
+JOIN norm_lookup nl
+  ON nl.sku_id = op.sku_id
+ AND nl.operation_type = 'outbound'
+ AND nl.unit_type = op.unit_type
+JOIN zones z
+  ON z.type = nl.zone_type
+ AND (op.warehouse_id IS NULL OR z.warehouse_id = op.warehouse_id)
+GROUP BY op.date, op.plan_id, op.doc_number, op.validated, z.zone_id, z.name, nl.resource_subtype;
+
+CREATE TABLE IF NOT EXISTS outbound_requirement_snapshots (
+    plan_id          integer NOT NULL,
+    date             date NOT NULL,
+    zone_id          integer NOT NULL REFERENCES zones (zone_id) ON DELETE CASCADE,
+    resource_subtype text NOT NULL,
+    required_hours   numeric NOT NULL,
+    snapshot_at      timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (plan_id, zone_id, resource_subtype),
+    FOREIGN KEY (plan_id, date)
+        REFERENCES outbound_plan (plan_id, date) ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ix_outbound_requirement_snapshots_date
+    ON outbound_requirement_snapshots (date);
+
+INSERT INTO outbound_requirement_snapshots (plan_id, date, zone_id, resource_subtype, required_hours)
+SELECT doc_id, date, zone_id, resource_type, required_units
+FROM v_resource_requirements
+WHERE validated AND operation_type = 'outbound'
+ON CONFLICT (plan_id, zone_id, resource_subtype) DO NOTHING;
+
+-- Третья ветвь UNION ALL: условие на date по-прежнему проталкивается во все ветви
+CREATE VIEW v_capacity_balance AS
+SELECT
+    date,
+    zone_name,
+    resource_subtype,
+    SUM(required_hours) AS required_hours,
+    SUM(available_hours) AS available_hours,
+    SUM(available_hours) - SUM(required_hours) AS balance
+FROM (
+    SELECT s.doc_date AS date, s.zone_id, z.name AS zone_name, s.resource_subtype,
+           s.required_hours, 0 AS available_hours
+    FROM inbound_requirement_snapshots s
+    JOIN zones z ON z.zone_id = s.zone_id
+    UNION ALL
+    SELECT s.date, s.zone_id, z.name, s.resource_subtype,
+           s.required_hours, 0
+    FROM outbound_requirement_snapshots s
+    JOIN zones z ON z.zone_id = s.zone_id
+    UNION ALL
+    SELECT ac.date, r.zone_id, z.name, r.subtype,
+           0, ac.available_hours
+    FROM available_capacities ac
+    JOIN resources r ON ac.resource_id = r.resource_id
+    JOIN zones z ON r.zone_id = z.zone_id
+) cells
+GROUP BY date, zone_id, zone_name, resource_subtype;
+
+-- Архивация месяца плана отгрузки уносит и снимки его строк
+INSERT INTO partition_archive_dependents (table_name, child_table, payload_key, key_columns)
+VALUES ('outbound_plan', 'outbound_requirement_snapshots', 'requirements', ARRAY['plan_id', 'date'])
+ON CONFLICT (table_name, child_table) DO NOTHING;
+
+COMMIT;
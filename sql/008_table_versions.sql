@@ -0,0 +1,86 @@
+-- Версии таблиц для HTTP-кэширования страниц (ETag / 304).
+-- Любая транзакция, менявшая таблицу, при фиксации увеличивает её версию и шлёт NOTIFY table_versions;
+-- воркеры держат версии в памяти и отвечают 304 без запросов к БД.
+-- Применение: psql -d warehouse_capacity -f sql/008_table_versions.sql  (PostgreSQL 13+)
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name text PRIMARY KEY,
+    version    bigint NOT NULL DEFAULT 0
+);
+
+-- Таблицы, изменённые незавершёнными транзакциями. Триггеры операторов только
+-- отмечают таблицу здесь (строки разных транзакций не конфликтуют), а версии
+-- увеличиваются один раз при фиксации — блокировка строки table_versions держится
+-- на время коммита, а не всей транзакции
+CREATE UNLOGGED TABLE IF NOT EXISTS table_version_pending (
+    tx_id      bigint NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+    table_name text NOT NULL,
+    PRIMARY KEY (tx_id, table_name)
+);
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO table_version_pending (table_name) VALUES (TG_ARGV[0])
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Срабатывает при фиксации (отложенный триггер). Первое срабатывание увеличивает
+-- версии всех таблиц транзакции, остальные ничего не находят. Строки версий
+-- блокируются в порядке имён, поэтому конкурирующие коммиты не взаимоблокируются,
+-- а версия одной таблицы растёт в порядке фиксации
+CREATE OR REPLACE FUNCTION apply_table_versions() RETURNS trigger AS $$
+DECLARE
+    tables text[];
+    t record;
+BEGIN
+    WITH done AS (
+        DELETE FROM table_version_pending
+        WHERE tx_id = pg_current_xact_id()::text::bigint
+        RETURNING table_name
+    )
+    SELECT array_agg(table_name) INTO tables FROM done;
+    IF tables IS NULL THEN
+        RETURN NULL;
+    END IF;
+    PERFORM 1 FROM table_versions WHERE table_name = ANY(tables) ORDER BY table_name FOR UPDATE;
+    FOR t IN
+        UPDATE table_versions SET version = version + 1
+        WHERE table_name = ANY(tables)
+        RETURNING table_name, version
+    LOOP
+        PERFORM pg_notify('table_versions', t.table_name || ':' || t.version);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'clients', 'products', 'warehouses', 'zones', 'resources', 'norms', 'norm_lookup',
+        'available_capacities', 'inbound_documents', 'inbound_items', 'outbound_plan',
+        'inbound_requirement_snapshots', 'outbound_requirement_snapshots'
+    ] LOOP
+        INSERT INTO table_versions (table_name) VALUES (t) ON CONFLICT DO NOTHING;
+        -- Триггер уровня оператора отмечает таблицу; версия растёт один раз на транзакцию
+        EXECUTE format('DROP TRIGGER IF EXISTS trg_%s_version ON %I;', t, t);
+        EXECUTE format(
+            'CREATE TRIGGER trg_%s_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I
+             FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version(%L);', t, t, t);
+    END LOOP;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_table_version_pending_apply ON table_version_pending;
+CREATE CONSTRAINT TRIGGER trg_table_version_pending_apply
+    AFTER INSERT ON table_version_pending
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION apply_table_versions();
+
+COMMIT;
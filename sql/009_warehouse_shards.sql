@@ -0,0 +1,44 @@
+-- Склад в балансе: фильтр страниц по складу и шардирование по складам.
+-- Каждый шард — отдельная база с полной схемой (миграции 001–009): зоны, ресурсы,
+-- мощности и документы своих складов; справочники клиентов, товаров, нормативов,
+-- складов и подтипов ресурсов пишутся на основной шард, и приложение тем же запросом
+-- копирует правку на остальные (REFERENCE_TABLES в app.py). Новый шард и расхождение
+-- после сбоя выравнивает flask shards sync-reference.
+-- Карта шардов — переменная DB_SHARDS. Запись идёт на шард склада строки: новая зона —
+-- по складу, ресурс — по зоне, мощность — по ресурсу, документ — по складу документа;
+-- перенос строки между складами разных шардов отклоняется. Ключи этих таблиц не
+-- должны пересекаться между шардами: после изменения карты — flask shards keys.
+-- Применение: psql -d warehouse_capacity -f sql/009_warehouse_shards.sql
+--             (на шардах: flask shards apply sql/009_warehouse_shards.sql)
+
+BEGIN;
+
+CREATE OR REPLACE VIEW v_capacity_balance AS
+SELECT
+    date,
+    zone_name,
+    resource_subtype,
+    SUM(required_hours) AS required_hours,
+    SUM(available_hours) AS available_hours,
+    SUM(available_hours) - SUM(required_hours) AS balance,
+    warehouse_id
+FROM (
+    SELECT s.doc_date AS date, s.zone_id, z.warehouse_id, z.name AS zone_name, s.resource_subtype,
+           s.required_hours, 0 AS available_hours
+    FROM inbound_requirement_snapshots s
+    JOIN zones z ON z.zone_id = s.zone_id
+    UNION ALL
+    SELECT s.date, s.zone_id, z.warehouse_id, z.name, s.resource_subtype,
+           s.required_hours, 0
+    FROM outbound_requirement_snapshots s
+    JOIN zones z ON z.zone_id = s.zone_id
+    UNION ALL
+    SELECT ac.date, r.zone_id, z.warehouse_id, z.name, r.subtype,
+           0, ac.available_hours
+    FROM available_capacities ac
+    JOIN resources r ON ac.resource_id = r.resource_id
+    JOIN zones z ON r.zone_id = z.zone_id
+) cells
+GROUP BY date, zone_id, warehouse_id, zone_name, resource_subtype;
+
+COMMIT;
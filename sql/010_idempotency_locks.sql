@@ -0,0 +1,65 @@
+-- Идемпотентность создания документов и пакетного API, версии и блокировка подтверждённых поступлений.
+-- Повтор запроса с тем же ключом (двойной клик, ретрай клиента) возвращает результат первого;
+-- подтверждённое поступление больше не редактируется — ни формой, ни напрямую в БД.
+-- Применение: psql -d warehouse_capacity -f sql/010_idempotency_locks.sql
+
+BEGIN;
+
+-- Ключ занимается в той же транзакции, что и сама запись: параллельный дубль ждёт её завершения
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key         text PRIMARY KEY,
+    endpoint    text NOT NULL,
+    created_at  timestamptz NOT NULL DEFAULT now(),
+    result_id   integer,
+    status      integer,
+    response    jsonb
+);
+CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at ON idempotency_keys (created_at);
+
+-- Версия документа для оптимистичной проверки формы редактирования (bump_row_version — sql/001)
+ALTER TABLE inbound_documents ADD COLUMN IF NOT EXISTS row_version integer NOT NULL DEFAULT 1;
+DROP TRIGGER IF EXISTS trg_inbound_documents_row_version ON inbound_documents;
+CREATE TRIGGER trg_inbound_documents_row_version
+    BEFORE UPDATE ON inbound_documents
+    FOR EACH ROW EXECUTE FUNCTION bump_row_version();
+
+-- Реквизиты подтверждённого документа неизменны
+CREATE OR REPLACE FUNCTION inbound_documents_locked() RETURNS trigger AS $$
+BEGIN
+    IF OLD.validated AND (NEW.client_id, NEW.doc_number, NEW.doc_date, NEW.validated)
+            IS DISTINCT FROM (OLD.client_id, OLD.doc_number, OLD.doc_date, OLD.validated) THEN
+        RAISE EXCEPTION 'Поступление % подтверждено и не может быть изменено', OLD.doc_id
+            USING ERRCODE = 'check_violation';
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_inbound_documents_locked ON inbound_documents;
+CREATE TRIGGER trg_inbound_documents_locked
+    BEFORE UPDATE ON inbound_documents
+    FOR EACH ROW WHEN (OLD.validated)
+    EXECUTE FUNCTION inbound_documents_locked();
+
+-- Позиции в подтверждённый документ не добавляются. Удаление не запрещено:
+-- документ удаляется каскадом, а архивация секций переносит и удаляет позиции.
+-- Срабатывает после trg_inbound_items_fill_doc_date (порядок триггеров — по имени).
+CREATE OR REPLACE FUNCTION inbound_items_locked() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM inbound_documents
+        WHERE doc_id = NEW.doc_id AND doc_date = NEW.doc_date AND validated
+    ) THEN
+        RAISE EXCEPTION 'Поступление % подтверждено и не может быть изменено', NEW.doc_id
+            USING ERRCODE = 'check_violation';
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_inbound_items_locked ON inbound_items;
+CREATE TRIGGER trg_inbound_items_locked
+    BEFORE INSERT ON inbound_items
+    FOR EACH ROW EXECUTE FUNCTION inbound_items_locked();
+
+COMMIT;
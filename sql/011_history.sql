@@ -0,0 +1,168 @@
+-- История изменений для запросов «на момент времени».
+-- Для каждой отслеживаемой таблицы ведётся <таблица>_history: те же колонки плюс
+-- valid — интервал времени, когда версия строки была текущей. Вставка открывает
+-- версию [now(), ∞), изменение закрывает старую и открывает новую, удаление закрывает.
+-- Записи пишут триггеры уровня оператора (таблицы переходов): пакетные операции
+-- дают два запроса к истории, а не по паре на строку. Маршруты не меняются.
+-- Версии, прожившие меньше одной транзакции, получают пустой интервал и в срезах не видны.
+-- now() — время начала транзакции: версию, открытую параллельной транзакцией, начавшейся
+-- позже, закрываем не раньше её начала — greatest(lower, now()), иначе интервал некорректен.
+-- История начинается с момента применения миграции. Новая колонка отслеживаемой таблицы
+-- добавляется той же миграцией и в её _history (триггер пишет колонки по именам).
+-- Применение: psql -d warehouse_capacity -f sql/011_history.sql
+
+BEGIN;
+
+-- GiST по (ключ/дата, интервал) — одним индексом
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+-- Аргументы триггера: таблица истории, затем колонки ключа строки
+CREATE OR REPLACE FUNCTION record_history() RETURNS trigger AS $$
+DECLARE
+    history_keys text;
+    old_keys text;
+    columns text;
+BEGIN
+    SELECT string_agg(format('h.%I', k), ', '), string_agg(format('o.%I', k), ', ')
+    INTO history_keys, old_keys
+    FROM unnest(TG_ARGV[1:]) AS k;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        EXECUTE format(
+            'UPDATE %I h SET valid = tstzrange(lower(h.valid), greatest(lower(h.valid), now()))
+             FROM old_rows o
+             WHERE upper_inf(h.valid) AND (%s) = (%s);',
+            TG_ARGV[0], history_keys, old_keys);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+        FROM pg_attribute
+        WHERE attrelid = TG_RELID AND attnum > 0 AND NOT attisdropped;
+        EXECUTE format(
+            'INSERT INTO %I (%s, valid) SELECT %s, tstzrange(now(), NULL) FROM new_rows;',
+            TG_ARGV[0], columns, columns);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t record;
+    history text;
+    key_list text;
+    trigger_args text;
+    has_rows boolean;
+BEGIN
+    FOR t IN
+        SELECT * FROM (VALUES
+            ('clients',                        ARRAY['client_id'],   NULL),
+            ('zones',                          ARRAY['zone_id'],     NULL),
+            ('resources',                      ARRAY['resource_id'], NULL),
+            ('norms',                          ARRAY['norm_id'],     NULL),
+            ('available_capacities',           ARRAY['capacity_id'], 'date'),
+            ('inbound_documents',              ARRAY['doc_id'],      'doc_date'),
+            ('inbound_items',                  ARRAY['item_id'],     'doc_date'),
+            ('outbound_plan',                  ARRAY['plan_id'],     'date'),
+            ('inbound_requirement_snapshots',  ARRAY['doc_id', 'zone_id', 'resource_subtype'],  'doc_date'),
+            ('outbound_requirement_snapshots', ARRAY['plan_id', 'zone_id', 'resource_subtype'], 'date')
+        ) AS v(name, keys, date_column)
+    LOOP
+        history := t.name || '_history';
+        SELECT string_agg(quote_ident(k), ', '), string_agg(quote_literal(k), ', ')
+        INTO key_list, trigger_args
+        FROM unnest(t.keys) AS k;
+        trigger_args := quote_literal(history) || ', ' || trigger_args;
+
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I (LIKE %I, valid tstzrange NOT NULL);', history, t.name);
+        -- Текущая версия строки — одна; по этому индексу триггер закрывает версии
+        EXECUTE format('CREATE UNIQUE INDEX IF NOT EXISTS %I ON %I (%s) WHERE upper_inf(valid);',
+                       'ux_' || history || '_current', history, key_list);
+        -- История одной строки и соединения «на момент»
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I USING gist (%s, valid);',
+                       'ix_' || history || '_key', history, key_list);
+        -- Срез периода «на момент»: даты и интервал в одном индексе
+        IF t.date_column IS NOT NULL THEN
+            EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I USING gist (%I, valid);',
+                           'ix_' || history || '_date', history, history, t.date_column);
+        END IF;
+
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I);', history) INTO has_rows;
+        IF NOT has_rows THEN
+            EXECUTE format('INSERT INTO %I SELECT t.*, tstzrange(now(), NULL) FROM %I t;', history, t.name);
+        END IF;
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I;', 'trg_' || t.name || '_history_insert', t.name);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows
+             FOR EACH STATEMENT EXECUTE FUNCTION record_history(%s);',
+            'trg_' || t.name || '_history_insert', t.name, trigger_args);
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I;', 'trg_' || t.name || '_history_update', t.name);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+             FOR EACH STATEMENT EXECUTE FUNCTION record_history(%s);',
+            'trg_' || t.name || '_history_update', t.name, trigger_args);
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I;', 'trg_' || t.name || '_history_delete', t.name);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows
+             FOR EACH STATEMENT EXECUTE FUNCTION record_history(%s);',
+            'trg_' || t.name || '_history_delete', t.name, trigger_args);
+    END LOOP;
+END;
+$$;
+
+-- Срезы «на момент». Функции на SQL без STRICT встраиваются в запрос,
+-- поэтому внешние условия (по дате, клиенту) доходят до индексов истории.
+CREATE OR REPLACE FUNCTION norms_as_of(p_at timestamptz) RETURNS SETOF norms_history AS $$
+    SELECT * FROM norms_history WHERE valid @> p_at;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION available_capacities_as_of(p_at timestamptz)
+RETURNS SETOF available_capacities_history AS $$
+    SELECT * FROM available_capacities_history WHERE valid @> p_at;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION inbound_documents_as_of(p_at timestamptz)
+RETURNS SETOF inbound_documents_history AS $$
+    SELECT * FROM inbound_documents_history WHERE valid @> p_at;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION inbound_items_as_of(p_at timestamptz)
+RETURNS SETOF inbound_items_history AS $$
+    SELECT * FROM inbound_items_history WHERE valid @> p_at;
+$$ LANGUAGE sql STABLE;
+
+-- Баланс на момент времени: тот же запрос, что v_capacity_balance (sql/009), по истории
+CREATE OR REPLACE FUNCTION capacity_balance_as_of(p_at timestamptz)
+RETURNS SETOF v_capacity_balance AS $$
+    SELECT
+        date,
+        zone_name,
+        resource_subtype,
+        SUM(required_hours) AS required_hours,
+        SUM(available_hours) AS available_hours,
+        SUM(available_hours) - SUM(required_hours) AS balance,
+        warehouse_id
+    FROM (
+        SELECT s.doc_date AS date, s.zone_id, z.warehouse_id, z.name AS zone_name, s.resource_subtype,
+               s.required_hours, 0 AS available_hours
+        FROM inbound_requirement_snapshots_history s
+        JOIN zones_history z ON z.zone_id = s.zone_id AND z.valid @> p_at
+        WHERE s.valid @> p_at
+        UNION ALL
+        SELECT s.date, s.zone_id, z.warehouse_id, z.name, s.resource_subtype,
+               s.required_hours, 0
+        FROM outbound_requirement_snapshots_history s
+        JOIN zones_history z ON z.zone_id = s.zone_id AND z.valid @> p_at
+        WHERE s.valid @> p_at
+        UNION ALL
+        SELECT ac.date, r.zone_id, z.warehouse_id, z.name, r.subtype,
+               0, ac.available_hours
+        FROM available_capacities_history ac
+        JOIN resources_history r ON ac.resource_id = r.resource_id AND r.valid @> p_at
+        JOIN zones_history z ON r.zone_id = z.zone_id AND z.valid @> p_at
+        WHERE ac.valid @> p_at
+    ) cells
+    GROUP BY date, zone_id, warehouse_id, zone_name, resource_subtype;
+$$ LANGUAGE sql STABLE;
+
+COMMIT;
@@ -0,0 +1,128 @@
+-- Проверки качества данных, из-за которых баланс молча врёт.
+-- Находки ищутся запросами NOT EXISTS по всему набору (flask data-quality scan --full)
+-- или только в областях, где что-то изменилось: триггеры уровня оператора пишут
+-- затронутые ключи (товар или зона, иногда с датой) в data_quality_dirty, и обычный
+-- прогон перепроверяет лишь их. Готовые находки лежат в data_quality_findings —
+-- страница /data-quality читает их, не выполняя проверок.
+-- Сами проверки — DATA_QUALITY_CHECKS в app.py; здесь — хранение, очередь и индексы.
+-- После применения выполните: flask data-quality scan --full; дальше — по расписанию
+-- (cron): flask data-quality scan каждые 10 минут, flask data-quality scan --full раз в сутки.
+-- Нужен PostgreSQL 15+: уникальный индекс находок построен с NULLS NOT DISTINCT.
+-- Применение: psql -d warehouse_capacity -f sql/012_data_quality.sql
+--             (на шардах: flask shards apply sql/012_data_quality.sql)
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS data_quality_findings (
+    check_name text NOT NULL,
+    -- Область перепроверки (товар или зона) и строка с проблемой
+    scope_id   integer NOT NULL,
+    entity_id  integer NOT NULL,
+    day        date,
+    details    jsonb NOT NULL,
+    found_at   timestamptz NOT NULL DEFAULT now()
+);
+
+-- Одна находка на строку и день; по нему же — постраничный просмотр по entity_id.
+-- NULLS NOT DISTINCT (PostgreSQL 15+): находки без дня тоже уникальны
+CREATE UNIQUE INDEX IF NOT EXISTS ux_data_quality_findings
+    ON data_quality_findings (check_name, entity_id, day) NULLS NOT DISTINCT;
+-- Удаление находок перепроверяемой области
+CREATE INDEX IF NOT EXISTS ix_data_quality_findings_scope
+    ON data_quality_findings (check_name, scope_id, day);
+-- Постраничный просмотр проверок с датой: по дню, затем по строке
+CREATE INDEX IF NOT EXISTS ix_data_quality_findings_day
+    ON data_quality_findings (check_name, day, entity_id);
+
+-- Очередь изменённых областей; day IS NULL — все дни области
+CREATE TABLE IF NOT EXISTS data_quality_dirty (
+    check_name text NOT NULL,
+    scope_id   integer NOT NULL,
+    day        date
+);
+CREATE INDEX IF NOT EXISTS ix_data_quality_dirty ON data_quality_dirty (check_name);
+
+-- Последние прогоны и число находок после них: счётчики страницы не пересчитываются
+CREATE TABLE IF NOT EXISTS data_quality_scans (
+    check_name   text PRIMARY KEY,
+    findings     integer NOT NULL DEFAULT 0,
+    scanned_at   timestamptz,
+    full_scan_at timestamptz
+);
+
+-- Индексы под антисоединения и выборку области
+CREATE INDEX IF NOT EXISTS ix_inbound_items_sku ON inbound_items (sku_id, unit_type);
+CREATE INDEX IF NOT EXISTS ix_resources_zone ON resources (zone_id, subtype);
+CREATE INDEX IF NOT EXISTS ix_available_capacities_resource_date ON available_capacities (resource_id, date);
+CREATE INDEX IF NOT EXISTS ix_inbound_requirement_snapshots_zone_date
+    ON inbound_requirement_snapshots (zone_id, doc_date);
+
+-- Аргументы триггера: проверка, выражение области и выражение дня (NULL — все дни) над строкой r
+CREATE OR REPLACE FUNCTION data_quality_mark() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        EXECUTE format(
+            'INSERT INTO data_quality_dirty (check_name, scope_id, day)
+             SELECT DISTINCT %L, s.scope_id, s.day
+             FROM (SELECT %s AS scope_id, %s::date AS day FROM old_rows r) s
+             WHERE s.scope_id IS NOT NULL;',
+            TG_ARGV[0], TG_ARGV[1], TG_ARGV[2]);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        EXECUTE format(
+            'INSERT INTO data_quality_dirty (check_name, scope_id, day)
+             SELECT DISTINCT %L, s.scope_id, s.day
+             FROM (SELECT %s AS scope_id, %s::date AS day FROM new_rows r) s
+             WHERE s.scope_id IS NOT NULL;',
+            TG_ARGV[0], TG_ARGV[1], TG_ARGV[2]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t record;
+    trigger_name text;
+BEGIN
+    FOR t IN
+        SELECT * FROM (VALUES
+            ('products',                      'product_units',  'r.sku_id',  'NULL'),
+            ('inbound_items',                 'inbound_norm',   'r.sku_id',  'NULL'),
+            ('norm_lookup',                   'inbound_norm',   'r.sku_id',  'NULL'),
+            ('zones',                         'zone_resources', 'r.zone_id', 'NULL'),
+            ('resources',                     'zone_resources', 'r.zone_id', 'NULL'),
+            ('resources',                     'capacity_gap',   'r.zone_id', 'NULL'),
+            ('available_capacities',          'capacity_gap',
+             '(SELECT x.zone_id FROM resources x WHERE x.resource_id = r.resource_id)', 'r.date'),
+            ('inbound_requirement_snapshots', 'capacity_gap',   'r.zone_id', 'r.doc_date')
+        ) AS v(table_name, check_name, scope_expr, day_expr)
+    LOOP
+        trigger_name := 'trg_' || t.table_name || '_dq_' || t.check_name;
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I;', trigger_name || '_insert', t.table_name);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows
+             FOR EACH STATEMENT EXECUTE FUNCTION data_quality_mark(%L, %L, %L);',
+            trigger_name || '_insert', t.table_name, t.check_name, t.scope_expr, t.day_expr);
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I;', trigger_name || '_update', t.table_name);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+             FOR EACH STATEMENT EXECUTE FUNCTION data_quality_mark(%L, %L, %L);',
+            trigger_name || '_update', t.table_name, t.check_name, t.scope_expr, t.day_expr);
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I;', trigger_name || '_delete', t.table_name);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows
+             FOR EACH STATEMENT EXECUTE FUNCTION data_quality_mark(%L, %L, %L);',
+            trigger_name || '_delete', t.table_name, t.check_name, t.scope_expr, t.day_expr);
+    END LOOP;
+END;
+$$;
+
+-- Страница находок кешируется по версии таблицы (sql/008_table_versions.sql)
+INSERT INTO table_versions (table_name) VALUES ('data_quality_findings') ON CONFLICT DO NOTHING;
+DROP TRIGGER IF EXISTS trg_data_quality_findings_version ON data_quality_findings;
+CREATE TRIGGER trg_data_quality_findings_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON data_quality_findings
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version('data_quality_findings');
+
+COMMIT;
@@ -0,0 +1,294 @@
+-- Справочник подтипов ресурсов: категория (персонал / техника), стоимость часа
+-- своими силами, сверхурочно и в аренде, срок подвоза арендной техники или вызова
+-- временного персонала. Ресурсы, нормативы, norm_lookup и снимки потребности
+-- получают subtype_id; баланс и потребность соединяются по нему. Текстовые колонки
+-- подтипа остаются подписью: по названию подтип находится в справочнике. Новые
+-- подтипы заводит приложение только на основном шарде и копирует на остальные с тем
+-- же id (ensure_subtypes в app.py); неизвестный подтип триггер отклоняет.
+-- Приложение держит справочник в памяти и перечитывает по версии таблицы.
+-- Применение: psql -d warehouse_capacity -f sql/013_resource_subtypes.sql
+--             (на шардах: flask shards apply sql/013_resource_subtypes.sql)
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS resource_subtypes (
+    subtype_id             serial PRIMARY KEY,
+    name                   text NOT NULL UNIQUE,
+    category               text CHECK (category IN ('staff', 'equipment')),
+    -- Руб. за час; NULL — стоимость не задана
+    cost_per_hour          numeric,
+    overtime_cost_per_hour numeric,
+    rental_cost_per_hour   numeric,
+    -- За сколько дней нужно заказать аренду (временный персонал)
+    rental_lead_days       integer NOT NULL DEFAULT 0 CHECK (rental_lead_days >= 0)
+);
+
+-- Подтипы, которые раньше различались по подстрокам названия
+INSERT INTO resource_subtypes (name, category) VALUES
+    ('Приёмщик', 'staff'), ('Грузчик', 'staff'), ('Контролёр', 'staff'),
+    ('Ричтрак', 'equipment'), ('Паллетоперевозчик', 'equipment'), ('Тележка', 'equipment')
+ON CONFLICT (name) DO NOTHING;
+
+-- Прочие уже встречающиеся подтипы: категория — по типу ресурсов с этим подтипом
+INSERT INTO resource_subtypes (name, category)
+SELECT subtype, CASE WHEN COUNT(DISTINCT type) = 1 THEN MIN(type) END
+FROM resources
+WHERE type IN ('staff', 'equipment')
+GROUP BY subtype
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO resource_subtypes (name)
+SELECT resource_subtype FROM norms
+UNION SELECT subtype FROM resources
+UNION SELECT resource_subtype FROM inbound_requirement_snapshots
+UNION SELECT resource_subtype FROM outbound_requirement_snapshots
+ON CONFLICT (name) DO NOTHING;
+
+-- Подтип по названию. Заводить его здесь нельзя: последовательность шарда выдала бы
+-- id, который на основном шарде занят другим подтипом
+DROP FUNCTION IF EXISTS resource_subtype_id(text, text);
+CREATE OR REPLACE FUNCTION resource_subtype_id(p_name text) RETURNS integer AS $$
+DECLARE
+    v_id integer;
+BEGIN
+    SELECT subtype_id INTO v_id FROM resource_subtypes WHERE name = p_name;
+    IF v_id IS NULL THEN
+        RAISE EXCEPTION 'Неизвестный подтип ресурса: %', p_name;
+    END IF;
+    RETURN v_id;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+ALTER TABLE resources ADD COLUMN IF NOT EXISTS subtype_id integer REFERENCES resource_subtypes (subtype_id);
+ALTER TABLE norms ADD COLUMN IF NOT EXISTS subtype_id integer REFERENCES resource_subtypes (subtype_id);
+ALTER TABLE norm_lookup ADD COLUMN IF NOT EXISTS subtype_id integer REFERENCES resource_subtypes (subtype_id);
+ALTER TABLE inbound_requirement_snapshots
+    ADD COLUMN IF NOT EXISTS subtype_id integer REFERENCES resource_subtypes (subtype_id);
+ALTER TABLE outbound_requirement_snapshots
+    ADD COLUMN IF NOT EXISTS subtype_id integer REFERENCES resource_subtypes (subtype_id);
+-- История пишет колонки по именам (sql/011_history.sql)
+ALTER TABLE resources_history ADD COLUMN IF NOT EXISTS subtype_id integer;
+ALTER TABLE norms_history ADD COLUMN IF NOT EXISTS subtype_id integer;
+ALTER TABLE inbound_requirement_snapshots_history ADD COLUMN IF NOT EXISTS subtype_id integer;
+ALTER TABLE outbound_requirement_snapshots_history ADD COLUMN IF NOT EXISTS subtype_id integer;
+
+-- Заполнение без триггеров: данные не меняются, и ни версии, ни история, ни очередь
+-- проверок качества не должны считать это изменением
+DO $$
+DECLARE
+    t record;
+BEGIN
+    FOR t IN
+        SELECT * FROM (VALUES
+            ('resources', 'subtype'),
+            ('norms', 'resource_subtype'),
+            ('norm_lookup', 'resource_subtype'),
+            ('inbound_requirement_snapshots', 'resource_subtype'),
+            ('outbound_requirement_snapshots', 'resource_subtype')
+        ) AS v(name, subtype_column)
+    LOOP
+        EXECUTE format('ALTER TABLE %I DISABLE TRIGGER USER;', t.name);
+        EXECUTE format(
+            'UPDATE %I x SET subtype_id = st.subtype_id FROM resource_subtypes st
+             WHERE st.name = x.%I AND x.subtype_id IS NULL;',
+            t.name, t.subtype_column);
+        EXECUTE format('ALTER TABLE %I ENABLE TRIGGER USER;', t.name);
+        EXECUTE format('ALTER TABLE %I ALTER COLUMN subtype_id SET NOT NULL;', t.name);
+        IF t.name <> 'norm_lookup' THEN
+            EXECUTE format(
+                'UPDATE %I x SET subtype_id = st.subtype_id FROM resource_subtypes st
+                 WHERE st.name = x.%I AND x.subtype_id IS NULL;',
+                t.name || '_history', t.subtype_column);
+        END IF;
+    END LOOP;
+END;
+$$;
+
+-- Ресурсы и нормативы по-прежнему пишутся с названием подтипа: id находит триггер
+CREATE OR REPLACE FUNCTION resources_fill_subtype_id() RETURNS trigger AS $$
+BEGIN
+    NEW.subtype_id := resource_subtype_id(NEW.subtype);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_resources_fill_subtype_id ON resources;
+CREATE TRIGGER trg_resources_fill_subtype_id
+    BEFORE INSERT OR UPDATE OF type, subtype ON resources
+    FOR EACH ROW EXECUTE FUNCTION resources_fill_subtype_id();
+
+CREATE OR REPLACE FUNCTION norms_fill_subtype_id() RETURNS trigger AS $$
+BEGIN
+    NEW.subtype_id := resource_subtype_id(NEW.resource_subtype);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_norms_fill_subtype_id ON norms;
+CREATE TRIGGER trg_norms_fill_subtype_id
+    BEFORE INSERT OR UPDATE OF resource_subtype ON norms
+    FOR EACH ROW EXECUTE FUNCTION norms_fill_subtype_id();
+
+-- Проверка capacity_gap (sql/012_data_quality.sql) соединяет ресурсы со снимками по id подтипа
+DROP INDEX IF EXISTS ix_resources_zone;
+CREATE INDEX IF NOT EXISTS ix_resources_zone_subtype ON resources (zone_id, subtype_id);
+
+-- Та же пересборка, что в sql/002_norm_lookup.sql, плюс id подтипа из норматива
+CREATE OR REPLACE FUNCTION rebuild_norm_lookup_skus(p_skus integer[])
+RETURNS void AS $$
+BEGIN
+    DELETE FROM norm_lookup WHERE p_skus IS NULL OR sku_id = ANY(p_skus);
+
+    INSERT INTO norm_lookup (
+        sku_id, operation_type, unit_type, zone_type, resource_subtype,
+        norm_id, norm_value, norm_level, subtype_id
+    )
+    SELECT DISTINCT ON (c.sku_id, c.operation_type, c.unit_type, c.zone_type, c.resource_subtype)
+        c.sku_id, c.operation_type, c.unit_type, c.zone_type, c.resource_subtype,
+        c.norm_id, c.norm_value, c.norm_level, c.subtype_id
+    FROM (
+        SELECT p.sku_id, n.operation_type, n.unit_type, n.zone_type, n.resource_subtype,
+               n.norm_id, n.norm_value, 'sku' AS norm_level, n.subtype_id, 1 AS rank
+        FROM products p
+        JOIN norms n ON n.sku_id = p.sku_id
+        WHERE p_skus IS NULL OR p.sku_id = ANY(p_skus)
+        UNION ALL
+        SELECT p.sku_id, n.operation_type, n.unit_type, n.zone_type, n.resource_subtype,
+               n.norm_id, n.norm_value, 'client', n.subtype_id, 2
+        FROM products p
+        JOIN norms n ON n.client_id = p.client_id AND n.sku_id IS NULL
+        WHERE p_skus IS NULL OR p.sku_id = ANY(p_skus)
+        UNION ALL
+        SELECT p.sku_id, n.operation_type, n.unit_type, n.zone_type, n.resource_subtype,
+               n.norm_id, n.norm_value, 'global', n.subtype_id, 3
+        FROM products p
+        CROSS JOIN norms n
+        WHERE n.client_id IS NULL AND n.sku_id IS NULL
+          AND (p_skus IS NULL OR p.sku_id = ANY(p_skus))
+    ) c
+    -- Самый конкретный уровень побеждает: сначала норма товара, затем клиента, затем общая
+    ORDER BY c.sku_id, c.operation_type, c.unit_type, c.zone_type, c.resource_subtype, c.rank;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Потребность (sql/007_outbound_requirements.sql) с id подтипа — для снимков
+CREATE OR REPLACE VIEW v_resource_requirements AS
+SELECT
+    d.doc_date AS date,
+    d.doc_id,
+    d.doc_number::text AS doc_number,
+    d.validated,
+    z.zone_id,
+    z.name AS zone_name,
+    nl.resource_subtype AS resource_type,
+    SUM(i.qty / nl.norm_value) AS required_units,
+    'inbound'::text AS operation_type,
+    nl.subtype_id
+FROM inbound_documents d
+JOIN inbound_items i ON i.doc_id = d.doc_id AND i.doc_date = d.doc_date
+JOIN norm_lookup nl
+  ON nl.sku_id = i.sku_id
+ AND nl.operation_type = 'inbound'
+ AND nl.unit_type = i.unit_type
+JOIN zones z
+  ON z.type = nl.zone_type
+ AND (d.warehouse_id IS NULL OR z.warehouse_id = d.warehouse_id)
+GROUP BY d.doc_date, d.doc_id, d.doc_number, d.validated, z.zone_id, z.name, nl.resource_subtype, nl.subtype_id
+UNION ALL
+SELECT
+    op.date,
+    op.plan_id,
+    COALESCE(op.doc_number, 'План ' || op.plan_id),
+    op.validated,
+    z.zone_id,
+    z.name,
+    nl.resource_subtype,
+    SUM(op.qty / nl.norm_value),
+    'outbound',
+    nl.subtype_id
+FROM outbound_plan op
+JOIN norm_lookup nl
+  ON nl.sku_id = op.sku_id
+ AND nl.operation_type = 'outbound'
+ AND nl.unit_type = op.unit_type
+JOIN zones z
+  ON z.type = nl.zone_type
+ AND (op.warehouse_id IS NULL OR z.warehouse_id = op.warehouse_id)
+GROUP BY op.date, op.plan_id, op.doc_number, op.validated, z.zone_id, z.name, nl.resource_subtype, nl.subtype_id;
+
+-- Баланс (sql/009_warehouse_shards.sql): ячейки группируются по id подтипа,
+-- название берётся из справочника; условие на date по-прежнему уходит во все ветви
+CREATE OR REPLACE VIEW v_capacity_balance AS
+SELECT
+    date,
+    zone_name,
+    st.name AS resource_subtype,
+    SUM(required_hours) AS required_hours,
+    SUM(available_hours) AS available_hours,
+    SUM(available_hours) - SUM(required_hours) AS balance,
+    warehouse_id,
+    cells.subtype_id
+FROM (
+    SELECT s.doc_date AS date, s.zone_id, z.warehouse_id, z.name AS zone_name, s.subtype_id,
+           s.required_hours, 0 AS available_hours
+    FROM inbound_requirement_snapshots s
+    JOIN zones z ON z.zone_id = s.zone_id
+    UNION ALL
+    SELECT s.date, s.zone_id, z.warehouse_id, z.name, s.subtype_id,
+           s.required_hours, 0
+    FROM outbound_requirement_snapshots s
+    JOIN zones z ON z.zone_id = s.zone_id
+    UNION ALL
+    SELECT ac.date, r.zone_id, z.warehouse_id, z.name, r.subtype_id,
+           0, ac.available_hours
+    FROM available_capacities ac
+    JOIN resources r ON ac.resource_id = r.resource_id
+    JOIN zones z ON r.zone_id = z.zone_id
+) cells
+JOIN resource_subtypes st ON st.subtype_id = cells.subtype_id
+GROUP BY date, zone_id, warehouse_id, zone_name, cells.subtype_id, st.name;
+
+-- Баланс на момент времени (sql/011_history.sql) — с той же новой колонкой
+CREATE OR REPLACE FUNCTION capacity_balance_as_of(p_at timestamptz)
+RETURNS SETOF v_capacity_balance AS $$
+    SELECT
+        date,
+        zone_name,
+        st.name AS resource_subtype,
+        SUM(required_hours) AS required_hours,
+        SUM(available_hours) AS available_hours,
+        SUM(available_hours) - SUM(required_hours) AS balance,
+        warehouse_id,
+        cells.subtype_id
+    FROM (
+        SELECT s.doc_date AS date, s.zone_id, z.warehouse_id, z.name AS zone_name, s.subtype_id,
+               s.required_hours, 0 AS available_hours
+        FROM inbound_requirement_snapshots_history s
+        JOIN zones_history z ON z.zone_id = s.zone_id AND z.valid @> p_at
+        WHERE s.valid @> p_at
+        UNION ALL
+        SELECT s.date, s.zone_id, z.warehouse_id, z.name, s.subtype_id,
+               s.required_hours, 0
+        FROM outbound_requirement_snapshots_history s
+        JOIN zones_history z ON z.zone_id = s.zone_id AND z.valid @> p_at
+        WHERE s.valid @> p_at
+        UNION ALL
+        SELECT ac.date, r.zone_id, z.warehouse_id, z.name, r.subtype_id,
+               0, ac.available_hours
+        FROM available_capacities_history ac
+        JOIN resources_history r ON ac.resource_id = r.resource_id AND r.valid @> p_at
+        JOIN zones_history z ON r.zone_id = z.zone_id AND z.valid @> p_at
+        WHERE ac.valid @> p_at
+    ) cells
+    JOIN resource_subtypes st ON st.subtype_id = cells.subtype_id
+    GROUP BY date, zone_id, warehouse_id, zone_name, cells.subtype_id, st.name;
+$$ LANGUAGE sql STABLE;
+
+-- Справочник в памяти воркеров перечитывается по версии таблицы (sql/008_table_versions.sql)
+INSERT INTO table_versions (table_name) VALUES ('resource_subtypes') ON CONFLICT DO NOTHING;
+DROP TRIGGER IF EXISTS trg_resource_subtypes_version ON resource_subtypes;
+CREATE TRIGGER trg_resource_subtypes_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON resource_subtypes
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version('resource_subtypes');
+
+COMMIT;